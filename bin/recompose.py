@@ -25,32 +25,73 @@
 # 10101001.0,2006,70.5007328963,292.565271684
 # ...
 #
+# For large files, or several files such as one per year, read them in chunks:
+# python bin/recompose.py ... --first data/contact-crimes-2015.csv data/contact-crimes-2016.csv --chunksize 100000
+#
+# A group's sum isn't known until every file has been read, since any chunk can add to it, so the
+# sums are written at the end. If each file holds different groups, such as one file per year with
+# --groupby year, add --per-file to write each file's sums as soon as it has been read.
+#
 
 import argparse
+import sys
+
 import pandas as pd
 import numpy as np
 
 
-def do_everything(args):
-    first = pd.read_csv(args.first)
-    second = pd.read_csv(args.second)
-    joined = pd.merge(first, second, on=args.join_key)
+def read_first(path, args):
+    """ Yield a FIRST file as DataFrames, in chunks of --chunksize rows if given.
+    """
+    if args.chunksize:
+        for chunk in pd.read_csv(path, chunksize=args.chunksize):
+            yield chunk
+    else:
+        yield pd.read_csv(path)
 
-    groupby = [args.second_key]
-    if args.groupby:
-        groupby.extend(args.groupby.split(","))
+
+def recompose(first, factors, args, groupby):
+    """ Reattribute the numbers in a DataFrame from the FIRST files using +factors+,
+    which is indexed by the join key, and return the sums for each group.
+    """
+    joined = pd.merge(first, factors, left_on=args.join_key, right_index=True)
 
     # fields to aggregate
     fields = [f for f in first.columns if f not in groupby and f != args.join_key]
 
     # apply factors
-    for field in fields:
-        joined[field] = np.multiply(joined[field], joined[args.factor_key])
+    joined[fields] = joined[fields].multiply(joined[args.factor_key], axis=0)
 
     # aggregate
-    joined = joined.groupby(groupby)
-    aggs = joined.agg({f: np.sum for f in fields})
-    print aggs.to_csv()
+    return joined.groupby(groupby)[fields].sum()
+
+
+def do_everything(args):
+    # the factors are much smaller than the numbers, so hold them in memory
+    # and join each chunk of the numbers to them
+    factors = pd.read_csv(args.second).set_index(args.join_key)
+
+    groupby = [args.second_key]
+    if args.groupby:
+        groupby.extend(args.groupby.split(","))
+
+    # only the running sums for each group are kept between chunks
+    aggs = None
+    header = True
+    for path in args.first:
+        for first in read_first(path, args):
+            partial = recompose(first, factors, args, groupby)
+            aggs = partial if aggs is None else aggs.add(partial, fill_value=0)
+
+        if args.per_file and aggs is not None:
+            aggs.to_csv(sys.stdout, header=header)
+            header = False
+            aggs = None
+
+    if aggs is not None:
+        aggs.to_csv(sys.stdout, header=header)
+    elif header:
+        sys.stderr.write("No rows to recompose in %s\n" % ", ".join(args.first))
 
 
 if __name__ == '__main__':
@@ -58,9 +99,11 @@ if __name__ == '__main__':
     parser.add_argument('--join-key', metavar="COLUMN", help='Column name to join datasets on', required=True)
     parser.add_argument('--factor-key', metavar="COLUMN", help='Column name in SECOND file with the factor', required=True)
     parser.add_argument('--second-key', metavar="COLUMN", help='Primary key column name in SECOND file with the factor', required=True)
-    parser.add_argument('--first', metavar="FILE", help='CSV file with one row per join attribute', required=True)
+    parser.add_argument('--first', metavar="FILE", nargs='+', help='CSV files with one row per join attribute. The numbers in all the files are added together.', required=True)
     parser.add_argument('--second', metavar="FILE", help='CSV file with factor column')
     parser.add_argument('--groupby', metavar="COL,COL,...", help='Columns to group by')
+    parser.add_argument('--chunksize', metavar="ROWS", type=int, help='Read the FIRST files this many rows at a time, to limit memory use')
+    parser.add_argument('--per-file', action='store_true', help='Write the sums for each FIRST file once it is read. Only use this if each file holds different groups.')
     args = parser.parse_args()
 
     do_everything(args)
@@ -0,0 +1,82 @@
+import numpy as np
+from scipy import sparse
+
+from wazimap_za.apportion import Apportionment
+
+"""
+Adds up the values for the geographies at one level, such as wards, into
+all of their ancestors: municipalities, districts, provinces and the country.
+
+The hierarchy comes from the parent_level and parent_code of each geography
+in the geography table, so metro wards go straight to their metro and then
+to the province. The values are summed with a sparse (geography x ancestor)
+matrix of ones, so that every level is aggregated in a single multiply.
+"""
+
+
+def geo_ancestors(geos):
+    """ Return a dict from (geo_level, geo_code) to a list of that geography's
+    ancestors, nearest first, from (geo_level, geo_code, parent_level, parent_code)
+    tuples for every geography in a version.
+    """
+    parents = {(level, code): (parent_level, parent_code)
+               for level, code, parent_level, parent_code in geos
+               if parent_level and parent_code}
+
+    ancestors = {}
+    for geo in parents:
+        chain = []
+        parent = parents.get(geo)
+        while parent and parent not in chain:
+            chain.append(parent)
+            parent = parents.get(parent)
+        ancestors[geo] = chain
+
+    return ancestors
+
+
+def ancestor_apportionment(geos, level='ward'):
+    """ An Apportionment from the codes of the geographies at +level+ to
+    each of their ancestors, as (geo_level, geo_code) tuples, with a factor of 1.
+    """
+    targets = {}
+    sources = []
+    i, j = [], []
+
+    for (geo_level, geo_code), chain in geo_ancestors(geos).iteritems():
+        if geo_level != level:
+            continue
+        for ancestor in chain:
+            i.append(len(sources))
+            j.append(targets.setdefault(ancestor, len(targets)))
+        sources.append(geo_code)
+
+    matrix = sparse.coo_matrix((np.ones(len(i)), (i, j)), shape=(len(sources), len(targets)))
+    return Apportionment(sources, sorted(targets, key=targets.get), matrix)
+
+
+def aggregate_to_parents(rows, geos, field_keys, value_keys=('total', ), level='ward'):
+    """ Sum FieldTable rows at +level+, such as
+    {'geo_level': 'ward', 'geo_code': '10404010', 'year': '2016', 'total': '12'},
+    into every ancestor of their geographies, and return the ancestors' rows,
+    grouped by +field_keys+.
+
+    Raises ValueError if a row isn't at +level+, or its geography isn't
+    in the hierarchy.
+    """
+    rows = list(rows)
+    levels = set(row['geo_level'] for row in rows)
+    if levels - set([level]):
+        raise ValueError("Expected only %s rows, not %s" % (level, ', '.join(sorted(levels - set([level])))))
+
+    apportionment = ancestor_apportionment(geos, level)
+    unmapped = set(row['geo_code'] for row in rows) - set(apportionment.source_index)
+    if unmapped:
+        raise ValueError("%d %s geographies have no parents in the geography table: %s" % (
+            len(unmapped), level, ', '.join(sorted(unmapped))))
+
+    results = apportionment.apply_rows(rows, 'geo_code', list(value_keys), field_keys, target_key='geo')
+    for row in results:
+        row['geo_level'], row['geo_code'] = row.pop('geo')
+
+    return results
@@ -0,0 +1,150 @@
+import csv
+import hashlib
+import os
+
+import numpy as np
+from scipy import sparse
+
+"""
+Reattributes numbers from one set of places to another, such as crimes
+counted by police station to wards, or 2011 wards to 2016 wards.
+
+The factors are held as a sparse (source x target) matrix, where each
+entry is the share of a source's numbers that goes to a target, so that
+all the numbers for all the sources are reattributed in one multiply.
+"""
+
+
+class Apportionment(object):
+    """ A sparse matrix of factors from +sources+ to +targets+.
+
+    Usage::
+
+        apportionment = Apportionment.from_csv('ward-factors.csv', 'PoliceStation', 'WARD_ID', 'scal_fac_per_int')
+        # values has a row for each source
+        ward_values = apportionment.apply(values)
+    """
+    def __init__(self, sources, targets, matrix):
+        self.sources = list(sources)
+        self.targets = list(targets)
+        self.matrix = sparse.csr_matrix(matrix)
+        self.source_index = {s: i for i, s in enumerate(self.sources)}
+
+    @classmethod
+    def from_rows(cls, rows, source_key, target_key, factor_key):
+        """ Build an apportionment from dicts with a source, target and factor each.
+        """
+        sources = {}
+        targets = {}
+        i, j, factors = [], [], []
+
+        for row in rows:
+            i.append(sources.setdefault(str(row[source_key]), len(sources)))
+            j.append(targets.setdefault(str(row[target_key]), len(targets)))
+            factors.append(float(row[factor_key]))
+
+        # duplicate entries are summed
+        matrix = sparse.coo_matrix((factors, (i, j)), shape=(len(sources), len(targets)))
+        return cls(sorted(sources, key=sources.get), sorted(targets, key=targets.get), matrix)
+
+    @classmethod
+    def from_csv(cls, path, source_key, target_key, factor_key, cache_dir=None):
+        """ Build an apportionment from a CSV file of factors. If +cache_dir+ is
+        given, the matrix is cached there and only rebuilt when the file changes.
+        """
+        cache_path = None
+        if cache_dir:
+            digest = hashlib.sha1('\t'.join([source_key, target_key, factor_key]))
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            cache_path = os.path.join(cache_dir, 'apportion-%s.npz' % digest.hexdigest())
+
+            if os.path.exists(cache_path):
+                return cls.load(cache_path)
+
+        with open(path) as f:
+            apportionment = cls.from_rows(csv.DictReader(f), source_key, target_key, factor_key)
+
+        if cache_path:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            apportionment.save(cache_path)
+
+        return apportionment
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            matrix = sparse.csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+            return cls(data['sources'].tolist(), data['targets'].tolist(), matrix)
+
+    def save(self, path):
+        # save to a file object, so that numpy doesn't add its own extension
+        with open(path, 'wb') as f:
+            np.savez(f, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                     shape=np.array(self.matrix.shape), sources=np.array(self.sources), targets=np.array(self.targets))
+
+    def apply(self, values):
+        """ Reattribute an array of values with a row for each source, and any
+        other dimensions, such as (source x category x year), returning an
+        array with a row for each target.
+        """
+        values = np.asarray(values, dtype=float)
+        if values.shape[0] != len(self.sources):
+            raise ValueError("Expected %d rows of values, one for each source, not %d" % (len(self.sources), values.shape[0]))
+
+        flat = values.reshape(len(self.sources), -1)
+        result = self.matrix.T.dot(flat)
+        return np.asarray(result).reshape((len(self.targets), ) + values.shape[1:])
+
+    def apply_rows(self, rows, source_key, value_keys, group_keys=(), target_key=None, keep_nulls=False):
+        """ Reattribute dicts with a source, +value_keys+ and +group_keys+ each,
+        such as {'PoliceStation': 'albertinia', 'year': '2004', 'contact': '159'},
+        and return a list of dicts for the targets, with the values summed by
+        target and group. The target goes into +target_key+, which defaults to
+        +source_key+.
+
+        Empty values count as 0, unless +keep_nulls+ is set, when a value of
+        None makes the values of every target it goes to None.
+
+        Raises ValueError if a source has no factors.
+        """
+        target_key = target_key or source_key
+        groups = {}
+        entries = []
+        unknown = set()
+
+        for row in rows:
+            source = str(row[source_key])
+            if source not in self.source_index:
+                unknown.add(source)
+                continue
+            group = groups.setdefault(tuple(row[k] for k in group_keys), len(groups))
+            entries.append((self.source_index[source], group, [
+                np.nan if keep_nulls and row[k] is None else float(row[k] or 0) for k in value_keys]))
+
+        if unknown:
+            raise ValueError("No factors for %d sources: %s" % (len(unknown), ', '.join(sorted(unknown))))
+
+        values = np.zeros((len(self.sources), len(groups), len(value_keys)))
+        present = np.zeros((len(self.sources), len(groups)))
+        for source, group, row_values in entries:
+            values[source, group] += row_values
+            present[source, group] = 1
+
+        result = self.apply(values)
+        # only targets that receive something from a source in the rows
+        reached = self.apply(present) > 0
+
+        group_keys = list(group_keys)
+        results = []
+        for group, g in sorted(groups.iteritems(), key=lambda x: x[1]):
+            for t in np.flatnonzero(reached[:, g]):
+                row = dict(zip(group_keys, group))
+                row[target_key] = self.targets[t]
+                # NaN only comes from nulls
+                row.update(zip(value_keys, [None if np.isnan(v) else v for v in result[t, g].tolist()]))
+                results.append(row)
+
+        return results
@@ -10,3 +10,11 @@ class WazimapConfig(AppConfig):
         if settings.WAZIMAP['default_profile'] == 'ecd':
             from wazimap.views import HomepageView
             HomepageView.template_name = 'homepage_ecd.html'
+
+        if settings.SQLITE_DATA_PATH:
+            from wazimap_za.sqlite_data import use_readonly_sqlite
+            use_readonly_sqlite()
+
+        if settings.TABLE_MANIFEST_PATH:
+            from wazimap_za.manifest import TableManifest, serve_tables_from_manifest
+            serve_tables_from_manifest(TableManifest(settings.TABLE_MANIFEST_PATH))
@@ -0,0 +1,242 @@
+import hashlib
+
+from sqlalchemy import (BigInteger, Column, DateTime, Integer, SmallInteger, String, Table, Text, UniqueConstraint,
+                        and_, func, tuple_)
+
+from wazimap.data.base import Base
+from wazimap.data.utils import get_session
+
+from wazimap_za.loading import table_exists
+
+"""
+Bookkeeping tables used by the import and data management commands.
+
+Like the data tables, these are described with SQLAlchemy and created
+on demand, rather than being Django models with migrations.
+"""
+
+
+# A checksum of the rows for each geography in a data table, used
+# by incremental imports to find the geographies that have changed.
+geo_checksums = Table(
+    'wazimap_za_geo_checksum', Base.metadata,
+    Column('db_table', String(63), primary_key=True),
+    Column('geo_level', String(15), primary_key=True),
+    Column('geo_code', String(10), primary_key=True),
+    Column('geo_version', String(100), primary_key=True),
+    Column('checksum', String(40), nullable=False),
+    Column('updated_at', DateTime, nullable=False, server_default=func.now()),
+)
+
+# The last checkpoint of a long-running import, so that it can be resumed.
+import_progress = Table(
+    'wazimap_za_import_progress', Base.metadata,
+    Column('filepath', String(1024), primary_key=True),
+    Column('db_table', String(63), primary_key=True),
+    Column('geo_version', String(100), primary_key=True),
+    Column('file_size', BigInteger, nullable=False),
+    Column('file_offset', BigInteger, nullable=False),
+    Column('geos_done', Integer, nullable=False),
+    Column('last_geo', String(30)),
+    # JSON list of the indexes that were dropped for the import
+    Column('deferred_indexes', Text),
+    Column('updated_at', DateTime, nullable=False, server_default=func.now()),
+)
+
+# A fingerprint of each data table's contents when checkdata last found
+# it to be complete, so that unchanged tables needn't be checked again.
+table_fingerprints = Table(
+    'wazimap_za_table_fingerprint', Base.metadata,
+    Column('db_table', String(63), primary_key=True),
+    Column('geo_version', String(100), primary_key=True),
+    Column('row_count', BigInteger, nullable=False),
+    Column('fingerprint', String(64), nullable=False),
+    # the number of geographies the table was checked against
+    Column('geo_count', Integer, nullable=False),
+    Column('checked_at', DateTime, nullable=False, server_default=func.now()),
+)
+
+# A checksum of each dump file in sql/ when it was last loaded,
+# so that only changed dumps are reloaded.
+dump_checksums = Table(
+    'wazimap_za_dump_checksum', Base.metadata,
+    Column('filename', String(255), primary_key=True),
+    Column('checksum', String(40), nullable=False),
+    Column('loaded_at', DateTime, nullable=False, server_default=func.now()),
+)
+
+# The labels of dictionary-encoded category columns, by field. Codes are
+# numbered in label order, so that ordering by code orders by label.
+category_labels = Table(
+    'wazimap_za_category', Base.metadata,
+    Column('field', String(128), primary_key=True),
+    Column('code', SmallInteger, primary_key=True),
+    Column('label', String(128), nullable=False),
+    UniqueConstraint('field', 'label'),
+)
+
+# The category columns of data tables that are dictionary-encoded.
+encoded_columns = Table(
+    'wazimap_za_category_column', Base.metadata,
+    Column('db_table', String(63), primary_key=True),
+    Column('field', String(128), primary_key=True),
+)
+
+
+def ensure_table(table):
+    """ Create a bookkeeping table if it doesn't exist yet.
+    """
+    session = get_session()
+    try:
+        table.create(session.get_bind(), checkfirst=True)
+    finally:
+        session.close()
+
+
+def checksum_rows(rows, columns):
+    """ Return a checksum of the values of +columns+ for a list of row dicts.
+    The checksum doesn't depend on the order of the rows.
+    """
+    lines = []
+    for row in rows:
+        line = '\t'.join('%s' % row.get(c) for c in columns)
+        if isinstance(line, unicode):
+            line = line.encode('utf8')
+        lines.append(line)
+
+    digest = hashlib.sha1()
+    for line in sorted(lines):
+        digest.update(line)
+        digest.update('\n')
+
+    return digest.hexdigest()
+
+
+def get_geo_checksums(session, db_table, geo_version):
+    """ Return a dict from (geo_level, geo_code) to the stored checksum for
+    each geography in +db_table+.
+    """
+    if not table_exists(session, geo_checksums.name):
+        # nothing has been imported yet, such as for a dry run
+        return {}
+
+    rows = session.execute(
+        geo_checksums.select().where(and_(
+            geo_checksums.c.db_table == db_table,
+            geo_checksums.c.geo_version == geo_version)))
+
+    return {(r.geo_level, r.geo_code): r.checksum for r in rows}
+
+
+def store_geo_checksums(session, db_table, geo_version, checksums):
+    """ Store a dict from (geo_level, geo_code) to checksum for +db_table+,
+    replacing any existing checksums for those geographies. This is a DELETE
+    and an INSERT, rather than ON CONFLICT, so that it works on PostgreSQL 9.4.
+    """
+    geos = list(checksums)
+    for i in xrange(0, len(geos), 1000):
+        batch = geos[i:i + 1000]
+        clear_geo_checksums(session, db_table, geo_version, batch)
+        session.execute(geo_checksums.insert(), [{
+            'db_table': db_table,
+            'geo_level': geo_level,
+            'geo_code': geo_code,
+            'geo_version': geo_version,
+            'checksum': checksums[(geo_level, geo_code)],
+        } for geo_level, geo_code in batch])
+
+
+def clear_geo_checksums(session, db_table, geo_version=None, geos=None):
+    """ Forget the checksums of +db_table+, optionally only those for a
+    +geo_version+ and a list of (geo_level, geo_code) +geos+. This must be
+    done whenever a table's rows are changed other than by an incremental
+    import, so that the changed geographies aren't skipped by the next one.
+    """
+    if not table_exists(session, geo_checksums.name):
+        return
+
+    conditions = [geo_checksums.c.db_table == db_table]
+    if geo_version is not None:
+        conditions.append(geo_checksums.c.geo_version == geo_version)
+    if geos is not None:
+        conditions.append(tuple_(geo_checksums.c.geo_level, geo_checksums.c.geo_code).in_(geos))
+
+    session.execute(geo_checksums.delete().where(and_(*conditions)))
+
+
+def _import_filter(filepath, db_table, geo_version):
+    return and_(
+        import_progress.c.filepath == filepath,
+        import_progress.c.db_table == db_table,
+        import_progress.c.geo_version == geo_version)
+
+
+def get_import_progress(session, filepath, db_table, geo_version):
+    """ Return the last checkpoint of an import, or None.
+    """
+    if not table_exists(session, import_progress.name):
+        return None
+
+    return session.execute(
+        import_progress.select().where(_import_filter(filepath, db_table, geo_version))).first()
+
+
+def save_import_progress(session, filepath, db_table, geo_version, **values):
+    """ Record a checkpoint of an import. This should be committed in the same
+    transaction as the data imported up to the checkpoint.
+    """
+    session.execute(import_progress.delete().where(_import_filter(filepath, db_table, geo_version)))
+    values.update({
+        'filepath': filepath,
+        'db_table': db_table,
+        'geo_version': geo_version,
+    })
+    session.execute(import_progress.insert().values(**values))
+
+
+def clear_import_progress(session, filepath, db_table, geo_version):
+    session.execute(import_progress.delete().where(_import_filter(filepath, db_table, geo_version)))
+
+
+def get_table_fingerprint(session, db_table, geo_version):
+    """ Return the stored (row_count, fingerprint, geo_count) for a table, or None.
+    """
+    if not table_exists(session, table_fingerprints.name):
+        return None
+
+    row = session.execute(
+        table_fingerprints.select().where(and_(
+            table_fingerprints.c.db_table == db_table,
+            table_fingerprints.c.geo_version == geo_version))).first()
+
+    if row:
+        return row.row_count, row.fingerprint, row.geo_count
+
+
+def store_table_fingerprint(session, db_table, geo_version, fingerprint):
+    """ Store a (row_count, fingerprint, geo_count) tuple for a table.
+    """
+    row_count, fingerprint, geo_count = fingerprint
+    session.execute(table_fingerprints.delete().where(and_(
+        table_fingerprints.c.db_table == db_table,
+        table_fingerprints.c.geo_version == geo_version)))
+    session.execute(table_fingerprints.insert().values(
+        db_table=db_table,
+        geo_version=geo_version,
+        row_count=row_count,
+        fingerprint=fingerprint,
+        geo_count=geo_count))
+
+
+def get_dump_checksums(session):
+    """ Return a dict from dump filename to the checksum it was last loaded with.
+    """
+    if not table_exists(session, dump_checksums.name):
+        return {}
+
+    return {r.filename: r.checksum for r in session.execute(dump_checksums.select())}
+
+
+def store_dump_checksum(session, filename, checksum):
+    session.execute(dump_checksums.delete().where(dump_checksums.c.filename == filename))
+    session.execute(dump_checksums.insert().values(filename=filename, checksum=checksum))
@@ -0,0 +1,230 @@
+import hashlib
+import threading
+import time
+
+from sqlalchemy import SmallInteger, text
+from sqlalchemy.types import TypeDecorator
+
+from wazimap.data.utils import get_session
+from wazimap_za.bookkeeping import category_labels, encoded_columns
+
+"""
+Dictionary-encoded category columns for data tables.
+
+The field columns of a FieldTable, such as "source of water", hold the same
+few long labels on every row. An encoded column holds a smallint code
+instead. The labels for each field are in the wazimap_za_category table.
+Each field has a single dictionary that is shared by every table with that
+field. Codes are numbered in the database's label order, so ordering by a
+code orders by its label. Running servers keep the codes they loaded, so a
+dictionary is only renumbered while no tables are encoded with it: new
+labels that sort after the others are appended, and any other new labels
+need the tables using that field's dictionary to be decoded first.
+
+Encoded columns are read and written through `CategoryType`, which turns
+labels into codes in queries and codes back into labels in results. So
+the profiles, get_stat_data and the data API see labels as before. The
+lazy data tables use it for the columns listed in wazimap_za_category_column.
+
+Columns are encoded and decoded with the encodecategories command. Labels
+that aren't in a dictionary are queried as UNKNOWN_CODE, which matches no
+rows. A check constraint stops that code from being inserted, so encoded
+tables must be decoded before importing new data into them.
+"""
+
+UNKNOWN_CODE = -1
+MAX_CODES = 32768
+
+
+class CategoryDictionary(object):
+    """ The labels of a field's categories, where each label's code is its index in +labels+.
+    """
+    def __init__(self, field, labels):
+        self.field = field
+        self.labels = list(labels)
+        self.codes = {label: code for code, label in enumerate(self.labels)}
+
+    def encode(self, label):
+        return self.codes.get(label, UNKNOWN_CODE)
+
+    def decode(self, code):
+        return self.labels[code]
+
+
+class CategoryType(TypeDecorator):
+    """ A smallint column of codes from a CategoryDictionary, which is
+    read and written as labels.
+    """
+    impl = SmallInteger
+
+    def __init__(self, dictionary):
+        super(CategoryType, self).__init__()
+        self.dictionary = dictionary
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else self.dictionary.encode(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else self.dictionary.decode(value)
+
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def load_encoding(session):
+    """ Return (dictionaries, columns), where dictionaries is a dict from field to
+    CategoryDictionary, and columns is a dict from db_table to its set of encoded fields.
+    """
+    if not session.get_bind().has_table(encoded_columns.name):
+        return {}, {}
+
+    columns = {}
+    for row in session.execute(encoded_columns.select()):
+        columns.setdefault(row.db_table, set()).add(row.field)
+
+    labels = {}
+    for row in session.execute(category_labels.select().order_by(category_labels.c.field, category_labels.c.code)):
+        labels.setdefault(row.field, []).append(row.label)
+
+    return {f: CategoryDictionary(f, l) for f, l in labels.iteritems()}, columns
+
+
+def get_encoding():
+    """ The encoding from `load_encoding`, which is loaded once per process.
+    Restart the server after encoding or decoding columns.
+    """
+    global _encoding
+
+    with _encoding_lock:
+        if _encoding is None:
+            session = get_session()
+            try:
+                _encoding = load_encoding(session)
+            finally:
+                session.close()
+        return _encoding
+
+
+def category_type(db_table, field):
+    """ A CategoryType for a field of a data table if it's encoded, otherwise None.
+    """
+    dictionaries, columns = get_encoding()
+    if field in columns.get(db_table, ()):
+        return CategoryType(dictionaries[field])
+
+
+def get_dictionary(session, field):
+    rows = session.execute(category_labels.select()
+                           .where(category_labels.c.field == field)
+                           .order_by(category_labels.c.code))
+    return CategoryDictionary(field, [r.label for r in rows])
+
+
+def get_encoded_fields(session, db_table):
+    rows = session.execute(encoded_columns.select().where(encoded_columns.c.db_table == db_table))
+    return set(r.field for r in rows)
+
+
+def check_constraint_name(db_table, field):
+    # field names have spaces, and table and field names together are too long for postgres
+    return 'category_check_%s' % hashlib.sha1('%s.%s' % (db_table, field)).hexdigest()[:12]
+
+
+def get_encoded_tables(session, field):
+    rows = session.execute(encoded_columns.select().where(encoded_columns.c.field == field))
+    return set(r.db_table for r in rows)
+
+
+def get_column_labels(session, db_table, field):
+    """ The distinct labels in a field column of a data table.
+    """
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    return [r[0] for r in session.execute(
+        "SELECT DISTINCT %(field)s FROM %(table)s WHERE %(field)s IS NOT NULL" % {
+            'table': quote(db_table), 'field': quote(field)})]
+
+
+def sort_labels(session, labels):
+    """ Sort labels the way the database orders a label column.
+    """
+    return [r[0] for r in session.execute(text(
+        "SELECT label FROM unnest(CAST(:labels AS text[])) AS label ORDER BY label"), {
+            'labels': list(labels),
+        })]
+
+
+def extend_dictionary(session, field, labels):
+    """ Add +labels+ to a field's dictionary, and return the dictionary.
+
+    Raises ValueError if the new labels would renumber a dictionary that
+    tables are already encoded with.
+    """
+    old = get_dictionary(session, field)
+    added = set(labels) - set(old.labels)
+    if not added:
+        return old
+
+    new = CategoryDictionary(field, sort_labels(session, set(old.labels) | added))
+    if len(new.labels) > MAX_CODES:
+        raise ValueError("%s has %d categories, more than can be encoded" % (field, len(new.labels)))
+
+    if new.labels[:len(old.labels)] != old.labels:
+        tables = get_encoded_tables(session, field)
+        if tables:
+            raise ValueError("Adding %s to the dictionary for %s would renumber it, but %s are encoded with it. "
+                             "Decode them first." % (', '.join(sorted(added)), field, ', '.join(sorted(tables))))
+
+    session.execute(category_labels.delete().where(category_labels.c.field == field))
+    session.execute(category_labels.insert(), [
+        {'field': field, 'code': code, 'label': label} for code, label in enumerate(new.labels)])
+
+    return new
+
+
+def encode_column(session, db_table, field):
+    """ Convert a field column of a data table from labels to codes.
+    """
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    params = {'table': quote(db_table), 'field': quote(field), 'check': quote(check_constraint_name(db_table, field))}
+
+    labels = get_column_labels(session, db_table, field)
+    dictionary = extend_dictionary(session, field, labels)
+
+    # ALTER ... USING can't have subqueries, so map the column's labels with a CASE
+    codes = 'NULL'
+    if labels:
+        codes = 'CASE %s::text %s END' % (params['field'], ' '.join(
+            'WHEN :label_%d THEN %d' % (i, dictionary.encode(label)) for i, label in enumerate(labels)))
+    session.execute(text(
+        "ALTER TABLE %(table)s ALTER COLUMN %(field)s TYPE smallint USING " % params + codes), {
+            'label_%d' % i: label for i, label in enumerate(labels)
+        })
+    session.execute("ALTER TABLE %(table)s ADD CONSTRAINT %(check)s CHECK (%(field)s >= 0)" % params)
+    session.execute(encoded_columns.insert().values(db_table=db_table, field=field))
+
+
+def decode_column(session, db_table, field):
+    """ Convert an encoded field column of a data table back to labels.
+    """
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    params = {'table': quote(db_table), 'field': quote(field), 'check': quote(check_constraint_name(db_table, field))}
+
+    dictionary = get_dictionary(session, field)
+    session.execute("ALTER TABLE %(table)s DROP CONSTRAINT IF EXISTS %(check)s" % params)
+    session.execute(text(
+        "ALTER TABLE %(table)s ALTER COLUMN %(field)s TYPE character varying(128) "
+        "USING (CAST(:labels AS text[]))[%(field)s + 1]" % params), {
+            'labels': dictionary.labels,
+        })
+    session.execute(encoded_columns.delete().where(
+        (encoded_columns.c.db_table == db_table) & (encoded_columns.c.field == field)))
+
+
+def time_scan(session, db_table):
+    """ Time a full scan of a table, in seconds.
+    """
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    start = time.time()
+    session.execute("SELECT COUNT(*) FROM %s" % quote(db_table)).scalar()
+    return time.time() - start
@@ -0,0 +1,250 @@
+from collections import namedtuple
+
+from sqlalchemy import Float, Integer, Numeric, text
+
+"""
+Set-based completeness checks for data tables, used by checkdata.
+
+Rather than loading every row of a table and comparing key combinations
+in Python, each check is a single anti-join in the database, and the
+results are streamed back so that large tables don't have to fit in memory.
+"""
+
+
+# A parent geography whose value doesn't match the sum of its children's values
+Deviation = namedtuple('Deviation', [
+    'table', 'column', 'geo_level', 'geo_code', 'keys', 'total', 'children_total', 'children', 'deviation'])
+
+
+def is_additive(table, non_additive_tables=()):
+    """ Do a table's values add up across geo levels? Percentages don't, and
+    nor do the tables with ids in +non_additive_tables+, such as averages,
+    rates and scores.
+    """
+    return (getattr(table, 'stat_type', 'number') != 'percentage' and
+            table.id.lower() not in non_additive_tables)
+
+
+class TableCheck(object):
+    """ Builds the completeness queries for a data table.
+
+    +table+ is a wazimap FieldTable or SimpleTable, +fields+ are its key
+    fields (empty for a SimpleTable), and +geo_model+ is the Django
+    geography model listing the geographies that the table should cover.
+    """
+    def __init__(self, session, table, fields, geo_model, geo_version, required_version=None):
+        self.session = session
+        self.table = table
+        self.fields = list(fields)
+        self.geo_version = geo_version
+        self.required_version = required_version or geo_version
+
+        quote = session.get_bind().dialect.identifier_preparer.quote
+        self.quote = quote
+        self.table_name = quote(table.db_table)
+        self.geo_table = quote(geo_model._meta.db_table)
+        self.columns = [quote(f) for f in self.fields]
+
+    def execute(self, sql):
+        params = {
+            'geo_version': self.geo_version,
+            'required_version': self.required_version,
+        }
+        return self.session.execute(text(sql).execution_options(stream_results=True), params)
+
+    def execute_write(self, sql):
+        params = {
+            'geo_version': self.geo_version,
+            'required_version': self.required_version,
+        }
+        return self.session.execute(text(sql), params).rowcount
+
+    def is_empty(self):
+        """ Does the table have no rows for this geo version?
+        """
+        return self.execute(
+            "SELECT 1 FROM %s WHERE geo_version = :geo_version LIMIT 1" % self.table_name
+        ).first() is None
+
+    def fingerprint(self):
+        """ Return a (row_count, fingerprint, geo_count) tuple describing the
+        table's rows and the geographies it should cover.
+
+        The fingerprint covers the rows of every geo version, since the key
+        combinations that are checked come from all of them. It is a sum of
+        a hash of each row, so it doesn't depend on the order of the rows.
+        """
+        row_count, fingerprint = self.execute(
+            "SELECT COUNT(*), COALESCE(SUM(('x' || SUBSTR(MD5(t::text), 1, 16))::bit(64)::bigint), 0) "
+            "FROM %s t" % self.table_name).first()
+        geo_count = self.execute(
+            "SELECT COUNT(*) FROM %s WHERE version = :required_version" % self.geo_table).scalar()
+
+        return row_count, str(fingerprint), geo_count
+
+    def keys_sql(self):
+        # All key combinations used anywhere in the table
+        return "SELECT DISTINCT %s FROM %s" % (", ".join(self.columns), self.table_name)
+
+    def row_exists_sql(self, geos, keys=None):
+        conditions = [
+            "t.geo_level = %s.geo_level" % geos,
+            "t.geo_code = %s.geo_code" % geos,
+            "t.geo_version = :geo_version",
+        ]
+        if keys:
+            conditions.extend("t.%s = %s.%s" % (c, keys, c) for c in self.columns)
+
+        return "EXISTS (SELECT 1 FROM %s t WHERE %s)" % (self.table_name, " AND ".join(conditions))
+
+    def missing_keys_sql(self, total=None):
+        """ Select the key combinations missing for geographies that have
+        some rows in the table, optionally with a constant +total+ column.
+        """
+        return """
+            WITH keys AS (%(keys)s),
+                 geos AS (SELECT DISTINCT geo_level, geo_code FROM %(table)s WHERE geo_version = :geo_version)
+            SELECT geos.geo_level, geos.geo_code, :geo_version, %(key_columns)s%(total)s
+            FROM geos CROSS JOIN keys
+            WHERE NOT %(exists)s
+        """ % {
+            'keys': self.keys_sql(),
+            'table': self.table_name,
+            'key_columns': ", ".join("keys.%s" % c for c in self.columns),
+            'total': ", %s" % total if total else "",
+            'exists': self.row_exists_sql('geos', 'keys'),
+        }
+
+    def missing_geos_sql(self, total=None):
+        """ Select the required geographies that have no rows in the table,
+        with a row for every key combination for a FieldTable.
+        """
+        if self.fields:
+            return """
+                WITH keys AS (%(keys)s)
+                SELECT g.geo_level, g.geo_code, :geo_version, %(key_columns)s%(total)s
+                FROM %(geo_table)s g CROSS JOIN keys
+                WHERE g.version = :required_version AND NOT %(exists)s
+            """ % {
+                'keys': self.keys_sql(),
+                'key_columns': ", ".join("keys.%s" % c for c in self.columns),
+                'total': ", %s" % total if total else "",
+                'geo_table': self.geo_table,
+                'exists': self.row_exists_sql('g'),
+            }
+
+        return """
+            SELECT g.geo_level, g.geo_code, :geo_version
+            FROM %(geo_table)s g
+            WHERE g.version = :required_version AND NOT %(exists)s
+        """ % {
+            'geo_table': self.geo_table,
+            'exists': self.row_exists_sql('g'),
+        }
+
+    def missing_keys(self):
+        """ Yield a (geo_level, geo_code, keys) tuple for each key combination
+        that is missing for a geography that has some rows in the table.
+        """
+        if not self.fields:
+            return
+
+        sql = self.missing_keys_sql() + " ORDER BY 1, 2"
+        for row in self.execute(sql):
+            yield row[0], row[1], tuple(row[3:])
+
+    def missing_geos(self):
+        """ Yield a (geo_level, geo_code) tuple for each required geography
+        that has no rows in the table.
+        """
+        sql = """
+            SELECT g.geo_level, g.geo_code
+            FROM %(geo_table)s g
+            WHERE g.version = :required_version AND NOT %(exists)s
+            ORDER BY 1, 2
+        """ % {
+            'geo_table': self.geo_table,
+            'exists': self.row_exists_sql('g'),
+        }
+
+        for row in self.execute(sql):
+            yield row[0], row[1]
+
+    def insert_sql(self, select, total=True):
+        columns = ["geo_level", "geo_code", "geo_version"] + self.columns
+        if total:
+            columns.append("total")
+
+        return "INSERT INTO %s (%s) %s" % (self.table_name, ", ".join(columns), select)
+
+    def fill_missing_keys(self):
+        """ Insert a row with a total of 0 for each missing key combination,
+        and return the number of rows inserted.
+        """
+        if not self.fields:
+            return 0
+        return self.execute_write(self.insert_sql(self.missing_keys_sql(total='0')))
+
+    def fill_missing_geos(self):
+        """ Insert rows with a NULL total for each missing geography, and
+        return the number of rows inserted.
+        """
+        return self.execute_write(self.insert_sql(self.missing_geos_sql(total='NULL'), total=bool(self.fields)))
+
+    def value_columns(self):
+        """ The numeric columns of the table that should add up across geo levels.
+        """
+        if self.fields:
+            return ['total']
+
+        return [c.name for c in self.table.model.__table__.columns
+                if c.name not in ('geo_level', 'geo_code', 'geo_version')
+                and isinstance(c.type, (Integer, Float, Numeric))]
+
+    def sum_deviations(self, column, tolerance):
+        """ Yield a Deviation for each geography and key combination whose
+        value of +column+ differs from the sum of its children's values by more
+        than +tolerance+, relative to the parent's value. Children are the
+        geographies whose parent it is, so wards add up to municipalities,
+        and districts and metros add up to provinces.
+        """
+        name = column
+        column = self.quote(column)
+        keys = ", ".join("t.%s" % c for c in self.columns)
+        key_join = "".join(" AND c.%s = p.%s" % (c, c) for c in self.columns)
+
+        sql = """
+            WITH children AS (
+                SELECT g.parent_level, g.parent_code%(keys)s, SUM(t.%(column)s) AS total, COUNT(*) AS children
+                FROM %(table)s t
+                JOIN %(geo_table)s g
+                  ON g.geo_level = t.geo_level AND g.geo_code = t.geo_code AND g.version = :required_version
+                WHERE t.geo_version = :geo_version AND g.parent_level IS NOT NULL
+                GROUP BY g.parent_level, g.parent_code%(keys)s
+            )
+            SELECT * FROM (
+                SELECT p.geo_level, p.geo_code, p.%(column)s AS parent_total, c.total AS children_total, c.children,
+                       ABS(p.%(column)s - c.total)::float / GREATEST(ABS(p.%(column)s), 1) AS deviation%(parent_keys)s
+                FROM %(table)s p
+                JOIN children c ON c.parent_level = p.geo_level AND c.parent_code = p.geo_code%(key_join)s
+                WHERE p.geo_version = :geo_version
+            ) d
+            WHERE d.deviation > :tolerance
+            ORDER BY d.deviation DESC
+        """ % {
+            'keys': ", " + keys if keys else "",
+            'parent_keys': "".join(", p.%s" % c for c in self.columns),
+            'key_join': key_join,
+            'column': column,
+            'table': self.table_name,
+            'geo_table': self.geo_table,
+        }
+
+        params = {
+            'geo_version': self.geo_version,
+            'required_version': self.required_version,
+            'tolerance': tolerance,
+        }
+        for row in self.session.execute(text(sql).execution_options(stream_results=True), params):
+            yield Deviation(self.table.id, name, row[0], row[1], tuple(row[6:]),
+                            row[2], row[3], row[4], float(row[5]))
@@ -0,0 +1,283 @@
+import gzip
+import hashlib
+import os
+import re
+import subprocess
+import tempfile
+
+from django.conf import settings
+
+from wazimap_za.loading import IndexDef
+
+"""
+Reads and writes the pg_dump files in the sql/ directory, each of which
+holds a single table: its definition, its data as a COPY block, and its
+constraints and indexes.
+"""
+
+CREATE_TABLE_RE = re.compile(r'^CREATE TABLE (\S+) \(')
+COPY_RE = re.compile(r'^COPY (\S+) \((.*)\) FROM stdin;$')
+CONSTRAINT_RE = re.compile(r'^ALTER TABLE ONLY (\S+) ADD CONSTRAINT (\S+) (.*?);$', re.DOTALL)
+# settings from newer versions of pg_dump that older servers don't understand
+SKIP_LINE_RE = re.compile(r'idle_in_transaction_session_timeout|row_security')
+
+COMPRESSION_EXTENSIONS = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+class TableDump(object):
+    """ A pg_dump file for a single table.
+
+    The file is scanned once when the dump is created, recording the table
+    definition, the position of the COPY data and the constraints and indexes
+    that follow it. The data itself is streamed with `copy_data`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.table = None
+        self.create_columns = None
+        self.columns = []
+        self.indexes = []
+        self.data_start = None
+        self.data_end = None
+        self.objects = 0
+        self.parse()
+
+    def parse(self):
+        statement = []
+        in_create = False
+
+        with open(self.path, 'rb') as f:
+            pos = 0
+            for line in iter(f.readline, ''):
+                pos += len(line)
+                stripped = line.strip()
+
+                if self.data_start is not None and self.data_end is None:
+                    # inside the COPY block
+                    if stripped == '\\.':
+                        self.data_end = pos - len(line)
+                    continue
+
+                if in_create:
+                    if stripped == ');':
+                        in_create = False
+                    else:
+                        self.create_columns.append(stripped.rstrip(','))
+                    continue
+
+                if stripped.startswith('CREATE SEQUENCE'):
+                    self.objects += 1
+
+                match = CREATE_TABLE_RE.match(stripped)
+                if match:
+                    self.objects += 1
+                    if self.table is None:
+                        self.table = match.group(1)
+                        self.create_columns = []
+                        in_create = True
+                    continue
+
+                match = COPY_RE.match(stripped)
+                if match:
+                    if match.group(1) == self.table and self.data_start is None:
+                        self.columns = [c.strip() for c in match.group(2).split(',')]
+                        self.data_start = pos
+                    continue
+
+                if stripped.startswith('--') or not stripped:
+                    continue
+
+                statement.append(stripped)
+                if stripped.endswith(';'):
+                    self.add_statement(' '.join(statement))
+                    statement = []
+
+    def add_statement(self, sql):
+        if self.data_end is None:
+            # ignore statements before the data, such as SET and DROP
+            return
+
+        match = CONSTRAINT_RE.match(sql)
+        if match and match.group(1) == self.table:
+            self.indexes.append(IndexDef(match.group(2), match.group(3), constraint=True))
+        elif sql.startswith('CREATE INDEX') or sql.startswith('CREATE UNIQUE INDEX'):
+            self.indexes.append(IndexDef.from_index_sql(sql))
+
+    @property
+    def is_single_table(self):
+        """ Does this dump hold exactly one table with data, which can be
+        loaded with `copy_data`?
+        """
+        return self.objects == 1 and self.data_start is not None and self.data_end is not None
+
+    def create_sql(self):
+        """ A CREATE TABLE statement for this table, with a %s placeholder
+        for the table name.
+        """
+        return "CREATE TABLE %%s (%s)" % ', '.join(self.create_columns).replace('%', '%%')
+
+    def copy_data(self):
+        """ Return a file-like object over the COPY data in this dump.
+        """
+        f = open(self.path, 'rb')
+        f.seek(self.data_start)
+        return DataReader(f, self.data_end - self.data_start)
+
+    @property
+    def data_size(self):
+        return self.data_end - self.data_start
+
+
+class DataReader(object):
+    """ A read-only file-like object over the next +size+ bytes of a file.
+    """
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def pg_client_args():
+    """ Connection arguments for the postgres command line clients.
+    """
+    db = settings.DATABASES['default']
+
+    args = ["-d", db['NAME']]
+    if db.get('HOST'):
+        args += ["-h", db['HOST']]
+    if db.get('PORT'):
+        args += ["-p", str(db['PORT'])]
+    if db.get('USER'):
+        args += ["-U", db['USER']]
+
+    return args
+
+
+def pg_client_env():
+    """ Environment for the postgres command line clients.
+    """
+    env = os.environ.copy()
+    password = settings.DATABASES['default'].get('PASSWORD')
+    if password:
+        env['PGPASSWORD'] = password
+    return env
+
+
+def dump_table(table, out):
+    """ Stream a pg_dump of +table+ to the file-like +out+, a line at a time,
+    without holding the dump in memory. Raises an IOError with pg_dump's
+    error output if it fails.
+    """
+    args = ["pg_dump", "-O", "-c", "--if-exists", "-t", table] + pg_client_args()
+
+    # a file rather than a pipe, so that pg_dump can't block on a full stderr pipe
+    with tempfile.TemporaryFile() as errors:
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=errors, env=pg_client_env())
+
+        try:
+            for line in iter(p.stdout.readline, b''):
+                if not SKIP_LINE_RE.search(line):
+                    out.write(line)
+        except:
+            # report pg_dump's own failure rather than what it caused
+            if p.poll():
+                raise IOError(pg_dump_error(table, p.returncode, errors))
+            p.kill()
+            p.stdout.close()
+            p.wait()
+            raise
+
+        p.stdout.close()
+        if p.wait() != 0:
+            raise IOError(pg_dump_error(table, p.returncode, errors))
+
+
+def pg_dump_error(table, returncode, errors):
+    errors.seek(0)
+    return "pg_dump of %s failed with exit code %d: %s" % (table, returncode, errors.read().strip())
+
+
+def dump_table_name(path):
+    """ The name of the first table created by the dump at +path+, or None.
+    Only the start of the file is read.
+    """
+    with open(path) as f:
+        for line in f:
+            match = CREATE_TABLE_RE.match(line)
+            if match:
+                return match.group(1)
+
+
+def dump_names(paths):
+    """ Return a dict from table name to the name of the dump file in +paths+
+    that holds it, without the .sql extension, such as 00_demarcation for
+    wazimap_geography.
+    """
+    names = {}
+    for path in paths:
+        table = dump_table_name(path)
+        if table:
+            names[table] = os.path.splitext(os.path.basename(path))[0]
+    return names
+
+
+class ZstdWriter(object):
+    """ Writes a zstd-compressed file by piping through the zstd command.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.p = subprocess.Popen(["zstd", "-q", "-f", "-o", path], stdin=subprocess.PIPE)
+
+    def write(self, data):
+        self.p.stdin.write(data)
+
+    def close(self):
+        self.p.stdin.close()
+        if self.p.wait() != 0:
+            raise IOError("zstd failed to write %s" % self.path)
+
+
+def open_dump_output(path, compression=None):
+    """ Open +path+ for writing, compressed with gzip or zstd if +compression+ is given.
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'wb')
+    elif compression == 'zstd':
+        return ZstdWriter(path)
+    return open(path, 'wb')
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    """ The SHA1 checksum of a file, read in chunks.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -1,4 +1,6 @@
 import logging
+import re
+from collections import defaultdict
 
 from shapely.geometry import asShape
 from wazimap.geo import GeoData as BaseGeoData, LocationNotFound
@@ -8,6 +10,9 @@ import requests
 
 log = logging.getLogger(__name__)
 
+# Municipality names in StatsSA exports, eg. "WC011: Matzikama"
+MUNI_RE = re.compile('^[A-Z]{2,3}\d{0,3}\s*:\s.*$')
+
 SETTINGS = settings.WAZIMAP.setdefault('mapit', {})
 SETTINGS.setdefault('url', 'https://mapit.code4sa.org')
 SETTINGS.setdefault('generations', {
@@ -77,3 +82,115 @@ class GeoData(BaseGeoData):
                 log.warn("Couldn't find geo that Mapit gave us: %s" % feature, exc_info=e)
 
         return geos
+
+
+class GeoResolver(object):
+    """ Resolves the geography names used in StatsSA and other data files,
+    such as "WC011: Matzikama" or "Western Cape", to (geo_level, geo_code)
+    tuples for a single geo version.
+
+    The indexes are built once from the geography table, and resolved
+    names are memoized, so this is cheap to call for every row of a file.
+    Use `GeoResolver.for_version` to share a resolver between commands.
+    """
+    # shared resolvers by (geo model, version)
+    _resolvers = {}
+
+    def __init__(self, geos):
+        self.codes = defaultdict(list)
+        self.names = defaultdict(list)
+        self.metro_names = defaultdict(list)
+        self.geo_ids = set()
+        self.geo_names = {}
+        self._cache = {}
+
+        for geo in geos:
+            geo_id = (geo.geo_level, geo.geo_code)
+            self.geo_ids.add(geo_id)
+            self.geo_names[geo_id] = geo.name
+            self.codes[geo.geo_code.upper()].append(geo_id)
+            self.names[self.normalize(geo.name)].append(geo_id)
+
+            # names without codes in StatsSA exports are provinces, districts and metros
+            if geo.geo_level in ('province', 'district') or (
+                    geo.geo_level == 'municipality' and geo.parent_level == 'province'):
+                self.metro_names[self.normalize(geo.name)].append(geo_id)
+
+    @classmethod
+    def for_version(cls, version, geo_model=None):
+        if geo_model is None:
+            from wazimap.geo import geo_data
+            geo_model = geo_data.geo_model
+
+        key = (geo_model, version)
+        if key not in cls._resolvers:
+            cls._resolvers[key] = cls(geo_model.objects.filter(version=version))
+        return cls._resolvers[key]
+
+    @staticmethod
+    def normalize(name):
+        return ' '.join(name.lower().split())
+
+    def lookup_code(self, code, geo_level=None):
+        """ Return a list of (geo_level, geo_code) tuples with this code.
+        """
+        matches = self.codes.get(code.strip().upper(), [])
+        if geo_level:
+            matches = [m for m in matches if m[0] == geo_level]
+        return matches
+
+    def lookup_name(self, name, levels=None):
+        """ Return a list of (geo_level, geo_code) tuples with this name,
+        optionally only at the given +levels+.
+        """
+        matches = self.names.get(self.normalize(name), [])
+        if levels:
+            matches = [m for m in matches if m[0] in levels]
+        return matches
+
+    def describe(self, geo_id):
+        """ Describe a (geo_level, geo_code) tuple as "level-code (name)",
+        for reporting.
+        """
+        name = self.geo_names.get(geo_id)
+        return '%s-%s (%s)' % (geo_id[0], geo_id[1], name) if name else '%s-%s' % geo_id
+
+    def resolve(self, geo_name):
+        """ Return a (geo_level, geo_code) tuple for a geography name from a
+        StatsSA export. Raises ValueError if the name is unknown or ambiguous.
+        """
+        try:
+            return self._cache[geo_name]
+        except KeyError:
+            geo_id = self._cache[geo_name] = self._resolve(geo_name)
+            return geo_id
+
+    def _resolve(self, geo_name):
+        if geo_name == "":
+            return ('country', 'ZA')
+
+        if ':' in geo_name:
+            code = geo_name.split(':', 1)[0].strip()
+
+            # prefer the level of a known code, since district codes
+            # such as "DC10" also look like municipality codes
+            matches = self.lookup_code(code)
+            if len(matches) == 1:
+                return matches[0]
+        else:
+            code = geo_name
+
+        if MUNI_RE.match(geo_name):
+            return ('municipality', code)
+        elif 'Ward' in geo_name:
+            return ('ward', code)
+        elif geo_name.startswith('DC'):
+            return ('district', code.strip())
+
+        matches = self.metro_names.get(self.normalize(geo_name), [])
+        if len(matches) == 0:
+            raise ValueError("Cannot recognize the geo level of %s" % geo_name)
+        elif len(matches) > 1:
+            raise ValueError("Cannot recognize single geo level of %s: %s" % (geo_name, matches))
+
+        return matches[0]
@@ -0,0 +1,95 @@
+from sqlalchemy import text
+
+"""
+Finds and creates the indexes that profile queries need on the data tables.
+
+Every profile query looks up a data table's rows for a geography by
+(geo_version, geo_level, geo_code). Tables created by FieldTable have a
+primary key that starts with those columns, but tables loaded from older
+dumps may not have any index that does.
+"""
+
+GEO_COLUMNS = ['geo_version', 'geo_level', 'geo_code']
+GEO_INDEX_SUFFIX = '_geo_lookup'
+
+
+def geo_index_name(table_name):
+    # keep within postgres' 63 character limit for names
+    return table_name[:63 - len(GEO_INDEX_SUFFIX)] + GEO_INDEX_SUFFIX
+
+
+def get_index_columns(session, table_name):
+    """ Return a list of (index name, columns, valid) tuples for the indexes on a table,
+    with the indexed columns in order.
+    """
+    return [(name, list(columns), valid) for name, columns, valid in session.execute(text(
+        "SELECT i.relname, "
+        "  array(SELECT a.attname FROM unnest(x.indkey) WITH ORDINALITY AS k(attnum, n) "
+        "        JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = k.attnum ORDER BY k.n), "
+        "  x.indisvalid "
+        "FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid "
+        "WHERE x.indrelid = to_regclass(:table) ORDER BY i.relname"), {'table': table_name})]
+
+
+def find_geo_index(indexes, columns=()):
+    """ Return the name of a valid index that starts with the geo columns, in
+    any order, and also has +columns+, or None.
+    """
+    for name, index_columns, valid in indexes:
+        if valid and set(index_columns[:len(GEO_COLUMNS)]) == set(GEO_COLUMNS) and \
+                set(columns) <= set(index_columns):
+            return name
+
+
+def geo_index_columns(fields):
+    """ The columns for a geo lookup index. For a FieldTable, the fields and
+    total are included, so that profile queries can be answered from the index alone.
+    """
+    return GEO_COLUMNS + (list(fields) + ['total'] if fields else [])
+
+
+def explain(session, sql, params=None, analyze=False):
+    """ Return the query plan for +sql+ as a list of lines.
+    """
+    options = "(ANALYZE, BUFFERS) " if analyze else ""
+    return [row[0] for row in session.execute(text("EXPLAIN " + options + sql), params or {})]
+
+
+def explain_geo_lookup(session, table_name):
+    """ The query plan for looking up the rows of a geography in a table,
+    using the first geography in the table, or None if it's empty.
+    """
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    geo = session.execute("SELECT geo_version, geo_level, geo_code FROM %s LIMIT 1" % quote(table_name)).first()
+    if geo is None:
+        return None
+
+    return explain(
+        session,
+        "SELECT * FROM %s WHERE geo_version = :geo_version AND geo_level = :geo_level AND geo_code = :geo_code"
+        % quote(table_name),
+        dict(zip(GEO_COLUMNS, geo)))
+
+
+def create_geo_index(engine, table_name, columns, maintenance_work_mem=None):
+    """ Create a geo lookup index on a table concurrently, so that the table
+    can still be written to, first dropping an invalid index left behind by
+    a failed attempt. Returns the index name.
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    name = geo_index_name(table_name)
+
+    # CREATE INDEX CONCURRENTLY can't run in a transaction
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        if maintenance_work_mem:
+            conn.execute("SET maintenance_work_mem = '%s'" % maintenance_work_mem)
+        conn.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % quote(name))
+        conn.execute("CREATE INDEX CONCURRENTLY %s ON %s (%s)" % (
+            quote(name), quote(table_name), ", ".join(quote(c) for c in columns)))
+
+    return name
+
+
+def relation_size(session, name):
+    return session.execute(text("SELECT pg_relation_size(to_regclass(:name))"), {'name': name}).scalar()
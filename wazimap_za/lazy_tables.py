@@ -0,0 +1,175 @@
+import threading
+import time
+
+import sqlalchemy.types
+from sqlalchemy import Column
+
+from wazimap.data.tables import (DATA_TABLES, FIELD_TABLES, FIELD_TABLE_FIELDS, FieldTable, SimpleTable,
+                                 get_model_for_db_table, get_table_id)
+
+from wazimap_za.categories import category_type
+
+"""
+Data tables that are declared when tables.py is imported, but only build
+their SQLAlchemy models and columns when they're first used.
+
+Building a FieldTable creates its database table if necessary and queries
+the distinct values of its fields, and building a SimpleTable reflects its
+columns from the database. Doing that for every table in every process
+that imports tables.py is slow, and most processes only use a few tables.
+
+The lazy tables are registered in DATA_TABLES and FIELD_TABLES with their
+metadata (id, fields, universe, dataset, etc.), so that `get_datatable`,
+`FieldTable.for_fields` and `get_model_from_fields` find them as before.
+Their `model`, `columns` and `total_column` are built on first access.
+FieldTables that share a database table are all registered on its model
+in the order they were declared when it's built, so that the model's
+first data table is the first one declared, whichever is built first.
+Field columns that are dictionary-encoded (see categories.py) are read
+through a CategoryType.
+"""
+
+# tables may be first used by several threads at once
+build_lock = threading.RLock()
+
+
+class LazyTableMixin(object):
+    # attributes that are only set once the table is built
+    lazy_attributes = ('model', 'columns', 'total_column')
+
+    # time spent declaring all lazy tables
+    declare_seconds = 0.0
+    # number of lazy tables declared
+    declared = 0
+
+    def __init__(self, *args, **kwargs):
+        start = time.time()
+        self.declaration = (args, kwargs)
+        self.declaration_order = LazyTableMixin.declared
+        LazyTableMixin.declared += 1
+        self.built = False
+        self.building = False
+        self.build_seconds = None
+        self.declare(*args, **kwargs)
+        LazyTableMixin.declare_seconds += time.time() - start
+
+    def __getattr__(self, name):
+        # only called for attributes that haven't been set
+        if name not in self.lazy_attributes:
+            raise AttributeError(name)
+
+        with build_lock:
+            if self.__dict__.get('building'):
+                # used before it's set while building, which would fail without laziness too
+                raise AttributeError(name)
+            if not self.__dict__.get('built'):
+                self.build()
+
+        return object.__getattribute__(self, name)
+
+    def build(self):
+        """ Build the table's model and columns, if they haven't been built yet.
+        """
+        with build_lock:
+            if self.built:
+                return
+
+            start = time.time()
+            self.building = True
+            try:
+                args, kwargs = self.declaration
+                self.build_table(*args, **kwargs)
+                self.built = True
+            finally:
+                self.building = False
+            self.build_seconds = time.time() - start
+
+
+class LazySimpleTable(LazyTableMixin, SimpleTable):
+    """ A SimpleTable whose model is only reflected from the database when it's first used.
+    """
+    lazy_attributes = ('model', 'columns')
+
+    def declare(self, id, universe, description, model='auto', total_column='total',
+                year='2011', dataset='Census 2011', stat_type='number', db_table=None):
+        self.id = id.upper()
+        self.db_table = db_table or self.id.lower()
+        self.universe = universe
+        self.description = description
+        self.year = year
+        self.dataset_name = dataset
+        self.total_column = total_column
+        self.stat_type = stat_type
+
+        DATA_TABLES[self.id] = self
+
+    def build_table(self, *args, **kwargs):
+        SimpleTable.__init__(self, *args, **kwargs)
+
+
+class LazyFieldTable(LazyTableMixin, FieldTable):
+    """ A FieldTable whose model and columns are only built when it's first used.
+    """
+    def declare(self, fields, id=None, universe='Population', description=None, denominator_key=None,
+                has_total=True, value_type='Integer', stat_type='number', db_table=None,
+                year='2011', dataset='Census 2011', **kwargs):
+        self.id = (id or get_table_id(fields)).upper()
+        self.db_table = db_table or self.id.lower()
+        self.shares_db_table = db_table is not None
+        self.fields = fields
+        self.field_set = set(fields)
+        self.universe = universe
+        self.description = description or (universe + ' by ' + ', '.join(fields))
+        self.denominator_key = denominator_key
+        self.has_total = has_total
+        self.value_type = getattr(sqlalchemy.types, value_type)
+        self.year = year
+        self.dataset_name = dataset
+        self.stat_type = stat_type
+
+        DATA_TABLES[self.id] = self
+        FIELD_TABLE_FIELDS.update(self.fields)
+        FIELD_TABLES[self.id] = self
+
+    def build_table(self, *args, **kwargs):
+        if self.shares_db_table and not get_model_for_db_table(self.db_table):
+            # FieldTable expects the model of the table it shares to exist already
+            for table in FIELD_TABLES.values():
+                if table.db_table == self.db_table and not getattr(table, 'shares_db_table', False):
+                    table.build()
+                    break
+
+        FieldTable.__init__(self, *args, **kwargs)
+
+    def build_models(self):
+        super(LazyFieldTable, self).build_models()
+
+        # wazimap uses the model's first data table for things like the table's
+        # metadata, so register the tables declared for it in declaration order
+        tables = set(self.model.data_tables)
+        tables.update(t for t in FIELD_TABLES.values()
+                      if isinstance(t, LazyFieldTable) and t.db_table == self.db_table)
+        self.model.data_tables = sorted(tables, key=lambda t: getattr(t, 'declaration_order', float('inf')))
+
+    def _build_model_columns(self, fields, value_type):
+        columns = super(LazyFieldTable, self)._build_model_columns(fields, value_type)
+
+        for i, column in enumerate(columns):
+            if column.name in fields:
+                encoded_type = category_type(self.db_table, column.name)
+                if encoded_type is not None:
+                    columns[i] = Column(column.name, encoded_type, primary_key=True)
+
+        return columns
+
+
+def build_all():
+    """ Build every lazy table that hasn't been built yet, and return
+    a list of (table, seconds) tuples for those that were built.
+    """
+    timings = []
+    for table_id, table in sorted(DATA_TABLES.iteritems()):
+        if isinstance(table, LazyTableMixin) and not table.built:
+            table.build()
+            timings.append((table, table.build_seconds))
+    return timings
@@ -0,0 +1,410 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import Column, MetaData, Table, and_, text, tuple_
+from sqlalchemy.pool import QueuePool
+
+from wazimap.data.utils import _engine, get_session
+
+"""
+Helpers for writing rows into data tables in bulk, and for swapping
+freshly loaded tables into place, used by the import and data
+management commands.
+"""
+
+
+def upsert_rows(session, table, rows):
+    """ Insert a list of row dicts into a SQLAlchemy +table+, updating the
+    non-key columns of rows whose primary key already exists.
+
+    Requires PostgreSQL 9.5 or later for ON CONFLICT.
+    """
+    if not rows:
+        return
+
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    columns = [c.name for c in table.columns]
+    keys = [c.name for c in table.primary_key.columns]
+    values = [c for c in columns if c not in keys]
+
+    if values:
+        action = "UPDATE SET " + ", ".join("%s = EXCLUDED.%s" % (quote(c), quote(c)) for c in values)
+    else:
+        action = "NOTHING"
+
+    # field names contain spaces, so use positional parameter names
+    sql = "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO %s" % (
+        quote(table.name),
+        ", ".join(quote(c) for c in columns),
+        ", ".join(":c%d" % i for i in xrange(len(columns))),
+        ", ".join(quote(c) for c in keys),
+        action)
+
+    params = [{'c%d' % i: row.get(c) for i, c in enumerate(columns)} for row in rows]
+    session.execute(text(sql), params)
+
+
+def replace_geo_rows(session, table, fields, geo_level, geo_code, geo_version, rows):
+    """ Make the rows for a single geography in a FieldTable's +table+ match
+    +rows+: upsert the given rows and delete rows for field combinations
+    that are no longer present.
+    """
+    upsert_rows(session, table, rows)
+
+    geo_filter = and_(
+        table.c.geo_level == geo_level,
+        table.c.geo_code == geo_code,
+        table.c.geo_version == geo_version)
+
+    keys = [tuple(row[f] for f in fields) for row in rows]
+    if keys:
+        stale = tuple_(*[table.c[f] for f in fields]).notin_(keys)
+        session.execute(table.delete().where(and_(geo_filter, stale)))
+    else:
+        session.execute(table.delete().where(geo_filter))
+
+
+def replace_rows(session, table, rows):
+    """ Insert a list of row dicts into a SQLAlchemy +table+, replacing the
+    rows with the same primary keys. Unlike `upsert_rows`, this works on
+    PostgreSQL 9.4. The rows mustn't repeat a primary key.
+    """
+    if not rows:
+        return
+
+    keys = table.primary_key.columns
+    session.execute(table.delete().where(
+        tuple_(*keys).in_([tuple(row[c.name] for c in keys) for row in rows])))
+    session.execute(table.insert(), rows)
+
+
+INDEX_RE = re.compile(r'^CREATE (UNIQUE )?INDEX (\S+) ON (\S+) (USING .*?);?$', re.DOTALL)
+KEY_CONSTRAINT_RE = re.compile(r'^(PRIMARY KEY|UNIQUE) (\(.*\))$', re.DOTALL)
+
+# Memory for building indexes, per connection
+MAINTENANCE_WORK_MEM = '256MB'
+
+# Staging tables and indexes are named after their live counterparts
+STAGING_SUFFIX = '_staging'
+# and the live table is renamed to this while it's swapped out
+RETIRED_SUFFIX = '_retired'
+
+
+def staging_name(name, suffix=STAGING_SUFFIX):
+    # keep within postgres' 63 character limit for names
+    return name[:63 - len(suffix)] + suffix
+
+
+class IndexDef(object):
+    """ A constraint or index on a table, which can be re-created on another table.
+
+    For constraints, +definition+ is what follows ADD CONSTRAINT name, eg.
+    "PRIMARY KEY (geo_level, geo_code)". For indexes, it's what follows
+    ON table, eg. "USING btree (geo_code)".
+    """
+    def __init__(self, name, definition, constraint=False, unique=False):
+        self.name = name
+        self.definition = definition
+        self.constraint = constraint
+        self.unique = unique
+
+    @property
+    def enforces_uniqueness(self):
+        if self.constraint:
+            return bool(KEY_CONSTRAINT_RE.match(self.definition))
+        return self.unique
+
+    @classmethod
+    def from_index_sql(cls, sql):
+        """ Build an index definition from a CREATE INDEX statement.
+        """
+        match = INDEX_RE.match(' '.join(sql.split()))
+        if not match:
+            raise ValueError("Couldn't parse index definition: %s" % sql)
+        unique, name, _, definition = match.groups()
+        return cls(name, definition, unique=bool(unique))
+
+    def create_sql(self, table_name, name=None):
+        if self.constraint:
+            return "ALTER TABLE %s ADD CONSTRAINT %s %s" % (table_name, name or self.name, self.definition)
+        return "CREATE %sINDEX %s ON %s %s" % ('UNIQUE ' if self.unique else '', name or self.name, table_name, self.definition)
+
+    def build_sql(self, table_name, name=None):
+        """ Statements to build this index, each of which should run in its own
+        transaction. Primary key and unique constraints are built as a plain
+        index first, so that they only briefly lock the table when attached.
+        """
+        name = name or self.name
+        match = self.constraint and KEY_CONSTRAINT_RE.match(self.definition)
+        if match:
+            kind, columns = match.groups()
+            return [
+                "CREATE UNIQUE INDEX %s ON %s %s" % (name, table_name, columns),
+                "ALTER TABLE %s ADD CONSTRAINT %s %s USING INDEX %s" % (table_name, name, kind, name),
+            ]
+        return [self.create_sql(table_name, name)]
+
+    def drop_sql(self, table_name):
+        if self.constraint:
+            return "ALTER TABLE %s DROP CONSTRAINT %s" % (table_name, self.name)
+        return "DROP INDEX %s" % self.name
+
+    def rename_sql(self, table_name, old_name):
+        if self.constraint:
+            return "ALTER TABLE %s RENAME CONSTRAINT %s TO %s" % (table_name, old_name, self.name)
+        return "ALTER INDEX %s RENAME TO %s" % (old_name, self.name)
+
+    def __repr__(self):
+        return 'IndexDef(%s)' % self.create_sql('<table>')
+
+
+def get_table_indexes(session, table_name):
+    """ Return a list of IndexDef objects for the constraints and indexes
+    that currently exist on a database table.
+    """
+    indexes = []
+
+    rows = session.execute(text(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(:table) ORDER BY conname"), {'table': table_name})
+    indexes.extend(IndexDef(name, definition, constraint=True) for name, definition in rows)
+
+    # indexes that don't back a constraint
+    rows = session.execute(text(
+        "SELECT pg_get_indexdef(x.indexrelid) FROM pg_index x "
+        "WHERE x.indrelid = to_regclass(:table) "
+        "AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid) "
+        "ORDER BY x.indexrelid"), {'table': table_name})
+    indexes.extend(IndexDef.from_index_sql(sql) for sql, in rows)
+
+    return indexes
+
+
+def drop_indexes(session, table_name):
+    """ Drop the indexes on a table that don't enforce uniqueness, so that it can
+    be bulk loaded, and return their definitions so that they can be rebuilt with
+    `build_indexes`.
+
+    The primary key and unique constraints are kept, so that duplicate rows are
+    still rejected while loading, and a rebuild can't fail on them. The drop is
+    committed straight away, so that the table isn't locked for the whole load.
+    """
+    indexes = [i for i in get_table_indexes(session, table_name) if not i.enforces_uniqueness]
+    for index in indexes:
+        session.execute(index.drop_sql(table_name))
+    session.commit()
+    return indexes
+
+
+def build_indexes(table_name, indexes, jobs=1, maintenance_work_mem=MAINTENANCE_WORK_MEM, rename=None):
+    """ Build +indexes+ on a table, +jobs+ at a time, each on its own connection.
+    The table must be visible to other connections, so commit it first.
+
+    :param function rename: called with an index name to get the name to build it as
+    :return: a list of (index name, seconds) tuples
+    """
+    def build(index):
+        name = rename(index.name) if rename else index.name
+        session = get_session()
+        try:
+            start = time.time()
+            if maintenance_work_mem:
+                session.execute("SET maintenance_work_mem = '%s'" % maintenance_work_mem)
+            for sql in index.build_sql(table_name, name):
+                session.execute(sql)
+                session.commit()
+            return index.name, time.time() - start
+        finally:
+            session.close()
+
+    if jobs <= 1 or len(indexes) <= 1:
+        return [build(index) for index in indexes]
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(build, indexes))
+
+
+def connection_limit(engine=None):
+    """ The most connections the SQLAlchemy engine's pool will open at once,
+    or None if there's no limit.
+    """
+    pool = (engine or _engine).pool
+    if not isinstance(pool, QueuePool) or pool._max_overflow < 0:
+        return None
+    return pool.size() + pool._max_overflow
+
+
+def bounded_jobs(jobs, connections_per_job=1, reserved=1):
+    """ Limit a number of +jobs+, each using +connections_per_job+ connections,
+    so that they and +reserved+ other connections fit in the connection pool.
+    Jobs beyond that would wait forever for a connection.
+    """
+    jobs = max(jobs, 1)
+    limit = connection_limit()
+    if limit is not None:
+        jobs = min(jobs, max((limit - reserved) // connections_per_job, 1))
+    return jobs
+
+
+def table_exists(session, table_name):
+    return session.execute(text("SELECT to_regclass(:table)"), {'table': table_name}).scalar() is not None
+
+
+def table_grants(session, table_name):
+    """ Return a list of (grantee, privilege) tuples for the privileges granted on
+    a table, with grantees quoted for use in a GRANT statement.
+    """
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    rows = session.execute(text(
+        "SELECT grantee, privilege_type FROM information_schema.table_privileges "
+        "WHERE table_schema = current_schema() AND table_name = :table "
+        "ORDER BY grantee, privilege_type"), {'table': table_name})
+
+    return [(grantee if grantee == 'PUBLIC' else quote(grantee), privilege) for grantee, privilege in rows]
+
+
+def table_sizes(session, db_table):
+    """ Return the (table, indexes) sizes of a table, in bytes.
+    """
+    return tuple(session.execute(text(
+        "SELECT pg_table_size(to_regclass(:table)), pg_indexes_size(to_regclass(:table))"),
+        {'table': db_table}).first())
+
+
+def format_size(size):
+    for unit in ('bytes', 'kB', 'MB'):
+        if size < 1024:
+            return '%.0f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f GB' % size
+
+
+class StagingTable(object):
+    """ A table that new data is loaded and indexed into, before it is swapped
+    with the live table in a single short transaction. Readers never see a
+    partially loaded or unindexed table.
+
+    Usage::
+
+        staging = StagingTable(session, 'gender')
+        staging.create()
+        staging.insert(rows)
+        staging.copy_live_rows()
+        staging.build_indexes()
+        staging.validate()
+        staging.swap()
+
+    By default the staging table has the same columns and indexes as the live
+    table. Pass +create_sql+ (with a %s placeholder for the table name) and
+    +indexes+ to use a different definition, such as one from a dump file.
+    """
+    def __init__(self, session, table_name, create_sql=None, indexes=None):
+        self.session = session
+        self.live_name = table_name
+        self.name = staging_name(table_name)
+        self.create_sql = create_sql
+        self.indexes = indexes
+
+    def create(self):
+        """ Create an empty staging table.
+        """
+        if self.indexes is None:
+            live_exists = table_exists(self.session, self.live_name)
+            self.indexes = get_table_indexes(self.session, self.live_name) if live_exists else []
+
+        self.session.execute("DROP TABLE IF EXISTS %s" % self.name)
+        if self.create_sql:
+            self.session.execute(self.create_sql % self.name)
+        else:
+            self.session.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (self.name, self.live_name))
+
+    def copy_live_rows(self):
+        """ Copy the live table's rows for the geographies that have no rows
+        in the staging table, so that the staged rows replace the data for
+        their geographies and the rest of the live data is kept.
+        """
+        if not table_exists(self.session, self.live_name):
+            return
+
+        self.session.execute(
+            "INSERT INTO %(staging)s SELECT * FROM %(live)s l WHERE NOT EXISTS ("
+            "SELECT 1 FROM %(staging)s s WHERE s.geo_level = l.geo_level AND s.geo_code = l.geo_code "
+            "AND s.geo_version = l.geo_version)" % {'staging': self.name, 'live': self.live_name})
+
+    def insert(self, rows, table=None):
+        """ Insert a list of row dicts. The columns are taken from the
+        SQLAlchemy +table+, which defaults to the reflected staging table.
+        """
+        if not rows:
+            return
+
+        if table is None:
+            staging = Table(self.name, MetaData(), autoload=True, autoload_with=self.session.connection())
+        else:
+            staging = Table(self.name, MetaData(), *[Column(c.name, c.type) for c in table.columns])
+        self.session.execute(staging.insert(), rows)
+
+    def copy_from(self, fileobj, columns, binary=False):
+        """ Bulk load tab-separated COPY data from a file-like object, or
+        binary COPY data if +binary+ is set.
+        """
+        cursor = self.session.connection().connection.cursor()
+        cursor.copy_expert("COPY %s (%s) FROM STDIN%s" % (
+            self.name, ', '.join(columns), " (FORMAT binary)" if binary else ""), fileobj)
+
+    def build_indexes(self, jobs=1, maintenance_work_mem=MAINTENANCE_WORK_MEM):
+        """ Commit the staged data and build the indexes, +jobs+ at a time.
+        Returns a list of (index name, seconds) tuples.
+        """
+        self.session.commit()
+        return build_indexes(self.name, self.indexes, jobs=jobs,
+                             maintenance_work_mem=maintenance_work_mem, rename=staging_name)
+
+    def validate(self):
+        """ Check that the staging table has rows, and return the number of rows.
+        """
+        count = self.session.execute("SELECT COUNT(*) FROM %s" % self.name).scalar()
+        if not count:
+            raise ValueError("Staging table %s for %s is empty" % (self.name, self.live_name))
+        return count
+
+    def swap(self, lock_timeout='10s', before_commit=None):
+        """ Commit the staged data and replace the live table with the staging
+        table, in a single transaction.
+
+        The live table is renamed out of the way and only dropped once the
+        staging table has taken its name, and the privileges granted on it are
+        granted on the new table. Views that use the live table would stop it
+        being dropped, so the swap fails and is rolled back if there are any.
+
+        :param function before_commit: called in the swap's transaction, such as to update bookkeeping
+        """
+        self.session.commit()
+        self.session.execute("SET LOCAL lock_timeout = '%s'" % lock_timeout)
+
+        retired = None
+        grants = []
+        if table_exists(self.session, self.live_name):
+            retired = staging_name(self.live_name, RETIRED_SUFFIX)
+            grants = table_grants(self.session, self.live_name)
+            self.session.execute("ALTER TABLE %s RENAME TO %s" % (self.live_name, retired))
+
+        self.session.execute("ALTER TABLE %s RENAME TO %s" % (self.name, self.live_name))
+        for grantee, privilege in grants:
+            self.session.execute("GRANT %s ON %s TO %s" % (privilege, self.live_name, grantee))
+
+        if retired:
+            # frees the names of the live table's indexes
+            self.session.execute("DROP TABLE %s" % retired)
+        for index in self.indexes:
+            self.session.execute(index.rename_sql(self.live_name, staging_name(index.name)))
+
+        if before_commit:
+            before_commit()
+        self.session.commit()
+
+    def drop(self):
+        self.session.rollback()
+        self.session.execute("DROP TABLE IF EXISTS %s" % self.name)
+        self.session.commit()
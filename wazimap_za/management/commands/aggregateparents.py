@@ -0,0 +1,76 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wazimap.geo import geo_data
+from wazimap_za.aggregation import aggregate_to_parents
+
+"""
+Calculates the values of the parent geographies from ward-level data in
+FieldTable format (geo_level, geo_code, [fields], total), and writes the
+ward rows and the parents' rows as CSV to stdout, ready for importsimplecsv.
+This replaces bin/ward_to_parent_codes.py, taking the hierarchy from the
+geography table instead of bin/geo/ward_geos.json.
+
+Every column other than geo_level, geo_code and the value columns is a field
+to group by. Wards that aren't in the geography table are an error.
+
+Example:
+
+    python manage.py aggregateparents data/formatted/5.2f.csv > data/complete/5.2f.csv
+"""
+
+
+class Command(BaseCommand):
+    help = ("Adds up ward-level data in FieldTable format into every parent geography, " +
+            "and writes the wards and the parents as CSV.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'filename',
+            help='CSV file in FieldTable format'
+        )
+        parser.add_argument(
+            '--geo-version',
+            action='store',
+            dest='geo_version',
+            default='2011',
+            help='The geo_version of the geography hierarchy to use.'
+        )
+        parser.add_argument(
+            '--level',
+            action='store',
+            dest='level',
+            default='ward',
+            help='The geo_level of the rows in the file. Default: ward'
+        )
+        parser.add_argument(
+            '--value-columns',
+            action='store',
+            dest='value_columns',
+            default='total',
+            help='Comma-separated columns with the values to add up. Default: total'
+        )
+
+    def handle(self, *args, **options):
+        value_keys = options['value_columns'].split(',')
+
+        with open(options['filename']) as f:
+            reader = csv.DictReader(f)
+            field_keys = [k for k in reader.fieldnames if k not in ['geo_level', 'geo_code'] + value_keys]
+            fieldnames = reader.fieldnames
+            rows = list(reader)
+
+        geos = geo_data.geo_model.objects\
+            .filter(version=options['geo_version'])\
+            .values_list('geo_level', 'geo_code', 'parent_level', 'parent_code')
+
+        try:
+            parents = aggregate_to_parents(rows, geos, field_keys, value_keys, level=options['level'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        writer = csv.DictWriter(self.stdout, fieldnames=fieldnames, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+        writer.writerows(parents)
@@ -0,0 +1,99 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wazimap_za.apportion import Apportionment
+
+"""
+Reattributes the numbers in CSV files from one set of places to another,
+using a CSV file of factors, and writes the result as CSV to stdout.
+This generalises bin/recompose.py to any source and target geography,
+such as police stations to wards, or 2011 wards to 2016 wards.
+
+Example:
+
+    python manage.py apportion data/contact-crimes.csv --factors data/ward-factors.csv \\
+        --source-key PoliceStation --target-key WARD_ID --factor-key scal_fac_per_int --groupby year
+"""
+
+
+class Command(BaseCommand):
+    help = ("Reattributes the numbers in CSV files proportionally from one set of places to another, " +
+            "using a CSV file of factors.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'files',
+            nargs='+',
+            help='CSV files with one row per source place. The numbers in all the files are added together.'
+        )
+        parser.add_argument(
+            '--factors',
+            action='store',
+            dest='factors',
+            required=True,
+            help='CSV file with a row for each source and target, and the factor for that pair'
+        )
+        parser.add_argument(
+            '--source-key',
+            action='store',
+            dest='source_key',
+            required=True,
+            help='Column with the source place, in both the files and the factors'
+        )
+        parser.add_argument(
+            '--target-key',
+            action='store',
+            dest='target_key',
+            required=True,
+            help='Column with the target place in the factors'
+        )
+        parser.add_argument(
+            '--factor-key',
+            action='store',
+            dest='factor_key',
+            required=True,
+            help='Column with the factor in the factors'
+        )
+        parser.add_argument(
+            '--groupby',
+            action='store',
+            dest='groupby',
+            default=None,
+            help='Comma-separated columns to group by, such as year'
+        )
+        parser.add_argument(
+            '--cache-dir',
+            action='store',
+            dest='cache_dir',
+            default=None,
+            help='Cache the factor matrix in this directory'
+        )
+
+    def handle(self, *args, **options):
+        source_key = options['source_key']
+        target_key = options['target_key']
+        groupby = options['groupby'].split(',') if options.get('groupby') else []
+
+        apportionment = Apportionment.from_csv(
+            options['factors'], source_key, target_key, options['factor_key'], cache_dir=options.get('cache_dir'))
+
+        rows = []
+        value_keys = None
+        for path in options['files']:
+            with open(path) as f:
+                reader = csv.DictReader(f)
+                keys = [k for k in reader.fieldnames if k != source_key and k not in groupby]
+                if value_keys is not None and keys != value_keys:
+                    raise CommandError("%s has different columns to the other files: %s" % (path, keys))
+                value_keys = keys
+                rows.extend(reader)
+
+        try:
+            results = apportionment.apply_rows(rows, source_key, value_keys, groupby, target_key=target_key)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        writer = csv.DictWriter(self.stdout, fieldnames=[target_key] + groupby + value_keys, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(results)
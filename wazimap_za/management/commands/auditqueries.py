@@ -0,0 +1,181 @@
+import json
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from wazimap.data.utils import _engine
+from wazimap.data.tables import DATA_TABLES
+from wazimap.geo import geo_data
+
+from wazimap_za.query_audit import QueryCapture, explain_analyze, summarise_plan
+
+"""
+Audits the query plans of the SQL run to build profiles.
+
+A profile is built for a sample geography at each level (or the geographies
+passed with --geo), recording every distinct SELECT statement. Each one is
+then run with EXPLAIN (ANALYZE, BUFFERS), and the report ranks the slowest
+statements, and lists the sequential scans and the worst row estimates, with
+the profile section and data tables each statement came from.
+
+Example:
+
+    python manage.py auditqueries --geo ward-10404010 --geo country-ZA -v 2
+"""
+
+
+class Command(BaseCommand):
+    help = ("Builds profiles for sample geographies, and reports the slowest queries, " +
+            "sequential scans and bad row estimates from their query plans.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--geo',
+            action='append',
+            dest='geos',
+            default=[],
+            help='A geography to build the profile for, as LEVEL-CODE. Can be given more than once. '
+                 'Default: the first geography at each level'
+        )
+        parser.add_argument(
+            '--geo-version',
+            action='store',
+            dest='geo_version',
+            default=None,
+            help='The geo_version of the geographies. Default: the latest version'
+        )
+        parser.add_argument(
+            '--limit',
+            action='store',
+            dest='limit',
+            type=int,
+            default=20,
+            help='How many of the slowest statements to report. Default: 20'
+        )
+        parser.add_argument(
+            '--estimate-error',
+            action='store',
+            dest='estimate_error',
+            type=float,
+            default=10.0,
+            help='Report row estimates that are out by more than this factor. Default: 10'
+        )
+        parser.add_argument(
+            '--json',
+            action='store',
+            dest='json_file',
+            default=None,
+            help='Also write the full report, with every statement, to this JSON file.'
+        )
+
+    def debug(self, msg):
+        if self.verbosity >= 2:
+            self.stdout.write(str(msg))
+
+    def handle(self, *args, **options):
+        self.verbosity = options.get('verbosity', 1)
+        if _engine.dialect.name != 'postgresql':
+            raise CommandError("Query plans can only be audited on postgres, not %s" % _engine.dialect.name)
+
+        geo_version = options.get('geo_version') or geo_data.global_latest_version
+        profile_name = settings.WAZIMAP['default_profile']
+        get_profile = import_string(settings.WAZIMAP['profile_builder'])
+
+        capture = QueryCapture(_engine)
+        for geo in self.sample_geos(options['geos'], geo_version):
+            self.stdout.write("Building the %s profile for %s" % (profile_name, geo.geoid))
+            with capture.capturing(geo.geo_level):
+                try:
+                    get_profile(geo, profile_name, None)
+                except Exception as e:
+                    self.stdout.write("Couldn't build the profile for %s: %s" % (geo.geoid, e))
+
+        if not capture.statements:
+            raise CommandError("No queries were captured")
+
+        table_ids = defaultdict(list)
+        for table in DATA_TABLES.itervalues():
+            table_ids[table.db_table].append(table.id)
+
+        results = []
+        for captured in capture.statements.itervalues():
+            self.debug("Explaining: %s" % captured.statement)
+            result = summarise_plan(explain_analyze(_engine, captured.statement, captured.parameters))
+            result.update({
+                'statement': captured.statement,
+                'count': captured.count,
+                'geo_levels': sorted(captured.geo_levels),
+                'sections': sorted(captured.sections),
+                'tables': captured.tables,
+                'table_ids': sorted(i for t in captured.tables for i in table_ids.get(t, [])),
+            })
+            results.append(result)
+
+        self.stdout.write("Explained %d distinct statements, run %d times" % (
+            len(results), sum(r['count'] for r in results)))
+
+        self.report_slowest(results, options['limit'])
+        self.report_seq_scans(results)
+        self.report_estimates(results, options['estimate_error'])
+
+        if options.get('json_file'):
+            with open(options['json_file'], 'w') as f:
+                json.dump(sorted(results, key=lambda r: -r['ms']), f, indent=2)
+
+    def sample_geos(self, geo_ids, geo_version):
+        if geo_ids:
+            geos = []
+            for geo_id in geo_ids:
+                try:
+                    level, code = geo_id.split('-', 1)
+                except ValueError:
+                    raise CommandError("Geographies must be LEVEL-CODE, eg. ward-10404010, not %s" % geo_id)
+                geos.append(geo_data.get_geography(code, level, geo_version))
+            return geos
+
+        geos = []
+        for level in settings.WAZIMAP['levels']:
+            code = geo_data.geo_model.objects\
+                .filter(geo_level=level, version=geo_version)\
+                .order_by('geo_code')\
+                .values_list('geo_code', flat=True)\
+                .first()
+            if code:
+                geos.append(geo_data.get_geography(code, level, geo_version))
+        return geos
+
+    def describe(self, result):
+        return "%s, %s, %s" % (
+            '/'.join(result['geo_levels']),
+            '/'.join(result['sections']),
+            ', '.join(result['table_ids'] or result['tables']) or 'no tables')
+
+    def report_slowest(self, results, limit):
+        self.stdout.write("\nSlowest statements:")
+        for result in sorted(results, key=lambda r: -r['ms'])[:limit]:
+            self.stdout.write("%9.2fms x%-3d %s; buffers %d hit, %d read%s" % (
+                result['ms'], result['count'], self.describe(result),
+                result['buffers_hit'], result['buffers_read'],
+                "; seq scan on %s" % ', '.join(result['seq_scans']) if result['seq_scans'] else ''))
+            self.debug("    %s" % result['statement'])
+
+    def report_seq_scans(self, results):
+        scans = defaultdict(list)
+        for result in results:
+            for relation in result['seq_scans']:
+                scans[relation].append(result)
+
+        self.stdout.write("\nSequential scans: %d relations" % len(scans))
+        for relation, scan_results in sorted(scans.iteritems(), key=lambda s: -sum(r['ms'] for r in s[1])):
+            self.stdout.write("  %s: %d statements, %.2fms, sections %s" % (
+                relation, len(scan_results), sum(r['ms'] for r in scan_results),
+                ', '.join(sorted(set(s for r in scan_results for s in r['sections'])))))
+
+    def report_estimates(self, results, threshold):
+        bad = sorted((r for r in results if r['estimate_error'] > threshold), key=lambda r: -r['estimate_error'])
+
+        self.stdout.write("\nRow estimates out by more than %gx: %d statements" % (threshold, len(bad)))
+        for result in bad:
+            self.stdout.write("  %8.1fx %s; %s" % (result['estimate_error'], result['estimate_node'], self.describe(result)))
@@ -0,0 +1,42 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from wazimap.data.utils import get_session
+from wazimap.data.tables import DATA_TABLES
+
+from wazimap_za.manifest import write_manifest
+
+"""
+Builds a manifest of the data tables, with their metadata and the distinct
+categories of their fields, so that the data API can list and search the
+tables without building them. It's served by setting the TABLE_MANIFEST_PATH
+environment variable to the path of the file.
+
+Rebuild the manifest whenever tables.py or the data in the tables changes.
+"""
+
+
+class Command(BaseCommand):
+    help = "Builds a JSON manifest of the data tables, for serving the data API's table listing."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            nargs='?',
+            default=None,
+            help='The manifest file to build. Default: TABLE_MANIFEST_PATH, or table-manifest.json'
+        )
+
+    def handle(self, *args, **options):
+        path = options.get('path') or settings.TABLE_MANIFEST_PATH or 'table-manifest.json'
+
+        start = time.time()
+        session = get_session()
+        try:
+            count = write_manifest(session, DATA_TABLES.values(), path)
+        finally:
+            session.close()
+
+        self.stdout.write("Built %s with %d tables in %.2fs" % (path, count, time.time() - start))
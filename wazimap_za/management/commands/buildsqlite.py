@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wazimap.data.utils import get_session
+from wazimap.data.tables import DATA_TABLES
+from wazimap.geo import geo_data
+
+from wazimap_za.bookkeeping import category_labels, encoded_columns
+from wazimap_za.loading import table_exists
+from wazimap_za.sqlite_data import build_sqlite
+
+"""
+Builds a read-only SQLite copy of the geographies and data tables, which
+can be served instead of postgres by setting the SQLITE_DATA_PATH
+environment variable to the path of the file.
+"""
+
+
+class Command(BaseCommand):
+    help = "Builds a read-only SQLite file with the geographies and data tables, for serving."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            nargs='?',
+            default='data.sqlite3',
+            help='The SQLite file to build. Default: data.sqlite3'
+        )
+        parser.add_argument(
+            '--table',
+            action='append',
+            dest='tables',
+            default=[],
+            help='An additional table to copy, such as another geography table. Can be given more than once.'
+        )
+
+    def handle(self, *args, **options):
+        path = options.get('path')
+        tables = [geo_data.geo_model._meta.db_table]
+        tables.extend(sorted(set(t.db_table for t in DATA_TABLES.itervalues())))
+        tables.extend(t for t in options.get('tables') or [] if t not in tables)
+
+        start = time.time()
+        session = get_session()
+        try:
+            # the labels of dictionary-encoded category columns
+            tables.extend(t.name for t in (category_labels, encoded_columns)
+                          if t.name not in tables and table_exists(session, t.name))
+            counts = build_sqlite(session, path, tables)
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            session.close()
+
+        for table, count in counts:
+            self.stdout.write("%s: %d rows" % (table, count))
+        self.stdout.write("Built %s with %d tables in %.2fs" % (path, len(counts), time.time() - start))
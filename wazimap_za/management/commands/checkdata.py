@@ -1,12 +1,16 @@
 import sys
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.management.base import BaseCommand
 
 from wazimap.data.utils import get_session
 from wazimap.data.tables import get_datatable, DATA_TABLES, FIELD_TABLES, FieldTable
 from wazimap.geo import geo_data
-
+from wazimap_za.bookkeeping import (ensure_table, table_fingerprints, get_table_fingerprint, store_table_fingerprint,
+                                    clear_geo_checksums)
+from wazimap_za.completeness import TableCheck
+from wazimap_za.geo import GeoResolver
+from wazimap_za.loading import bounded_jobs
 from wazimap_za.models import GeographyYouth
 
 import logging
@@ -17,8 +21,16 @@ logging.getLogger('sqlalchemy.engine').setLevel(logging.WARN)
 """
 This is a helper script that checks the tables in the DB for missing geo entries,
 and missing keys for fields. The tables with missing values will be output after completion.
+Each check is done with a single query in the database, and with --verbosity 2
+the missing entries are output as they are found. Use --jobs to check several
+tables at once, each on its own connection. Missing geographies are
+reported by name using the same GeoResolver as the importers.
+
+When a table is complete, a fingerprint of its contents is stored, and later
+runs skip tables whose fingerprint hasn't changed. Use --force to check them anyway.
 
-If the store_missing_entries flag is passed, the missing items will be populated in the DB.
+If the store_missing_entries flag is passed, the missing items will be populated in the DB,
+with a single INSERT ... SELECT and transaction per table.
 Missing geos are populated with null values for all keys,
 and missing key values are populated with 0.
 
@@ -64,6 +76,21 @@ class Command(BaseCommand):
             default=False,
             help="Dry-run, don't actuall write any data.",
         )
+        parser.add_argument(
+            '--jobs',
+            action='store',
+            dest='jobs',
+            type=int,
+            default=1,
+            help='How many tables to check at once, up to the size of the connection pool. Default: 1'
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help="Check all tables, even those that haven't changed since they were last found to be complete.",
+        )
 
     def debug(self, msg):
         if self.verbosity >= 2:
@@ -76,13 +103,11 @@ class Command(BaseCommand):
         self.geo_version = options.get('geo_version')
         self.store_missing_entries = options.get('store_missing_entries', False)
         self.dryrun = options.get('dryrun')
-
-        self.geos = self.get_geos(self.geo_version)
-        self.wc_geos = GeographyYouth.objects.filter(version='2011')
+        self.jobs = options.get('jobs') or 1
+        self.force = options.get('force', False)
+        self.unchanged_tables = []
 
         self.db_tables = []
-        self.fields_by_table = {}
-        self.keys_by_table = {}
         self.missing_keys_by_table = {}
         self.missing_geos_by_table = {}
         self.missing_geos_by_simple_table = {}
@@ -109,186 +134,152 @@ class Command(BaseCommand):
             self.field_tables = FIELD_TABLES
             self.simple_tables = {k: v for k, v in DATA_TABLES.iteritems() if k not in FIELD_TABLES.keys()}
 
-        for table_id, table in self.field_tables.iteritems():
+        self.geos = GeoResolver.for_version(self.geo_version)
+        self.wc_geos = GeoResolver.for_version('2011', geo_model=GeographyYouth)
+
+        if not self.dryrun:
+            ensure_table(table_fingerprints)
+
+        field_tables = []
+        for table_id, table in sorted(self.field_tables.iteritems()):
             if table.db_table in self.db_tables:
                 # Multiple field tables can refer to the same underlying db table
                 continue
 
             self.db_tables.append(table.db_table)
-            self.stdout.write("Checking table: %s" % (table.id))
+            field_tables.append(table)
 
-            self.fields_by_table[table.id] = table.fields
-            self.keys_by_table[table_id] = self.get_table_keys(table, table.fields)
+        simple_tables = [table for table_id, table in sorted(self.simple_tables.iteritems())]
 
-            rows = self.session.query(table.model).filter(table.model.geo_version == self.geo_version).all()
+        results = self.check_tables([(t, t.fields) for t in field_tables] + [(t, []) for t in simple_tables])
+        if self.unchanged_tables:
+            self.stdout.write("Skipped %d tables that haven't changed since they were last checked" % len(self.unchanged_tables))
 
-            missing_keys = self.get_missing_keys(table, rows, table.fields)
+        for table in field_tables:
+            missing_keys, missing_geos = results[table.id]
             if missing_keys:
                 self.missing_keys_by_table[table.id] = missing_keys
-
-            missing_geos = self.get_missing_geos(table, rows)
             if missing_geos:
                 self.missing_geos_by_table[table.id] = missing_geos
 
         if self.missing_keys_by_table:
             self.stdout.write("Missing keys for tables:")
-            for table in self.missing_keys_by_table.iterkeys():
-                self.stdout.write("%s" % (table))
+            for table, count in sorted(self.missing_keys_by_table.iteritems()):
+                self.stdout.write("%s: %d missing" % (table, count))
 
         if self.missing_geos_by_table:
             self.stdout.write("Missing geos for tables:")
-            for table in self.missing_geos_by_table.iterkeys():
-                self.stdout.write("%s" % table)
+            for table, geos in sorted(self.missing_geos_by_table.iteritems()):
+                self.stdout.write("%s: %d missing" % (table, len(geos)))
 
         if self.store_missing_entries:
-            if self.missing_keys_by_table:
-                self.store_missing_keys()
-                self.stdout.write("Missing keys stored in database.")
-            if self.missing_geos_by_table:
-                self.store_missing_geos()
-                self.stdout.write("Missing geos stored in database.")
+            for table_id in sorted(set(self.missing_keys_by_table) | set(self.missing_geos_by_table)):
+                table = self.field_tables[table_id]
+                self.store_missing(table, table.fields)
         else:
             self.stdout.write("Run command with --store-missing-entries to populate missing keys with 0 and missing geos with null")
 
-
-        for table_id, table in self.simple_tables.iteritems():
-            self.stdout.write("Checking table: %s" % (table.id))
-            rows = self.session.query(table.model).filter(table.model.geo_version == self.geo_version).all()
-            missing_geos = self.get_missing_geos(table, rows)
+        for table in simple_tables:
+            missing_keys, missing_geos = results[table.id]
             if missing_geos:
                 self.missing_geos_by_simple_table[table.id] = missing_geos
 
         if self.missing_geos_by_simple_table:
             self.stdout.write("Missing geos for Simple tables:")
-            for table in self.missing_geos_by_simple_table.iterkeys():
-                self.stdout.write("%s" % table)
+            for table, geos in sorted(self.missing_geos_by_simple_table.iteritems()):
+                self.stdout.write("%s: %d missing" % (table, len(geos)))
 
             if self.store_missing_entries:
-                self.store_simple_table_missing_geos()
-                self.stdout.write("Missing geos for Simple tables stored in database.")
+                for table_id in sorted(self.missing_geos_by_simple_table):
+                    self.store_missing(self.simple_tables[table_id], [])
 
         self.session.close()
 
-    def get_geos(self, geo_version):
-        return geo_data.geo_model.objects.filter(version=geo_version)
-
-    def get_table_keys(self, table, fields):
-        # Return a list with all permuations of the keys for all fields
-        keys = []
-        for obj in self.session.query(table.model).distinct(*fields):
-            keys.append([obj.__getattribute__(field) for field in fields])
-
-        return keys
-
-    def get_missing_keys(self, table, rows, fields):
-        keys_by_geo = defaultdict(list)
-        for row in rows:
-            # Get existing key combinations by geo_id
-            keys_by_geo[row.geo_level + '-' + row.geo_code].append(
-                [row.__getattribute__(field) for field in fields])
-
-        missing_keys_by_geo = {}
-        for geo_id, geo_keys in keys_by_geo.iteritems():
-            if len(geo_keys) != len(self.keys_by_table[table.id]):
-                missing_keys_by_geo[geo_id] = [
-                    x for x in self.keys_by_table[table.id] if x not in geo_keys]
-
-        return missing_keys_by_geo
-
-
-    def get_missing_geos(self, table, rows):
-        table_geos = set((row.geo_level, row.geo_code) for row in rows)
-        if not table_geos:
-            sys.exit("Empty table: %s" % (table.id))
-
+    def table_check(self, session, table, fields):
         if table.id.lower() in WC_ONLY_TABLES:
-            req_geos = set(
-                (g.geo_level, g.geo_code) for g in self.wc_geos)
+            return TableCheck(session, table, fields, GeographyYouth, self.geo_version, required_version='2011')
+        return TableCheck(session, table, fields, geo_data.geo_model, self.geo_version)
+
+    def check_tables(self, tables):
+        """ Check a list of (table, fields) tuples, +jobs+ at a time, and return
+        a dict from table id to a (missing keys count, missing geos) tuple.
+        Exits before checking anything if a table is empty.
+        """
+        for table, fields in tables:
+            if self.table_check(self.session, table, fields).is_empty():
+                sys.exit("Empty table: %s" % (table.id))
+
+        jobs = bounded_jobs(self.jobs)
+        if jobs <= 1 or len(tables) <= 1:
+            results = [self.check_table(table, fields) for table, fields in tables]
         else:
-            req_geos = set((g.geo_level, g.geo_code) for g in self.geos)
-
-        missing_geos = [g for g in req_geos if g not in table_geos]
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(lambda t: self.check_table(*t), tables))
+
+        return {table.id: result for (table, fields), result in zip(tables, results)}
+
+    def check_table(self, table, fields):
+        """ Check a table on its own connection.
+        """
+        session = get_session()
+        try:
+            check = self.table_check(session, table, fields)
+            fingerprint = check.fingerprint()
+            if not self.force and get_table_fingerprint(session, table.db_table, self.geo_version) == fingerprint:
+                self.debug("Unchanged table: %s" % (table.id))
+                self.unchanged_tables.append(table.id)
+                return 0, []
 
-        if missing_geos:
-            self.missing_geos_by_table[table.id] = missing_geos
-
-        return missing_geos
+            self.stdout.write("Checking table: %s" % (table.id))
+            missing_keys = self.get_missing_keys(check)
+            missing_geos = self.get_missing_geos(check)
 
-    def store_missing_keys(self):
-        count = 0
-        for table_id, missing_keys_by_geo in self.missing_keys_by_table.iteritems():
-            table = self.field_tables[table_id]
-            self.stdout.write("Storing missing keys for : %s" % (table_id))
-            for geo, missing_keys in missing_keys_by_geo.iteritems():
-                for key_combo in missing_keys:
-                    count += 1
-                    geo_level, geo_code = geo.split('-')
-                    entry = {
-                        'geo_level': geo_level,
-                        'geo_code': geo_code,
-                        'total': 0,
-                        'geo_version': self.geo_version}
-                    for i, field in enumerate(self.fields_by_table[table_id]):
-                        entry[field] = key_combo[i]
-
-                    entry = table.model(**entry)
-
-                    if not self.dryrun:
-                        self.session.add(entry)
-
-                    if count % 100 == 0:
-                        self.session.flush()
+            if not missing_keys and not missing_geos and not self.dryrun:
+                store_table_fingerprint(session, table.db_table, self.geo_version, fingerprint)
+                session.commit()
 
-        if not self.dryrun:
-            self.session.commit()
+            return missing_keys, missing_geos
+        finally:
+            session.close()
 
-    def store_missing_geos(self):
+    def get_missing_keys(self, check):
+        # Return the number of missing keys
         count = 0
-        for table_id, missing_geos in self.missing_geos_by_table.iteritems():
-            table = self.field_tables[table_id]
-            self.stdout.write("Storing missing geos for : %s" % (table_id))
-            for geo in missing_geos:
-                # Entry for each possible key combination for each missing geo
-                for keys in self.keys_by_table[table_id]:
-                    count += 1
-                    row = {
-                        'geo_level': geo[0],
-                        'geo_code': geo[1],
-                        'total': None,
-                        'geo_version': self.geo_version}
-                    for i, field in enumerate(self.fields_by_table[table_id]):
-                        row[field] = keys[i]
-
-                    entry = table.model(**row)
-
-                    if not self.dryrun:
-                        self.session.add(entry)
-
-                    if count % 100 == 0:
-                        self.session.flush()
+        for geo_level, geo_code, keys in check.missing_keys():
+            self.debug("Missing key for %s-%s in %s: %s" % (geo_level, geo_code, check.table.id, list(keys)))
+            count += 1
 
-        if not self.dryrun:
-            self.session.commit()
+        return count
 
-    def store_simple_table_missing_geos(self):
-        count = 0
-        for table_id, missing_geos in self.missing_geos_by_simple_table.iteritems():
-            table = self.simple_tables[table_id]
-            self.stdout.write("Storing missing geos for : %s" % (table_id))
-            for geo in missing_geos:
-                count += 1
-                row = {
-                    'geo_level': geo[0],
-                    'geo_code': geo[1],
-                    'geo_version': self.geo_version}
+    def get_missing_geos(self, check):
+        geos = self.wc_geos if check.table.id.lower() in WC_ONLY_TABLES else self.geos
 
-                entry = table.model(**row)
+        missing_geos = []
+        for geo in check.missing_geos():
+            self.debug("Missing geo in %s: %s" % (check.table.id, geos.describe(geo)))
+            missing_geos.append(geo)
 
-                if not self.dryrun:
-                    self.session.add(entry)
-
-                if count % 100 == 0:
-                    self.session.flush()
+        return missing_geos
 
-        if not self.dryrun:
-            self.session.commit()
+    def store_missing(self, table, fields):
+        """ Insert rows for the missing keys and geos of a table, in a
+        single transaction.
+        """
+        check = self.table_check(self.session, table, fields)
+        try:
+            keys = check.fill_missing_keys()
+            geos = check.fill_missing_geos()
+
+            if self.dryrun:
+                self.session.rollback()
+            else:
+                # the table is now complete
+                store_table_fingerprint(self.session, table.db_table, self.geo_version, check.fingerprint())
+                clear_geo_checksums(self.session, table.db_table, self.geo_version)
+                self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+
+        self.stdout.write("%s %d rows for missing keys and %d rows for missing geos in %s" % (
+            "Would store" if self.dryrun else "Stored", keys, geos, table.id))
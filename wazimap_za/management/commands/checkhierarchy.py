@@ -0,0 +1,140 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+
+from wazimap.data.utils import get_session
+from wazimap.data.tables import get_datatable, DATA_TABLES
+from wazimap.geo import geo_data
+from wazimap_za.completeness import TableCheck, is_additive
+from wazimap_za.management.commands.checkdata import WC_ONLY_TABLES
+from wazimap_za.models import GeographyYouth
+
+import logging
+
+logging.basicConfig()
+logging.getLogger('sqlalchemy.engine').setLevel(logging.WARN)
+
+"""
+This is a helper script that checks that the values for each geography in
+the data tables add up to the values of their parents: wards to municipalities,
+municipalities to districts, and districts and metros to provinces and the country.
+
+For each table and category, the children are summed per parent in the database,
+and the parents whose values differ from their children's sums by more than the
+tolerance are output, largest deviation first.
+
+Tables whose values don't add up, such as percentages, averages and rates,
+are skipped: those with a stat_type of percentage, and those listed in
+NON_ADDITIVE_TABLES.
+"""
+
+NON_ADDITIVE_TABLES = [
+    # scores
+    'youth_mpi_score',
+    # the MEC7 votes in the registered voters are only counted per municipality, not per ward
+    'voter_turnout_municipal_2011',
+    'voter_turnout_municipal_2016',
+    'voter_turnout_national_2014',
+    'voter_turnout_provincial_2014',
+]
+
+
+class Command(BaseCommand):
+    help = ("Checks that the values of geographies in the data tables (or a single table if passed) " +
+            "add up to the values of their parent geographies.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--table',
+            action='store',
+            dest='table',
+            default=None,
+            help='The name of the database table to check'
+        )
+        parser.add_argument(
+            '--geo-version',
+            action='store',
+            dest='geo_version',
+            default='2011',
+            help='The geo_version of the data which should be checked.'
+        )
+        parser.add_argument(
+            '--tolerance',
+            action='store',
+            dest='tolerance',
+            type=float,
+            default=0.01,
+            help='The largest acceptable difference between a value and the sum of its children, '
+                 'relative to the value. Default: 0.01'
+        )
+        parser.add_argument(
+            '--limit',
+            action='store',
+            dest='limit',
+            type=int,
+            default=50,
+            help='How many of the largest deviations to output. Default: 50'
+        )
+
+    def debug(self, msg):
+        if self.verbosity >= 2:
+            self.stdout.write(str(msg))
+
+    def handle(self, *args, **options):
+        self.verbosity = options.get('verbosity', 1)
+        self.table_id = options.get('table')
+        self.geo_version = options.get('geo_version')
+        self.tolerance = options.get('tolerance')
+        self.limit = options.get('limit')
+
+        if self.table_id:
+            tables = [get_datatable(self.table_id)]
+        else:
+            tables = []
+            db_tables = set()
+            for table_id, table in sorted(DATA_TABLES.iteritems()):
+                # Multiple field tables can refer to the same underlying db table
+                if table.db_table not in db_tables:
+                    db_tables.add(table.db_table)
+                    tables.append(table)
+
+        session = get_session()
+        deviations = []
+        try:
+            for table in tables:
+                if not is_additive(table, NON_ADDITIVE_TABLES):
+                    self.stdout.write("Skipping table: %s, its values don't add up across geo levels" % table.id)
+                    continue
+
+                self.stdout.write("Checking table: %s" % table.id)
+                check = self.table_check(session, table)
+                for column in check.value_columns():
+                    for deviation in check.sum_deviations(column, self.tolerance):
+                        self.debug(self.format_deviation(deviation))
+                        deviations.append(deviation)
+        finally:
+            session.close()
+
+        if not deviations:
+            self.stdout.write("All values add up to within %.2f%%" % (self.tolerance * 100))
+            return
+
+        self.stdout.write("Deviations by table:")
+        for table_id, count in Counter(d.table for d in deviations).most_common():
+            self.stdout.write("%s: %d" % (table_id, count))
+
+        deviations.sort(key=lambda d: d.deviation, reverse=True)
+        self.stdout.write("Largest deviations:")
+        for deviation in deviations[:self.limit]:
+            self.stdout.write(self.format_deviation(deviation))
+
+    def table_check(self, session, table):
+        fields = getattr(table, 'fields', [])
+        if table.id.lower() in WC_ONLY_TABLES:
+            return TableCheck(session, table, fields, GeographyYouth, self.geo_version, required_version='2011')
+        return TableCheck(session, table, fields, geo_data.geo_model, self.geo_version)
+
+    def format_deviation(self, d):
+        return "%.1f%% %s.%s %s-%s %s: %s, children (%d) add up to %s" % (
+            d.deviation * 100, d.table, d.column, d.geo_level, d.geo_code,
+            list(d.keys), d.total, d.children, d.children_total)
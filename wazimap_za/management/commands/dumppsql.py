@@ -1,37 +1,127 @@
-import subprocess
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.management.base import BaseCommand, CommandError
-from django.conf import settings
+
+from wazimap.data.tables import DATA_TABLES
+
+from wazimap_za.dumps import COMPRESSION_EXTENSIONS, dump_names, dump_table, open_dump_output
+
+"""
+Dumps data tables with pg_dump, streaming the output rather than holding
+each dump in memory.
+
+A single table is written to stdout. Several tables, or all the data tables
+and the tables with dumps in sql/, such as the geographies, are dumped in
+parallel into a directory, one file per table, optionally compressed with
+gzip or zstd. Tables that already have a dump in sql/ keep its file name,
+such as 00_demarcation.sql for wazimap_geography.
+
+If pg_dump fails, its error output is reported and the existing file is kept.
+"""
 
 
 class Command(BaseCommand):
-    help = "Dumps data tables to CSV. Just a thin wrapper around pg_dump."
+    help = "Dumps data tables to SQL. Just a thin wrapper around pg_dump."
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--table',
+            action='append',
+            dest='tables',
+            default=[],
+            help='Which table to dump. Can be given more than once.'
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            dest='all',
+            default=False,
+            help='Dump all data tables, and the tables with dumps in sql/.'
+        )
+        parser.add_argument(
+            '--output-dir',
+            action='store',
+            dest='output_dir',
+            default=None,
+            help='Write each table to TABLE.sql in this directory, rather than to stdout.'
+        )
+        parser.add_argument(
+            '--compress',
             action='store',
-            dest='table',
+            dest='compress',
+            choices=['gzip', 'zstd'],
             default=None,
-            help='Which table to dump.'
+            help='Compress the files in --output-dir with gzip or zstd.'
+        )
+        parser.add_argument(
+            '--jobs',
+            action='store',
+            dest='jobs',
+            type=int,
+            default=4,
+            help='How many tables to dump at once. Default: 4'
         )
 
     def handle(self, *args, **options):
-        table_id = options.get('table')
-        if not table_id:
-            raise CommandError("You need to specify a table with --table")
+        tables = options.get('tables') or []
+        self.names = dump_names(glob.glob('sql/*.sql'))
+        if options.get('all'):
+            tables = sorted(set(t.db_table for t in DATA_TABLES.itervalues()) | set(self.names))
+        if not tables:
+            raise CommandError("You need to specify a table with --table, or --all")
+
+        self.output_dir = options.get('output_dir')
+        self.compress = options.get('compress')
+        jobs = options.get('jobs') or 1
+
+        if not self.output_dir:
+            if len(tables) > 1:
+                raise CommandError("Use --output-dir to dump more than one table")
+            if self.compress:
+                raise CommandError("--compress needs --output-dir")
+            try:
+                dump_table(tables[0], self)
+            except (IOError, OSError) as e:
+                raise CommandError(str(e))
+            return
+
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        try:
+            if jobs <= 1:
+                results = [self.dump_to_file(table) for table in tables]
+            else:
+                with ThreadPoolExecutor(max_workers=jobs) as executor:
+                    results = list(executor.map(self.dump_to_file, tables))
+        except (IOError, OSError) as e:
+            raise CommandError(str(e))
 
-        db = settings.DATABASES['default']
+        for path, size, seconds in results:
+            self.stdout.write("Dumped %s (%d KB) in %.2fs" % (path, size / 1024, seconds))
 
-        args = ["-O", "-c", "--if-exists", "-t", table_id]
-        args += ["-d", db['NAME']]
-        args += ["-h", db['HOST']]
-        args += ["-U", db['USER']]
-        args += ["-U", db['USER']]
+    def write(self, data):
+        # dump_table writes the single table dump to stdout through us
+        self.stdout.write(data.decode('utf8'), ending='')
 
-        args = ["pg_dump"] + args
+    def dump_to_file(self, table):
+        name = self.names.get(table, table)
+        path = os.path.join(self.output_dir, name + '.sql' + COMPRESSION_EXTENSIONS[self.compress])
+        # write to a temporary file so that a failed dump doesn't replace a good one
+        tmp_path = path + '.tmp'
+        start = time.time()
 
-        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
+        out = open_dump_output(tmp_path, self.compress)
+        try:
+            dump_table(table, out)
+        except:
+            out.close()
+            os.remove(tmp_path)
+            raise
+        out.close()
+        os.rename(tmp_path, path)
 
-        self.stdout.write(stdout.decode('utf8'))
+        return path, os.path.getsize(path), time.time() - start
@@ -0,0 +1,54 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wazimap.data.utils import get_session
+from wazimap.data.tables import DATA_TABLES
+
+from wazimap_za.snapshots import TableSnapshot
+
+"""
+Writes compact, columnar snapshots of data tables, which can be loaded
+again with loadsnapshot. See wazimap_za/snapshots.py for the format.
+"""
+
+
+class Command(BaseCommand):
+    help = "Writes a columnar snapshot of data tables into a directory, one directory per table."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--table',
+            action='append',
+            dest='tables',
+            default=[],
+            help='Which table to snapshot. Can be given more than once. Default: all data tables'
+        )
+        parser.add_argument(
+            '--output-dir',
+            action='store',
+            dest='output_dir',
+            default='snapshot',
+            help='The directory to write the snapshot to. Default: snapshot'
+        )
+
+    def handle(self, *args, **options):
+        tables = options.get('tables') or sorted(set(t.db_table for t in DATA_TABLES.itervalues()))
+        output_dir = options.get('output_dir')
+
+        session = get_session()
+        try:
+            for table in tables:
+                start = time.time()
+                path = os.path.join(output_dir, table)
+                try:
+                    snapshot = TableSnapshot.write(session, table, path)
+                except ValueError as e:
+                    raise CommandError(str(e))
+
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                self.stdout.write("Wrote %s: %d rows, %d KB in %.2fs" % (
+                    path, snapshot.rows, size / 1024, time.time() - start))
+        finally:
+            session.close()
@@ -0,0 +1,171 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from wazimap.data.utils import get_session
+from wazimap.data.tables import get_datatable, FIELD_TABLES
+
+from wazimap_za.bookkeeping import category_labels, encoded_columns, ensure_table
+from wazimap_za.categories import (decode_column, encode_column, extend_dictionary, get_column_labels,
+                                   get_encoded_fields, time_scan)
+from wazimap_za.loading import format_size, table_sizes
+
+import logging
+
+logging.basicConfig()
+logging.getLogger('sqlalchemy.engine').setLevel(logging.WARN)
+
+"""
+Converts the field columns of FieldTables (or a single table if passed) from
+text labels to smallint codes, with a dictionary of labels for each field,
+or back again with --decode. See wazimap_za/categories.py.
+
+Before encoding, the labels of all the tables being encoded are added to
+the dictionaries at once, so that a dictionary isn't renumbered once
+tables are encoded with it. Each table is then converted in its own
+transaction, and its size and the time to scan it are reported before and
+after. The server must be restarted to use the new encoding.
+
+Encoded tables can't be imported into: decode them first, import, and encode them again.
+"""
+
+
+class Command(BaseCommand):
+    help = ("Dictionary-encodes the category columns of the data tables (or a single table if passed), " +
+            "or decodes them with --decode.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--table',
+            action='append',
+            dest='tables',
+            default=[],
+            help='The id of a FieldTable to convert. Can be given more than once. Default: all of them'
+        )
+        parser.add_argument(
+            '--decode',
+            action='store_true',
+            dest='decode',
+            default=False,
+            help='Convert encoded columns back to labels.'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dryrun',
+            default=False,
+            help="Dry-run, convert the tables and roll back.",
+        )
+
+    def debug(self, msg):
+        if self.verbosity >= 2:
+            self.stdout.write(str(msg))
+
+    def handle(self, *args, **options):
+        self.verbosity = options.get('verbosity', 1)
+        self.decode = options.get('decode')
+        self.dryrun = options.get('dryrun')
+
+        if options['tables']:
+            tables = []
+            for table_id in options['tables']:
+                try:
+                    table = get_datatable(table_id)
+                except KeyError:
+                    raise CommandError("Unknown table: %s" % table_id)
+                if table.id not in FIELD_TABLES:
+                    raise CommandError("%s isn't a FieldTable, so it has no category columns" % table.id)
+                tables.append(table)
+        else:
+            tables = FIELD_TABLES.values()
+
+        # tables that share a database table have the same fields
+        db_tables = {}
+        for table in sorted(tables, key=lambda t: t.id):
+            db_tables.setdefault(table.db_table, table.fields)
+
+        ensure_table(category_labels)
+        ensure_table(encoded_columns)
+
+        if self.dryrun:
+            self.stdout.write("DRY RUN: rolling back all changes")
+
+        if not self.decode:
+            self.extend_dictionaries(db_tables)
+
+        converted = 0
+        for db_table, fields in sorted(db_tables.iteritems()):
+            if self.convert_table(db_table, fields):
+                converted += 1
+
+        self.stdout.write("%s %d of %d tables" % ("Decoded" if self.decode else "Encoded", converted, len(db_tables)))
+        if converted and not self.dryrun:
+            self.stdout.write("Restart the server to use the new encoding.")
+
+    def extend_dictionaries(self, db_tables):
+        """ Add the labels of the fields that aren't encoded yet to their dictionaries.
+        """
+        session = get_session()
+        try:
+            labels = {}
+            for db_table, fields in sorted(db_tables.iteritems()):
+                encoded = get_encoded_fields(session, db_table)
+                for field in fields:
+                    if field not in encoded:
+                        labels.setdefault(field, set()).update(get_column_labels(session, db_table, field))
+
+            for field, field_labels in sorted(labels.iteritems()):
+                self.debug("Dictionary for %s: %d labels" % (field, len(extend_dictionary(session, field, field_labels).labels)))
+
+            if self.dryrun:
+                session.rollback()
+            else:
+                session.commit()
+        except ValueError as e:
+            session.rollback()
+            raise CommandError(str(e))
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def convert_table(self, db_table, fields):
+        session = get_session()
+        try:
+            encoded = get_encoded_fields(session, db_table)
+            if self.decode:
+                todo = [f for f in fields if f in encoded]
+            else:
+                todo = [f for f in fields if f not in encoded]
+
+            if not todo:
+                self.debug("%s: nothing to do" % db_table)
+                return False
+
+            before = table_sizes(session, db_table) + (time_scan(session, db_table), )
+            for field in todo:
+                self.debug("%s: %s" % (db_table, field))
+                if self.decode:
+                    decode_column(session, db_table, field)
+                else:
+                    encode_column(session, db_table, field)
+            after = table_sizes(session, db_table) + (time_scan(session, db_table), )
+
+            if self.dryrun:
+                session.rollback()
+            else:
+                session.commit()
+        except ValueError as e:
+            session.rollback()
+            raise CommandError("%s: %s" % (db_table, e))
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        self.stdout.write("%s: table %s -> %s, indexes %s -> %s, scan %.3fs -> %.3fs" % (
+            db_table,
+            format_size(before[0]), format_size(after[0]),
+            format_size(before[1]), format_size(after[1]),
+            before[2], after[2]))
+        return True
@@ -0,0 +1,136 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from wazimap.data.utils import get_session
+from wazimap.data.tables import get_datatable, DATA_TABLES, FIELD_TABLES
+
+from wazimap_za.indexes import (create_geo_index, explain_geo_lookup, find_geo_index, geo_index_columns,
+                                get_index_columns, relation_size)
+from wazimap_za.loading import MAINTENANCE_WORK_MEM, format_size, table_exists, table_sizes
+
+import logging
+
+logging.basicConfig()
+logging.getLogger('sqlalchemy.engine').setLevel(logging.WARN)
+
+"""
+Makes sure that every data table (or a single table if passed) has an index
+for looking up a geography's rows by (geo_version, geo_level, geo_code),
+which every profile query does.
+
+A table is fine if any valid index starts with those three columns, such as
+a FieldTable's primary key. Otherwise an index is created concurrently, so
+the table can still be used while it's built. For FieldTables the index also
+covers the fields and total, so that profile queries are answered from the
+index alone.
+
+For each table that gets an index, the sizes and the query plan for a
+geography lookup are reported before and after. Use -v 2 for the full plans.
+"""
+
+# postgres' limit on the number of columns in an index
+MAX_INDEX_COLUMNS = 32
+
+
+class Command(BaseCommand):
+    help = ("Creates any missing (geo_version, geo_level, geo_code) lookup indexes on the data tables " +
+            "(or a single table if passed).")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--table',
+            action='append',
+            dest='tables',
+            default=[],
+            help='The id of a data table to check. Can be given more than once. Default: all of them'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dryrun',
+            default=False,
+            help="Dry-run, only report which indexes are missing.",
+        )
+        parser.add_argument(
+            '--maintenance-work-mem',
+            action='store',
+            dest='maintenance_work_mem',
+            default=MAINTENANCE_WORK_MEM,
+            help='Memory for each index build. Default: %s' % MAINTENANCE_WORK_MEM
+        )
+
+    def debug(self, msg):
+        if self.verbosity >= 2:
+            self.stdout.write(str(msg))
+
+    def handle(self, *args, **options):
+        self.verbosity = options.get('verbosity', 1)
+        self.dryrun = options.get('dryrun')
+        self.maintenance_work_mem = options.get('maintenance_work_mem')
+
+        if options['tables']:
+            try:
+                tables = [get_datatable(t) for t in options['tables']]
+            except KeyError as e:
+                raise CommandError("Unknown table: %s" % e)
+        else:
+            tables = DATA_TABLES.values()
+
+        # tables that share a database table have the same fields
+        db_tables = {}
+        for table in sorted(tables, key=lambda t: t.id):
+            db_tables.setdefault(table.db_table, table.fields if table.id in FIELD_TABLES else [])
+
+        created = []
+        for db_table, fields in sorted(db_tables.iteritems()):
+            if self.ensure_index(db_table, fields):
+                created.append(db_table)
+
+        self.stdout.write("%s %d indexes, %d tables were already indexed" % (
+            "Would create" if self.dryrun else "Created", len(created), len(db_tables) - len(created)))
+
+    def ensure_index(self, db_table, fields):
+        session = get_session()
+        try:
+            if not table_exists(session, db_table):
+                self.stdout.write("%s: table doesn't exist" % db_table)
+                return False
+
+            existing = find_geo_index(get_index_columns(session, db_table))
+            if existing:
+                self.debug("%s: indexed by %s" % (db_table, existing))
+                return False
+
+            columns = geo_index_columns(fields)
+            if len(columns) > MAX_INDEX_COLUMNS:
+                columns = geo_index_columns([])
+
+            table_size, indexes_size = table_sizes(session, db_table)
+            plan_before = explain_geo_lookup(session, db_table)
+            # don't hold locks while the index is built
+            session.commit()
+
+            self.stdout.write("%s: table %s, indexes %s, missing (%s)" % (
+                db_table, format_size(table_size), format_size(indexes_size), ', '.join(columns)))
+            self.report_plan("before", plan_before)
+
+            if self.dryrun:
+                return True
+
+            name = create_geo_index(session.get_bind(), db_table, columns, self.maintenance_work_mem)
+
+            table_size, indexes_size = table_sizes(session, db_table)
+            self.stdout.write("%s: created %s, %s, indexes now %s" % (
+                db_table, name, format_size(relation_size(session, name)), format_size(indexes_size)))
+            self.report_plan("after", explain_geo_lookup(session, db_table))
+            return True
+        finally:
+            session.close()
+
+    def report_plan(self, when, plan):
+        if plan is None:
+            self.stdout.write("  %s: table is empty" % when)
+            return
+
+        self.stdout.write("  %s: %s" % (when, plan[0].strip()))
+        for line in plan[1:]:
+            self.debug("    %s" % line)
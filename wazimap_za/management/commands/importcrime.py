@@ -0,0 +1,297 @@
+import csv
+import os
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wazimap.data.utils import get_session
+from wazimap.data.tables import get_datatable, get_table_id
+from wazimap.geo import geo_data
+
+from wazimap_za.aggregation import aggregate_to_parents
+from wazimap_za.apportion import Apportionment
+from wazimap_za.bookkeeping import clear_geo_checksums
+from wazimap_za.loading import replace_rows
+from wazimap_za.progress import CountingFile, ProgressReporter
+
+import logging
+
+logging.basicConfig()
+logging.getLogger('sqlalchemy.engine').setLevel(logging.WARN)
+
+"""
+Imports crime statistics by police station into a FieldTable in one pass,
+instead of running bin/recompose.py, bin/field_table_format.py and
+aggregateparents with intermediate files, followed by importsimplecsv.
+
+The stations' numbers are reformatted into FieldTable rows using the
+--field and --value mappings, reattributed to wards with the factors file,
+rounded for each ward, added up into every parent geography, and written
+into the table, replacing the existing rows with the same keys. A dry run
+does all of that except writing.
+The time spent in each stage is reported at the end.
+
+Example, for a file with PoliceStation, year, contact and property columns:
+
+    python manage.py importcrime data/crimes.csv --factors data/ward-factors.csv \\
+        --field year --value-field "crime type" \\
+        --value "Contact crime=contact" --value "Property crime=property"
+
+which is loaded into the table for the fields "crime type" and year.
+"""
+
+
+def parse_mapping(mapping):
+    """ Split NAME=COLUMN into (NAME, COLUMN). COLUMN defaults to NAME.
+    """
+    name, _, column = mapping.partition('=')
+    return name.strip(), (column or name).strip()
+
+
+def ward_code(code):
+    # the factors have ward codes such as 10404010.0
+    try:
+        return str(int(float(code)))
+    except ValueError:
+        return code
+
+
+class Command(BaseCommand):
+    help = ("Imports crime statistics by police station: reattributes them to wards, " +
+            "adds them up into the parent geographies and loads them into a FieldTable.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'filepath',
+            action='store',
+            help='CSV file with a row for each police station'
+        )
+        parser.add_argument(
+            '--factors',
+            action='store',
+            dest='factors',
+            required=True,
+            help='CSV file with the factor for each police station and ward'
+        )
+        parser.add_argument(
+            '--source-key',
+            action='store',
+            dest='source_key',
+            default='PoliceStation',
+            help='Column with the police station, in both files. Default: PoliceStation'
+        )
+        parser.add_argument(
+            '--target-key',
+            action='store',
+            dest='target_key',
+            default='WARD_ID',
+            help='Column with the ward in the factors. Default: WARD_ID'
+        )
+        parser.add_argument(
+            '--factor-key',
+            action='store',
+            dest='factor_key',
+            default='scal_fac_per_int',
+            help='Column with the factor in the factors. Default: scal_fac_per_int'
+        )
+        parser.add_argument(
+            '--field',
+            action='append',
+            dest='fields',
+            default=[],
+            help='A field of the table, as FIELD=COLUMN, or FIELD if the column has the same name. '
+                 'Can be given more than once.'
+        )
+        parser.add_argument(
+            '--value',
+            action='append',
+            dest='values',
+            default=[],
+            help='A column with numbers, as LABEL=COLUMN. Each one becomes a row with --value-field '
+                 'set to LABEL. Can be given more than once. Default: Frequency'
+        )
+        parser.add_argument(
+            '--value-field',
+            action='store',
+            dest='value_field',
+            default=None,
+            help='The field that holds the label of each --value, such as "crime type"'
+        )
+        parser.add_argument(
+            '--table',
+            action='store',
+            dest='table',
+            default=None,
+            help='The name of the database table where the data will be stored. '
+                 'If not provided, it is generated from the field names'
+        )
+        parser.add_argument(
+            '--geo_version',
+            action='store',
+            dest='geo_version',
+            default='2011',
+            help='The the value for the geo_version column for this data. Default: 2011'
+        )
+        parser.add_argument(
+            '--value_type',
+            action='store',
+            dest='value_type',
+            default='Integer',
+            help='The type of values used in the total column: Integer or Float'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dryrun',
+            default=False,
+            help="Dry-run, don't actually write any data.",
+        )
+        parser.add_argument(
+            '--summary-file',
+            action='store',
+            dest='summary_file',
+            default=None,
+            help='Write a JSON summary of the import, with the timing of each stage, to this file.'
+        )
+
+    def debug(self, msg):
+        if self.verbosity >= 2:
+            self.stdout.write(str(msg))
+
+    def handle(self, *args, **options):
+        self.filepath = options['filepath']
+        self.verbosity = options.get('verbosity', 1)
+        self.source_key = options['source_key']
+        self.geo_version = options.get('geo_version')
+        self.value_type = options.get('value_type', 'Integer')
+        self.dryrun = options.get('dryrun', False)
+
+        self.field_columns = [parse_mapping(m) for m in options['fields']]
+        self.value_columns = [parse_mapping(m) for m in options['values'] or ['Frequency']]
+        self.value_field = options.get('value_field')
+        if len(self.value_columns) > 1 and not self.value_field:
+            raise CommandError("--value-field is needed to tell several --value columns apart")
+
+        self.fields = [name for name, column in self.field_columns]
+        if self.value_field:
+            self.fields.append(self.value_field)
+        if not self.fields:
+            raise CommandError("At least one --field or a --value-field is needed")
+
+        table_id = options.get('table') or get_table_id(self.fields)
+        try:
+            self.table = get_datatable(table_id)
+        except KeyError:
+            raise CommandError("Couldn't establish which table to use for these fields. Have you added a FieldTable entry in wazimap_za/tables.py?\nFields: %s" % self.fields)
+        self.stdout.write("Table for fields %s is %s" % (self.fields, self.table.id))
+
+        if self.dryrun:
+            self.stdout.write("DRY RUN: not actually writing data")
+
+        self.progress = ProgressReporter(self.stdout, total_bytes=os.path.getsize(self.filepath))
+
+        with self.progress.phase('factors'):
+            apportionment = Apportionment.from_csv(
+                options['factors'], self.source_key, options['target_key'], options['factor_key'])
+
+        with open(self.filepath) as f:
+            self.f = CountingFile(f)
+            rows = list(self.reformat(csv.DictReader(self.f)))
+
+        with self.progress.phase('recompose'):
+            try:
+                wards = apportionment.apply_rows(rows, self.source_key, ['total'], self.fields, target_key='geo_code')
+            except ValueError as e:
+                raise CommandError(str(e))
+
+            for row in wards:
+                row['geo_level'] = 'ward'
+                row['geo_code'] = ward_code(row['geo_code'])
+            wards = self.merge_wards(wards)
+
+        with self.progress.phase('aggregate'):
+            geos = geo_data.geo_model.objects\
+                .filter(version=self.geo_version)\
+                .values_list('geo_level', 'geo_code', 'parent_level', 'parent_code')
+            try:
+                parents = aggregate_to_parents(wards, geos, self.fields)
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        with self.progress.phase('load'):
+            count = self.store_values(wards + parents)
+
+        self.stdout.write("%s %d rows into %s" % (
+            "Would have loaded" if self.dryrun else "Loaded", count, self.table.db_table))
+        self.progress.finish(options.get('summary_file'))
+
+    def reformat(self, reader):
+        """ Yield a FieldTable row, keyed by police station, for each value
+        column of each row in the file.
+        """
+        missing = [c for n, c in self.field_columns + self.value_columns + [(None, self.source_key)]
+                   if c not in reader.fieldnames]
+        if missing:
+            raise CommandError("%s doesn't have the columns %s" % (self.filepath, ', '.join(missing)))
+
+        for raw in self.progress.timed(reader, 'read'):
+            with self.progress.phase('reformat'):
+                fields = {name: raw[column] for name, column in self.field_columns}
+                fields[self.source_key] = raw[self.source_key]
+
+                rows = []
+                for label, value_column in self.value_columns:
+                    row = dict(fields, total=raw[value_column])
+                    if self.value_field:
+                        row[self.value_field] = label
+                    rows.append(row)
+
+            self.progress.update(bytes_read=self.f.tell())
+            for row in rows:
+                yield row
+
+    def merge_wards(self, rows):
+        """ Add up the rows for the same ward and fields, such as when the factors
+        have both 10404010 and 10404010.0, and round each ward's total, so that
+        the parents' totals are the sums of the wards' rounded totals.
+        """
+        merged = OrderedDict()
+        for row in rows:
+            key = (row['geo_code'], ) + tuple(row[f] for f in self.fields)
+            if key in merged:
+                merged[key]['total'] += row['total']
+            else:
+                merged[key] = row
+
+        for row in merged.itervalues():
+            row['total'] = self.round_total(row['total'])
+        return merged.values()
+
+    def round_total(self, total):
+        return round(total, 1) if self.value_type == 'Float' else int(round(total))
+
+    def store_values(self, rows):
+        table = self.table.model.__table__
+        session = get_session()
+
+        try:
+            for i in xrange(0, len(rows), 1000):
+                batch = rows[i:i + 1000]
+                for row in batch:
+                    row['geo_version'] = self.geo_version
+                    row['total'] = self.round_total(row['total'])
+                    self.debug("%s-%s" % (row['geo_level'], row['geo_code']))
+
+                if not self.dryrun:
+                    replace_rows(session, table, batch)
+
+            if not self.dryrun:
+                clear_geo_checksums(session, table.name, self.geo_version)
+                session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        return len(rows)
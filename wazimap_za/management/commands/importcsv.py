@@ -1,13 +1,20 @@
 import copy
 import csv
-import re
+import json
+import os
 
 from django.core.management.base import BaseCommand, CommandError
+from sqlalchemy import and_, select
 
 from wazimap.data.utils import get_session
 from wazimap.data.tables import get_datatable, get_table_id
-from wazimap.geo import geo_data
 
+from wazimap_za.bookkeeping import geo_checksums, ensure_table, checksum_rows, get_geo_checksums, store_geo_checksums, \
+    clear_geo_checksums, import_progress, get_import_progress, save_import_progress, clear_import_progress
+from wazimap_za.geo import GeoResolver
+from wazimap_za.loading import (IndexDef, StagingTable, bounded_jobs, build_indexes, drop_indexes, get_table_indexes,
+                                replace_geo_rows)
+from wazimap_za.progress import CountingFile, ProgressReporter
 
 import logging
 
@@ -20,8 +27,6 @@ CSV file and imports the data into the Wazi database, creating
 tables as necessary.
 """
 
-muni_re = re.compile('^[A-Z]{2,3}\d{0,3}\s*:\s.*$')
-
 
 class Command(BaseCommand):
     help = ("Imports data from a SuperWEB- or SuperCROSS-generated CSV file. " +
@@ -57,9 +62,70 @@ class Command(BaseCommand):
             required=True,
             help='The geography demarcation version that this table refers to'
         )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            dest='incremental',
+            default=False,
+            help="Only replace the data for geographies that have changed since the last import.",
+        )
+        parser.add_argument(
+            '--delete-missing',
+            action='store_true',
+            dest='delete_missing',
+            default=False,
+            help="With --incremental, delete the data for geographies at the levels in the file "
+                 "that aren't in the file. By default their data is kept.",
+        )
+        parser.add_argument(
+            '--staging',
+            action='store_true',
+            dest='staging',
+            default=False,
+            help="Load into a staging copy of the table and swap it with the live table when complete.",
+        )
+        parser.add_argument(
+            '--defer-indexes',
+            action='store_true',
+            dest='defer_indexes',
+            default=False,
+            help="Drop the table's indexes while loading and rebuild them afterwards. "
+                 "The primary key and unique constraints are kept.",
+        )
+        parser.add_argument(
+            '--index-jobs',
+            action='store',
+            dest='index_jobs',
+            type=int,
+            default=2,
+            help='How many indexes to rebuild at once. Default: 2'
+        )
+        parser.add_argument(
+            '--summary-file',
+            action='store',
+            dest='summary_file',
+            default=None,
+            help='Write a JSON summary of the import, with timings, to this file.'
+        )
+        parser.add_argument(
+            '--checkpoint-every',
+            action='store',
+            dest='checkpoint_every',
+            type=int,
+            default=0,
+            help='Commit and record a checkpoint every N geographies, so that a failed import '
+                 'can be continued with --resume. Default: commit once at the end'
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help="Continue a checkpointed import of this file from its last checkpoint.",
+        )
 
-    def debug(self, msg):
-        if self.verbosity >= 2:
+    def debug(self, msg, verbosity=2):
+        if self.verbosity >= verbosity:
             self.stdout.write(str(msg))
 
     def handle(self, *args, **options):
@@ -69,18 +135,44 @@ class Command(BaseCommand):
         self.table_id = options.get('table')
         self.dryrun = options.get('dryrun', False)
         self.geo_version = options.get('geo_version')
-        self.provinces = {g.name.lower(): g for g in geo_data.geo_model.objects.filter(version=self.geo_version).filter(geo_level='province')}
-        self.districts = {g.name.lower(): g for g in geo_data.geo_model.objects.filter(version=self.geo_version).filter(geo_level='district')}
-        self.metros = {g.name.lower(): g for g in geo_data.geo_model.objects.filter(version=self.geo_version).filter(geo_level='municipality').filter(parent_level='province')}
+        self.incremental = options.get('incremental', False)
+        self.delete_missing = options.get('delete_missing', False)
+        self.staging = options.get('staging', False)
+        self.defer_indexes = options.get('defer_indexes', False)
+        self.index_jobs = bounded_jobs(options.get('index_jobs') or 1)
+        self.summary_file = options.get('summary_file')
+        self.checkpoint_every = options.get('checkpoint_every') or 0
+        self.resume = options.get('resume', False)
+        self.progress = ProgressReporter(self.stdout, total_bytes=os.path.getsize(self.filepath))
+        self.resolver = GeoResolver.for_version(self.geo_version)
 
         if self.dryrun:
             self.stdout.write("DRY RUN: not actuall writing data")
 
+        if self.resume and not self.checkpoint_every:
+            self.checkpoint_every = 500
+        if self.checkpoint_every and (self.incremental or self.staging):
+            raise CommandError("--checkpoint-every and --resume can't be used with --incremental or --staging")
+        if self.incremental and self.staging:
+            raise CommandError("--incremental can't be used with --staging")
+        if self.delete_missing and not self.incremental:
+            raise CommandError("--delete-missing can only be used with --incremental")
+
         with open(self.filepath) as f:
-            self.f = f
+            self.f = CountingFile(f)
             self.read_headers()
             self.setup_table()
-            self.store_values()
+            if not self.dryrun:
+                ensure_table(geo_checksums)
+                ensure_table(import_progress)
+            if self.incremental:
+                self.store_changed_values()
+            elif self.staging:
+                self.store_values_staged()
+            else:
+                self.store_values()
+
+        self.progress.finish(self.summary_file)
 
     def read_headers(self):
         line = next(self.f)
@@ -248,90 +340,250 @@ class Command(BaseCommand):
         except KeyError:
             raise CommandError("Couldn't establish which table to use for these fields. Have you added a FieldTable entry in wazimap_za/tables.py?\nFields: %s" % self.fields)
 
-    def store_values(self):
-        session = get_session()
-        count = 0
+    def read_geo_blocks(self):
+        """ Yield a (geo_level, geo_code, rows) tuple for each geography in the
+        file, where rows is a list of dicts of column values for the data table.
+        """
         stored_values = {}
 
-        for geo_name, values in self.read_rows():
+        for geo_name, values in self.progress.timed(self.read_rows(), 'parse'):
             if all(not val for val in values):
                 break
+
+            with self.progress.phase('validate'):
+                geo_level, geo_code = self.determine_geo_id(geo_name)
+
+            self.debug("%s-%s" % (geo_level, geo_code))
+
+            rows = []
+            with self.progress.phase('parse'):
+                for category, value in zip(self.categories, values):
+                    # prepare the dict of args to pass to the db model for this row
+                    kwargs = {
+                        'geo_level': geo_level,
+                        'geo_code': geo_code,
+                        'geo_version': self.geo_version,
+                    }
+
+                    kwargs.update(dict((f, v) for f, v in zip(self.fields, category)))
+                    if value == '-':
+                        value = '0'
+                    total = round(float(value.replace(',', '')))
+                    stored_key = tuple(sorted(list(kwargs.items())))
+                    if stored_key in stored_values:
+                        if stored_values[stored_key] == total:
+                            self.stdout.write("Skipping already-added value for key %r" % list(stored_key))
+                            continue
+                        else:
+                            raise Exception("Different value %r != %r for duplicate key %r" % (stored_values[stored_key], total, stored_key))
+                    stored_values[stored_key] = total
+                    kwargs['total'] = total
+                    rows.append(kwargs)
+
+            self.progress.update(len(rows), self.f.tell())
+            yield geo_level, geo_code, rows
+
+    def store_values(self):
+        session = get_session()
+        count = 0
+
+        indexes = []
+        if self.resume:
+            count, indexes = self.resume_from_checkpoint(session)
+        if self.defer_indexes and not self.dryrun:
+            indexes.extend(drop_indexes(session, self.table.db_table))
+            for index in indexes:
+                self.stdout.write("Deferring index: %s" % index.create_sql(self.table.db_table))
+
+        try:
+            self.load_rows(session, count, indexes)
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+            # rebuild the indexes even if the load failed, so the table isn't left without them
+            if indexes:
+                self.report_index_times(build_indexes(self.table.db_table, indexes, jobs=self.index_jobs))
+
+    def load_rows(self, session, count, indexes):
+        checksums = {}
+
+        for geo_level, geo_code, rows in self.read_geo_blocks():
             count += 1
-            geo_level, geo_code = self.determine_geo_id(geo_name)
-
-            self.stdout.write("%s-%s" % (geo_level, geo_code))
-
-            for category, value in zip(self.categories, values):
-                # prepare the dict of args to pass to the db model for this row
-                kwargs = {
-                    'geo_level': geo_level,
-                    'geo_code': geo_code,
-                    'geo_version': self.geo_version,
-                }
-
-                kwargs.update(dict((f, v) for f, v in zip(self.fields, category)))
-                if value == '-':
-                    value = '0'
-                total = round(float(value.replace(',', '')))
-                stored_key = tuple(sorted(list(kwargs.items())))
-                if stored_key in stored_values:
-                    if stored_values[stored_key] == total:
-                        self.stdout.write("Skipping already-added value for key %r" % list(stored_key))
-                        continue
-                    else:
-                        raise Exception("Different value %r != %r for duplicate key %r" % (stored_values[stored_key], total, stored_key))
-                stored_values[stored_key] = total
-                kwargs['total'] = total
-
-                # create and add the row
-                self.debug(kwargs)
-                entry = self.table.model(**kwargs)
-                if not self.dryrun:
-                    session.add(entry)
+            checksums[(geo_level, geo_code)] = checksum_rows(rows, self.fields + ['total'])
+
+            with self.progress.phase('write'):
+                for kwargs in rows:
+                    # create and add the row
+                    self.debug(kwargs, 3)
+                    entry = self.table.model(**kwargs)
+                    if not self.dryrun:
+                        session.add(entry)
+
+                if count % 100 == 0:
+                    session.flush()
+
+                if self.checkpoint_every and count % self.checkpoint_every == 0 and not self.dryrun:
+                    # commit the rows along with the checkpoint, so that
+                    # the checkpoint always matches what's in the table
+                    store_geo_checksums(session, self.table.db_table, self.geo_version, checksums)
+                    checksums = {}
+                    self.save_checkpoint(session, count, '%s-%s' % (geo_level, geo_code), indexes)
+                    session.commit()
+                    self.debug("Checkpoint after %d geographies at %s-%s" % (count, geo_level, geo_code))
+
+        with self.progress.phase('write'):
+            if not self.dryrun:
+                store_geo_checksums(session, self.table.db_table, self.geo_version, checksums)
+                if self.checkpoint_every:
+                    clear_import_progress(session, self.checkpoint_key(), self.table.db_table, self.geo_version)
+                session.commit()
+
+    def checkpoint_key(self):
+        return os.path.abspath(self.filepath)
+
+    def save_checkpoint(self, session, count, last_geo, indexes):
+        save_import_progress(
+            session, self.checkpoint_key(), self.table.db_table, self.geo_version,
+            file_size=os.path.getsize(self.filepath),
+            file_offset=self.f.tell(),
+            geos_done=count,
+            last_geo=last_geo,
+            deferred_indexes=json.dumps([vars(i) for i in indexes]))
+
+    def resume_from_checkpoint(self, session):
+        """ Move the file to just after the last checkpointed geography, and
+        return the number of geographies already imported and the indexes
+        that were dropped by the original import and haven't been rebuilt.
+        """
+        checkpoint = get_import_progress(session, self.checkpoint_key(), self.table.db_table, self.geo_version)
+        if checkpoint is None:
+            raise CommandError("No checkpoint to resume from for %s into %s" % (self.filepath, self.table.db_table))
 
-            if count % 100 == 0:
-                session.flush()
+        if checkpoint.file_size != os.path.getsize(self.filepath):
+            raise CommandError("%s has changed since it was checkpointed, it can't be resumed" % self.filepath)
 
-        if not self.dryrun:
-            session.commit()
-        session.close()
+        # the headers have already been read, skip the rows that are already in the table
+        self.f.seek(checkpoint.file_offset)
+        self.stdout.write("Resuming after %s, %d geographies already imported" % (checkpoint.last_geo, checkpoint.geos_done))
 
-    def determine_geo_id(self, geo_name):
-        """ Return a [geo_level, geo_code] tuple.
+        existing = set(i.name for i in get_table_indexes(session, self.table.db_table))
+        indexes = [IndexDef(**i) for i in json.loads(checkpoint.deferred_indexes or '[]')]
+        return checkpoint.geos_done, [i for i in indexes if i.name not in existing]
+
+    def report_index_times(self, timings):
+        for name, seconds in timings:
+            self.stdout.write("Built index %s on %s in %.2fs" % (name, self.table.db_table, seconds))
+
+    def store_values_staged(self):
+        """ Load the new rows into a staging table, along with the existing rows
+        of the geographies that aren't in the file, and swap it with the live
+        table once it's indexed and valid.
         """
-        if geo_name == "":
-            return ['country', 'ZA']
+        session = get_session()
+        staging = StagingTable(session, self.table.db_table)
+        checksums = {}
 
-        level = None
-        if ':' in geo_name:
-            pre, code = geo_name.split(':', 1)
-            pre = pre.strip(); code = code.strip()
-        else:
-            pre = code = geo_name
-
-        if muni_re.match(geo_name):
-            level = 'municipality'
-            code = pre
-        elif 'Ward' in geo_name:
-            level = 'ward'
-            code = pre
-        elif geo_name.startswith('DC'):
-            level = 'district'
-            code = pre.strip()
+        try:
+            staging.create()
 
-        else:
-            matches = []
-            for geo_level, options in [('province', self.provinces),
-                                       ('district', self.districts),
-                                       ('municipality', self.metros)]:
-                match = options.get(geo_name.strip().lower(), None)
-                if match:
-                    matches.append((geo_level, match.geo_code))
-            if len(matches) == 0:
-                raise ValueError("Cannot recognize the geo level of %s" % geo_name)
-            elif len(matches) == 1:
-                (level, code) = matches[0]
+            for geo_level, geo_code, rows in self.read_geo_blocks():
+                checksums[(geo_level, geo_code)] = checksum_rows(rows, self.fields + ['total'])
+                self.debug(rows, 3)
+                with self.progress.phase('write'):
+                    staging.insert(rows, self.table.model.__table__)
+
+            with self.progress.phase('write'):
+                staging.copy_live_rows()
+
+            self.report_index_times(staging.build_indexes(jobs=self.index_jobs))
+            count = staging.validate()
+
+            if self.dryrun:
+                staging.drop()
             else:
-                raise ValueError("Cannot recognize single geo level of %s: %s" % (geo_name, matches))
+                staging.swap(before_commit=lambda: store_geo_checksums(
+                    session, self.table.db_table, self.geo_version, checksums))
+                self.stdout.write("Swapped in %s with %d rows" % (self.table.db_table, count))
+        except:
+            staging.drop()
+            raise
+        finally:
+            session.close()
+
+    def store_changed_values(self):
+        """ Compare a checksum of each geography's rows with the checksum stored
+        by the previous import, and only replace the rows of geographies
+        that have changed.
+
+        Geographies that aren't in the file keep their data, unless
+        --delete-missing is given.
+        """
+        session = get_session()
+        table = self.table.model.__table__
+        changed = 0
+        unchanged = 0
+        seen = set()
+
+        try:
+            stored_checksums = get_geo_checksums(session, self.table.db_table, self.geo_version)
+
+            for geo_level, geo_code, rows in self.read_geo_blocks():
+                seen.add((geo_level, geo_code))
+                checksum = checksum_rows(rows, self.fields + ['total'])
+                if stored_checksums.get((geo_level, geo_code)) == checksum:
+                    unchanged += 1
+                    continue
+
+                changed += 1
+                self.stdout.write("Changed: %s-%s" % (geo_level, geo_code))
+                self.debug(rows, 3)
 
-        return [level, code]
+                if not self.dryrun:
+                    with self.progress.phase('write'):
+                        replace_geo_rows(session, table, self.fields, geo_level, geo_code, self.geo_version, rows)
+                        store_geo_checksums(session, self.table.db_table, self.geo_version,
+                                            {(geo_level, geo_code): checksum})
+
+            if self.delete_missing:
+                self.delete_missing_geos(session, table, seen)
+
+            if not self.dryrun:
+                with self.progress.phase('write'):
+                    session.commit()
+        finally:
+            session.close()
+
+        self.stdout.write("%d geographies changed, %d unchanged" % (changed, unchanged))
+
+    def delete_missing_geos(self, session, table, seen):
+        """ Delete the rows and checksums of geographies at the levels in
+        the file that have rows in the table, but aren't in the file.
+        """
+        levels = set(geo_level for geo_level, geo_code in seen)
+        geos = session.execute(
+            select([table.c.geo_level, table.c.geo_code]).distinct().where(and_(
+                table.c.geo_version == self.geo_version,
+                table.c.geo_level.in_(levels))))
+        missing = sorted(set(tuple(geo) for geo in geos) - seen)
+
+        for geo_level, geo_code in missing:
+            self.stdout.write("Missing: %s-%s" % (geo_level, geo_code))
+            if not self.dryrun:
+                with self.progress.phase('write'):
+                    session.execute(table.delete().where(and_(
+                        table.c.geo_level == geo_level,
+                        table.c.geo_code == geo_code,
+                        table.c.geo_version == self.geo_version)))
+
+        if missing and not self.dryrun:
+            clear_geo_checksums(session, self.table.db_table, self.geo_version, missing)
+
+        self.stdout.write("%s %d geographies that aren't in the file" % (
+            "Would delete" if self.dryrun else "Deleted", len(missing)))
+
+    def determine_geo_id(self, geo_name):
+        """ Return a (geo_level, geo_code) tuple.
+        """
+        return self.resolver.resolve(geo_name)
@@ -1,10 +1,17 @@
 import csv
+import os
 
 from django.core.management.base import BaseCommand, CommandError
 
 from wazimap.data.utils import get_session
 from wazimap.data.tables import get_datatable, get_table_id
 
+from wazimap_za.apportion import Apportionment
+from wazimap_za.bookkeeping import clear_geo_checksums
+from wazimap_za.geo import GeoResolver
+from wazimap_za.loading import StagingTable, bounded_jobs, build_indexes, drop_indexes
+from wazimap_za.progress import CountingFile, ProgressReporter
+
 
 import logging
 
@@ -60,6 +67,58 @@ class Command(BaseCommand):
             default=False,
             help="Dry-run, don't actuall write any data.",
         )
+        parser.add_argument(
+            '--staging',
+            action='store_true',
+            dest='staging',
+            default=False,
+            help="Load into a staging copy of the table and swap it with the live table when complete.",
+        )
+        parser.add_argument(
+            '--defer-indexes',
+            action='store_true',
+            dest='defer_indexes',
+            default=False,
+            help="Drop the table's indexes while loading and rebuild them afterwards. "
+                 "The primary key and unique constraints are kept.",
+        )
+        parser.add_argument(
+            '--index-jobs',
+            action='store',
+            dest='index_jobs',
+            type=int,
+            default=2,
+            help='How many indexes to rebuild at once. Default: 2'
+        )
+        parser.add_argument(
+            '--summary-file',
+            action='store',
+            dest='summary_file',
+            default=None,
+            help='Write a JSON summary of the import, with timings, to this file.'
+        )
+        parser.add_argument(
+            '--apportion',
+            action='store',
+            dest='apportion',
+            default=None,
+            help='Reattribute the values to other geographies using this CSV file of factors, '
+                 'with source_code, target_code and factor columns.'
+        )
+        parser.add_argument(
+            '--apportion-levels',
+            action='store',
+            dest='apportion_levels',
+            default='ward:ward',
+            help='The geo levels to reattribute values from and to, as SOURCE:TARGET. Default: ward:ward'
+        )
+        parser.add_argument(
+            '--apportion-cache',
+            action='store',
+            dest='apportion_cache',
+            default=None,
+            help='Cache the --apportion factor matrix in this directory'
+        )
 
     def debug(self, msg):
         if self.verbosity >= 2:
@@ -73,18 +132,38 @@ class Command(BaseCommand):
         self.geo_version = options.get('geo_version')
         self.value_type = options.get('value_type', 'Integer')
         self.dryrun = options.get('dryrun', False)
+        self.staging = options.get('staging', False)
+        self.defer_indexes = options.get('defer_indexes', False)
+        self.index_jobs = bounded_jobs(options.get('index_jobs') or 1)
+        self.summary_file = options.get('summary_file')
+        self.progress = ProgressReporter(self.stdout, total_bytes=os.path.getsize(self.filepath))
+        self.resolver = GeoResolver.for_version(self.geo_version)
+
+        self.apportionment = None
+        if options.get('apportion'):
+            try:
+                self.apportion_from, self.apportion_to = options['apportion_levels'].split(':')
+            except ValueError:
+                raise CommandError("--apportion-levels must be SOURCE:TARGET, eg. ward:ward")
+            self.apportionment = Apportionment.from_csv(options['apportion'], 'source_code', 'target_code', 'factor',
+                                                        cache_dir=options.get('apportion_cache'))
 
         if self.dryrun:
             self.stdout.write("DRY RUN: not actuall writing data")
 
         with open(self.filepath) as f:
-            self.f = f
+            self.f = CountingFile(f)
             self.reader = csv.DictReader(self.f, delimiter=",")
             # Fields excluding geo_level, geo_code and total
             self.fields = self.reader.fieldnames[2:-1]
 
             self.setup_table()
-            self.store_values()
+            if self.staging:
+                self.store_values_staged()
+            else:
+                self.store_values()
+
+        self.progress.finish(self.summary_file)
 
     def setup_table(self):
         table_id = self.table_id or get_table_id(self.fields)
@@ -94,26 +173,127 @@ class Command(BaseCommand):
         except KeyError:
             raise CommandError("Couldn't establish which table to use for these fields. Have you added a FieldTable entry in wazimap_za/tables.py?\nFields: %s" % self.fields)
 
+    def read_values(self):
+        """ Yield a dict of column values for each row in the file.
+        """
+        for row in self.progress.timed(self.reader, 'parse'):
+            with self.progress.phase('parse'):
+                row['geo_version'] = self.geo_version
+                if row['total'] == 'no data':
+                    row['total'] = None
+                else:
+                    row['total'] = round(float(row['total']), 1) if self.value_type == 'Float' else int(round(float(row['total'])))
+            self.debug("%s-%s" % (row['geo_level'], row['geo_code']))
+
+            with self.progress.phase('validate'):
+                if not self.resolver.lookup_code(row['geo_code'], row['geo_level']):
+                    self.stdout.write("Unknown geography for version %s: %s-%s" % (self.geo_version, row['geo_level'], row['geo_code']))
+
+            self.progress.update(bytes_read=self.f.tell())
+            yield row
+
+    def values(self):
+        if self.apportionment:
+            return self.apportioned_values()
+        return self.read_values()
+
+    def apportioned_values(self):
+        """ Yield the rows in the file, with the values of rows at the source
+        level reattributed to geographies at the target level.
+        """
+        sources = []
+        for row in self.read_values():
+            if row['geo_level'] == self.apportion_from:
+                sources.append(row)
+            else:
+                yield row
+
+        with self.progress.phase('apportion'):
+            try:
+                # a source with no data gives its targets no data
+                rows = self.apportionment.apply_rows(sources, 'geo_code', ['total'], self.fields, keep_nulls=True)
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        for row in rows:
+            row['geo_level'] = self.apportion_to
+            row['geo_version'] = self.geo_version
+            if row['total'] is not None:
+                row['total'] = round(row['total'], 1) if self.value_type == 'Float' else int(round(row['total']))
+            yield row
+
     def store_values(self):
         session = get_session()
         count = 0
-        for row in self.reader:
-            count += 1
-            row['geo_version'] = self.geo_version
-            if row['total'] == 'no data':
-                row['total'] = None
-            else:
-                row['total'] = round(float(row['total']), 1) if self.value_type == 'Float' else int(round(float(row['total'])))
-            self.stdout.write("%s-%s" % (row['geo_level'], row['geo_code']))
-            entry = self.table.model(**row)
 
-            if not self.dryrun:
-                session.add(entry)
+        indexes = []
+        if self.defer_indexes and not self.dryrun:
+            indexes = drop_indexes(session, self.table.db_table)
+            for index in indexes:
+                self.stdout.write("Deferring index: %s" % index.create_sql(self.table.db_table))
+
+        try:
+            for row in self.values():
+                count += 1
+                with self.progress.phase('write'):
+                    entry = self.table.model(**row)
+
+                    if not self.dryrun:
+                        session.add(entry)
 
-            if count % 100 == 0:
-                session.flush()
+                    if count % 100 == 0:
+                        session.flush()
 
-        if not self.dryrun:
-            session.commit()
+            with self.progress.phase('write'):
+                if not self.dryrun:
+                    clear_geo_checksums(session, self.table.db_table, self.geo_version)
+                    session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+            # rebuild the indexes even if the load failed, so the table isn't left without them
+            if indexes:
+                self.report_index_times(build_indexes(self.table.db_table, indexes, jobs=self.index_jobs))
+
+    def report_index_times(self, timings):
+        for name, seconds in timings:
+            self.stdout.write("Built index %s on %s in %.2fs" % (name, self.table.db_table, seconds))
+
+    def store_values_staged(self):
+        """ Load the new rows into a staging table, along with the existing rows
+        of the geographies that aren't in the file, and swap it with the live
+        table once it's indexed and valid.
+        """
+        session = get_session()
+        staging = StagingTable(session, self.table.db_table)
+        batch = []
 
-        session.close()
+        try:
+            staging.create()
+
+            for row in self.values():
+                batch.append(row)
+                if len(batch) == 1000:
+                    with self.progress.phase('write'):
+                        staging.insert(batch, self.table.model.__table__)
+                    batch = []
+
+            with self.progress.phase('write'):
+                staging.insert(batch, self.table.model.__table__)
+                staging.copy_live_rows()
+
+            self.report_index_times(staging.build_indexes(jobs=self.index_jobs))
+            count = staging.validate()
+
+            if self.dryrun:
+                staging.drop()
+            else:
+                staging.swap(before_commit=lambda: clear_geo_checksums(session, self.table.db_table))
+                self.stdout.write("Swapped in %s with %d rows" % (self.table.db_table, count))
+        except:
+            staging.drop()
+            raise
+        finally:
+            session.close()
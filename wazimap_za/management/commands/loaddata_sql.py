@@ -0,0 +1,236 @@
+import glob
+import os
+import re
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wazimap.data.utils import get_session
+
+from wazimap_za.bookkeeping import clear_geo_checksums, dump_checksums, ensure_table, get_dump_checksums, store_dump_checksum
+from wazimap_za.dumps import TableDump, dump_table_name, file_checksum, pg_client_args, pg_client_env
+from wazimap_za.loading import MAINTENANCE_WORK_MEM, StagingTable, bounded_jobs, table_exists
+
+"""
+Loads the pg_dump files in sql/ into the database.
+
+Each data table is loaded into a staging table without indexes, then
+indexed and checked, and then swapped with the live table in a single
+short transaction, so the site never serves an empty or partially
+loaded table while data is being reloaded.
+
+Dumps that hold more than a table, such as the geography dumps with
+their sequences, are passed to psql as they are, in a single transaction
+that is rolled back at the first error.
+
+The geography dumps (00_demarcation*.sql, 01_policedistrict_2014.sql and
+any other numbered dumps) are loaded first and in order, since other
+dumps may refer to them, and the first of them to fail stops the load.
+The data dumps are then loaded --jobs at a time, each over its own
+connection plus one for each of its --index-jobs, and as many as fit in
+the connection pool. A data dump that fails to load is reported and the
+others are still loaded.
+
+The checksum of each dump is recorded when it is loaded, and dumps that
+haven't changed since they were last loaded are skipped, unless --force is given
+or their table no longer exists.
+"""
+
+# Dumps that must be loaded first, in order
+ORDERED_DUMP_RE = re.compile(r'^\d+_')
+
+
+class Command(BaseCommand):
+    help = ("Loads pg_dump files from the sql/ directory into the database, " +
+            "swapping each data table into place once it is fully loaded.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'files',
+            nargs='*',
+            help='The dump files to load. Default: sql/*.sql'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dryrun',
+            default=False,
+            help="Dry-run, only list the dumps that would be loaded.",
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help="Load all the dumps, even those that haven't changed since they were last loaded.",
+        )
+        parser.add_argument(
+            '--jobs',
+            action='store',
+            dest='jobs',
+            type=int,
+            default=4,
+            help='How many data dumps to load at once, up to what fits in the connection pool. Default: 4'
+        )
+        parser.add_argument(
+            '--index-jobs',
+            action='store',
+            dest='index_jobs',
+            type=int,
+            default=2,
+            help='How many indexes to build at once for each table. Default: 2'
+        )
+        parser.add_argument(
+            '--maintenance-work-mem',
+            action='store',
+            dest='maintenance_work_mem',
+            default=MAINTENANCE_WORK_MEM,
+            help='Memory for each index build. Default: %s' % MAINTENANCE_WORK_MEM
+        )
+
+    def debug(self, msg):
+        if self.verbosity >= 2:
+            self.stdout.write(str(msg))
+
+    def handle(self, *args, **options):
+        self.verbosity = options.get('verbosity', 1)
+        self.dryrun = options.get('dryrun', False)
+        # each job holds a connection while it builds its indexes, each on its own connection
+        self.index_jobs = bounded_jobs(options.get('index_jobs') or 1, reserved=2)
+        self.jobs = bounded_jobs(options.get('jobs') or 1, connections_per_job=1 + self.index_jobs)
+        self.maintenance_work_mem = options.get('maintenance_work_mem')
+        self.force = options.get('force', False)
+        self.index_times = []
+
+        paths = options.get('files') or sorted(glob.glob('sql/*.sql'))
+        if not paths:
+            raise CommandError("No dump files found. Run this from the project directory or pass the files to load.")
+
+        if not self.dryrun:
+            ensure_table(dump_checksums)
+        self.checksums = {path: file_checksum(path) for path in paths}
+        if not self.force:
+            paths = self.changed_dumps(paths)
+            if not paths:
+                self.stdout.write("All dumps are unchanged since they were last loaded. Use --force to load them anyway.")
+                return
+
+        ordered = sorted(p for p in paths if ORDERED_DUMP_RE.match(os.path.basename(p)))
+        others = [p for p in paths if p not in ordered]
+        self.total = len(paths)
+        self.done = 0
+        start = time.time()
+
+        for path in ordered:
+            self.report(path, self.load(path))
+
+        failed = []
+        # with a single job, the dumps are loaded one at a time and in order
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {executor.submit(self.load, path): path for path in others}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    self.report(path, future.result())
+                except Exception as e:
+                    self.stderr.write("Failed to load %s: %s" % (path, e))
+                    failed.append(path)
+
+        if self.index_times:
+            self.stdout.write("Index build times:")
+            for table, name, seconds in self.index_times:
+                self.stdout.write("%s %s: %.2fs" % (table, name, seconds))
+
+        if failed:
+            raise CommandError("Failed to load %d dumps: %s" % (len(failed), ", ".join(sorted(failed))))
+
+        self.stdout.write("Loaded %d dumps in %.2fs" % (self.total, time.time() - start))
+
+    def changed_dumps(self, paths):
+        """ Return the dumps whose checksums differ from those they were last
+        loaded with, or whose tables don't exist, such as if they've been dropped.
+        """
+        session = get_session()
+        try:
+            loaded = get_dump_checksums(session)
+
+            changed = []
+            for path in paths:
+                table = dump_table_name(path)
+                if loaded.get(os.path.basename(path)) != self.checksums[path]:
+                    changed.append(path)
+                elif table and not table_exists(session, table):
+                    self.debug("Missing table %s: %s" % (table, path))
+                    changed.append(path)
+                else:
+                    self.debug("Unchanged: %s" % path)
+        finally:
+            session.close()
+
+        if len(changed) < len(paths):
+            self.stdout.write("Skipping %d unchanged dumps" % (len(paths) - len(changed)))
+
+        return changed
+
+    def load(self, path):
+        """ Load a dump, and return a description of what was loaded.
+        """
+        start = time.time()
+        dump = TableDump(path)
+
+        if dump.is_single_table:
+            description = "into %s" % dump.table
+            if not self.dryrun:
+                description += ", %d rows" % self.load_table(dump)
+        else:
+            description = "with psql"
+            if not self.dryrun:
+                self.load_with_psql(path)
+
+        if not self.dryrun:
+            # only once the dump has loaded, so that a failed dump is tried again
+            self.store_checksum(path)
+
+        return description, time.time() - start
+
+    def store_checksum(self, path):
+        session = get_session()
+        try:
+            store_dump_checksum(session, os.path.basename(path), self.checksums[path])
+            session.commit()
+        finally:
+            session.close()
+
+    def report(self, path, result):
+        description, seconds = result
+        self.done += 1
+        self.stdout.write("[%d/%d] %s %s %s in %.2fs" % (
+            self.done, self.total, "Would load" if self.dryrun else "Loaded", path, description, seconds))
+
+    def load_table(self, dump):
+        session = get_session()
+        staging = StagingTable(session, dump.table, create_sql=dump.create_sql(), indexes=dump.indexes)
+
+        try:
+            staging.create()
+            with dump.copy_data() as data:
+                staging.copy_from(data, dump.columns)
+            timings = staging.build_indexes(jobs=self.index_jobs, maintenance_work_mem=self.maintenance_work_mem)
+            count = staging.validate()
+            staging.swap(before_commit=lambda: clear_geo_checksums(session, dump.table))
+        except:
+            staging.drop()
+            raise
+        finally:
+            session.close()
+
+        self.index_times.extend((dump.table, name, seconds) for name, seconds in timings)
+        return count
+
+    def load_with_psql(self, path):
+        # stop at the first error, with a non-zero exit code, and roll back the whole dump
+        args = ["psql", "-q", "-v", "ON_ERROR_STOP=1", "--single-transaction", "-f", path] + pg_client_args()
+        if subprocess.call(args, env=pg_client_env()) != 0:
+            raise CommandError("psql failed to load %s" % path)
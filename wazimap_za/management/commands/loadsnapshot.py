@@ -0,0 +1,123 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wazimap.data.utils import get_session
+
+from wazimap_za.bookkeeping import clear_geo_checksums
+from wazimap_za.loading import MAINTENANCE_WORK_MEM, StagingTable, bounded_jobs
+from wazimap_za.snapshots import TableSnapshot
+
+"""
+Loads the table snapshots written by dumpsnapshot into the database.
+
+Like loaddata_sql, each table is loaded into a staging table, indexed,
+and then swapped with the live table, --jobs tables at a time, each over
+its own connection. Tables are sent with the binary COPY format where
+they can be, which is built straight from the snapshot's arrays.
+"""
+
+
+class Command(BaseCommand):
+    help = "Loads the columnar snapshots of data tables in a directory into the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'snapshot_dir',
+            nargs='?',
+            default='snapshot',
+            help='The directory with the snapshot. Default: snapshot'
+        )
+        parser.add_argument(
+            '--table',
+            action='append',
+            dest='tables',
+            default=[],
+            help='Which table to load. Can be given more than once. Default: all tables in the snapshot'
+        )
+        parser.add_argument(
+            '--jobs',
+            action='store',
+            dest='jobs',
+            type=int,
+            default=4,
+            help='How many tables to load at once, up to what fits in the connection pool. Default: 4'
+        )
+        parser.add_argument(
+            '--index-jobs',
+            action='store',
+            dest='index_jobs',
+            type=int,
+            default=2,
+            help='How many indexes to build at once for each table. Default: 2'
+        )
+        parser.add_argument(
+            '--maintenance-work-mem',
+            action='store',
+            dest='maintenance_work_mem',
+            default=MAINTENANCE_WORK_MEM,
+            help='Memory for each index build. Default: %s' % MAINTENANCE_WORK_MEM
+        )
+
+    def handle(self, *args, **options):
+        snapshot_dir = options.get('snapshot_dir')
+        # each job holds a connection while it builds its indexes, each on its own connection
+        self.index_jobs = bounded_jobs(options.get('index_jobs') or 1, reserved=2)
+        jobs = bounded_jobs(options.get('jobs') or 1, connections_per_job=1 + self.index_jobs)
+        self.maintenance_work_mem = options.get('maintenance_work_mem')
+
+        tables = options.get('tables') or sorted(
+            d for d in os.listdir(snapshot_dir) if os.path.exists(os.path.join(snapshot_dir, d, 'meta.json')))
+        if not tables:
+            raise CommandError("No table snapshots found in %s" % snapshot_dir)
+
+        start = time.time()
+        failed = []
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(self.load, os.path.join(snapshot_dir, table)): table for table in tables}
+            for future in as_completed(futures):
+                table = futures[future]
+                try:
+                    self.stdout.write("Loaded %s: %d rows %s in %.2fs" % future.result())
+                except Exception as e:
+                    self.stderr.write("Failed to load %s: %s" % (table, e))
+                    failed.append(table)
+
+        if failed:
+            raise CommandError("Failed to load %d tables: %s" % (len(failed), ", ".join(sorted(failed))))
+
+        self.stdout.write("Loaded %d tables in %.2fs" % (len(tables), time.time() - start))
+
+    def load(self, path):
+        """ Load a table snapshot, and return a (table, rows, format, seconds) tuple.
+        """
+        start = time.time()
+        snapshot = TableSnapshot(path)
+        binary = self.load_table(snapshot)
+        return snapshot.table, snapshot.rows, "as binary" if binary else "as text", time.time() - start
+
+    def load_table(self, snapshot):
+        session = get_session()
+        quote = session.get_bind().dialect.identifier_preparer.quote
+        staging = StagingTable(session, snapshot.table, create_sql=snapshot.create_sql(), indexes=snapshot.indexes)
+
+        try:
+            staging.create()
+            columns = [quote(c) for c in snapshot.column_names]
+            binary = snapshot.can_copy_binary
+            if binary:
+                staging.copy_from(snapshot.copy_binary(), columns, binary=True)
+            else:
+                staging.copy_from(snapshot.copy_data(), columns)
+            staging.build_indexes(jobs=self.index_jobs, maintenance_work_mem=self.maintenance_work_mem)
+            staging.validate()
+            staging.swap(before_commit=lambda: clear_geo_checksums(session, snapshot.table))
+        except:
+            staging.drop()
+            raise
+        finally:
+            session.close()
+
+        return binary
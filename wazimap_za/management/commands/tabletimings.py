@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from wazimap.data.tables import get_datatable
+from wazimap_za.lazy_tables import LazyTableMixin, build_all
+
+"""
+Reports how long it takes to declare the data tables in tables.py, which
+is all that happens at start-up, and how long each table takes to build
+its model and columns when it's first used. The sum of the build times is
+what every process used to spend at start-up before tables were lazy.
+"""
+
+
+class Command(BaseCommand):
+    help = "Reports the start-up cost of declaring the data tables, and the cost of building each table."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--table',
+            action='append',
+            dest='tables',
+            default=[],
+            help='Only build this table. Can be given more than once.'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Declared tables in %.3fs" % LazyTableMixin.declare_seconds)
+
+        if options['tables']:
+            timings = []
+            for table_id in options['tables']:
+                table = get_datatable(table_id)
+                table.build()
+                timings.append((table, table.build_seconds or 0.0))
+        else:
+            timings = build_all()
+
+        for table, seconds in sorted(timings, key=lambda t: -t[1]):
+            self.stdout.write("%-60s %.3fs" % (table.id, seconds))
+
+        if timings:
+            total = sum(s for t, s in timings)
+            self.stdout.write("Built %d tables in %.3fs, %.3fs per table" % (len(timings), total, total / len(timings)))
@@ -0,0 +1,120 @@
+import json
+import os
+from collections import OrderedDict
+
+from wazimap.data.tables import FieldTable
+
+"""
+A precompiled manifest of the data tables, so that the data API can list
+and search them without building their models or querying the database.
+
+The manifest is a JSON file written by the buildmanifest command. It has
+an entry for each table with its metadata (id, fields, universe,
+denominator, dataset, year and db_table), the distinct categories of each
+field, and the table's description for the data API. When the
+TABLE_MANIFEST_PATH setting is set, the manifest is loaded at start-up and
+the /api/1.0/table listing is served from it.
+"""
+
+MANIFEST_FORMAT = 1
+
+
+def field_categories(session, table):
+    """ Return an OrderedDict from each of a FieldTable's fields to a sorted list of its distinct values.
+    """
+    categories = OrderedDict()
+    for field in table.fields:
+        # through the model, so that encoded categories are decoded
+        column = getattr(table.model, field)
+        categories[field] = [row[0] for row in session.query(column).distinct().order_by(column)]
+    return categories
+
+
+def table_entry(session, table):
+    """ The manifest entry for a data table. This builds the table if it's lazy.
+    """
+    is_field_table = isinstance(table, FieldTable)
+
+    return OrderedDict([
+        ('id', table.id),
+        ('fields', table.fields if is_field_table else []),
+        ('universe', table.universe),
+        ('description', table.description),
+        ('denominator', table.denominator_key if is_field_table else table.total_column),
+        ('dataset', table.dataset_name),
+        ('year', table.year),
+        ('db_table', table.db_table),
+        ('categories', field_categories(session, table) if is_field_table else OrderedDict()),
+        ('api', table.as_dict(columns=False)),
+    ])
+
+
+def write_manifest(session, tables, path):
+    """ Write a manifest of +tables+ to +path+, replacing it once it's complete.
+    """
+    manifest = OrderedDict([
+        ('format', MANIFEST_FORMAT),
+        ('tables', [table_entry(session, t) for t in sorted(tables, key=lambda t: t.id)]),
+    ])
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(tmp_path, path)
+
+    return len(manifest['tables'])
+
+
+class TableManifest(object):
+    """ The data tables in a manifest file.
+
+    Usage::
+
+        manifest = TableManifest('table-manifest.json')
+        manifest.search('household income')
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path) as f:
+            data = json.load(f, object_pairs_hook=OrderedDict)
+
+        if data['format'] != MANIFEST_FORMAT:
+            raise ValueError("Unsupported manifest format %s in %s" % (data['format'], path))
+
+        self.tables = OrderedDict((t['id'], t) for t in data['tables'])
+        self.search_text = {}
+        for t in data['tables']:
+            words = [t['id'], t['description'], t['universe'], t['dataset']] + t['fields']
+            for values in t['categories'].itervalues():
+                words.extend(values)
+            self.search_text[t['id']] = ' '.join(unicode(w) for w in words if w).lower()
+
+    def get(self, table_id):
+        return self.tables[table_id.upper()]
+
+    def search(self, query):
+        """ The tables that have every word of +query+ in their id, description,
+        universe, dataset, fields or categories.
+        """
+        words = query.lower().split()
+        return [t for t in self.tables.itervalues()
+                if all(w in self.search_text[t['id']] for w in words)]
+
+    def api_tables(self, query=None):
+        """ The tables as described by the data API's table listing, optionally
+        only those matching +query+.
+        """
+        tables = self.search(query) if query else self.tables.itervalues()
+        return [t['api'] for t in tables]
+
+
+def serve_tables_from_manifest(manifest):
+    """ Serve the data API's table listing from +manifest+, with an optional
+    ?q= search, instead of from the data tables.
+    """
+    from wazimap.views import TableAPIView, render_json_to_response
+
+    def get(self, request, *args, **kwargs):
+        return render_json_to_response(manifest.api_tables(request.GET.get('q')))
+
+    TableAPIView.get = get
@@ -0,0 +1,139 @@
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+"""
+Progress reporting for long-running imports.
+
+Writing a line to the console for every row of a large file takes
+a noticeable part of the import time, so the reporter only writes a
+status line every few seconds.
+"""
+
+
+class CountingFile(object):
+    """ Wraps a file that is read by iterating over its lines, counting the
+    bytes read. file.tell() isn't available while iterating over a file.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = next(self.f)
+        self.bytes_read += len(line)
+        return line
+
+    __next__ = next
+
+    def seek(self, offset, whence=0):
+        self.f.seek(offset, whence)
+        self.bytes_read = self.f.tell()
+
+    def tell(self):
+        return self.bytes_read
+
+
+class ProgressReporter(object):
+    """ Tracks rows and bytes processed and the time spent in each phase
+    of an import, and writes a status line at most every +interval+ seconds.
+
+    Usage::
+
+        progress = ProgressReporter(self.stdout, total_bytes=os.path.getsize(path))
+        for row in rows:
+            with progress.phase('write'):
+                ...
+            progress.update(bytes_read=f.tell())
+        progress.finish()
+    """
+    def __init__(self, stream, total_bytes=None, interval=2.0, clock=time.time):
+        self.stream = stream
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.clock = clock
+
+        self.rows = 0
+        self.bytes_read = 0
+        self.phases = OrderedDict()
+        self.start = self.last_report = clock()
+
+    def update(self, rows=1, bytes_read=None):
+        self.rows += rows
+        if bytes_read is not None:
+            self.bytes_read = bytes_read
+
+        now = self.clock()
+        if self.stream is not None and now - self.last_report >= self.interval:
+            self.last_report = now
+            self.stream.write(self.status(now))
+
+    @contextmanager
+    def phase(self, name):
+        """ Time the enclosed block as part of phase +name+.
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + self.clock() - start
+
+    def timed(self, iterable, name):
+        """ Iterate over +iterable+, timing each step as part of phase +name+.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def status(self, now=None):
+        elapsed = max((now or self.clock()) - self.start, 0.001)
+        parts = [
+            "%d rows" % self.rows,
+            "%.0f rows/s" % (self.rows / elapsed),
+            "%.1f KB/s" % (self.bytes_read / elapsed / 1024),
+        ]
+
+        if self.total_bytes and self.bytes_read:
+            fraction = float(self.bytes_read) / self.total_bytes
+            eta = elapsed / fraction - elapsed
+            parts.append("%.0f%%" % (fraction * 100))
+            parts.append("ETA %s" % time.strftime('%H:%M:%S', time.gmtime(eta)))
+
+        return ', '.join(parts)
+
+    def summary(self):
+        """ A dict summarising the import, suitable for serialising as JSON.
+        """
+        elapsed = max(self.clock() - self.start, 0.001)
+        return OrderedDict([
+            ('rows', self.rows),
+            ('bytes', self.bytes_read),
+            ('seconds', round(elapsed, 3)),
+            ('rows_per_second', round(self.rows / elapsed, 1)),
+            ('bytes_per_second', round(self.bytes_read / elapsed, 1)),
+            ('phases', OrderedDict((k, round(v, 3)) for k, v in self.phases.iteritems())),
+        ])
+
+    def finish(self, summary_file=None):
+        """ Write a final summary line, and a JSON summary to +summary_file+ if given.
+        """
+        summary = self.summary()
+
+        if self.stream is not None:
+            phases = ', '.join('%s %.2fs' % (k, v) for k, v in summary['phases'].iteritems())
+            self.stream.write("Done: %d rows in %.2fs (%s)" % (summary['rows'], summary['seconds'], phases))
+
+        if summary_file:
+            with open(summary_file, 'w') as f:
+                json.dump(summary, f, indent=2)
+
+        return summary
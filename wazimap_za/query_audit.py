@@ -0,0 +1,144 @@
+import json
+import re
+import sys
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+"""
+Captures the SQL statements issued while building profiles, and summarises
+their query plans, so that slow queries, sequential scans and bad row
+estimates can be found and traced back to a profile section and data table.
+
+Statements are attributed to the profile section whose get_<section>_profile
+function was running when they were issued, found by walking the stack.
+"""
+
+SECTION_FUNCTION_RE = re.compile(r'^get_(\w+)_profile$')
+TABLE_RE = re.compile(r'\b(?:FROM|JOIN)\s+"?(\w+)"?', re.IGNORECASE)
+
+
+def current_section(frame=None):
+    """ The name of the innermost profile section function on the stack, or None.
+    """
+    frame = frame or sys._getframe(1)
+    while frame is not None:
+        match = SECTION_FUNCTION_RE.match(frame.f_code.co_name)
+        if match:
+            return match.group(1)
+        frame = frame.f_back
+
+
+def statement_tables(statement):
+    """ The names of the tables a SELECT statement reads from.
+    """
+    return sorted(set(TABLE_RE.findall(statement)))
+
+
+class CapturedStatement(object):
+    """ A distinct SELECT statement, with the parameters it was first run with.
+    """
+    def __init__(self, statement, parameters):
+        self.statement = statement
+        self.parameters = parameters
+        self.count = 0
+        self.sections = set()
+        self.geo_levels = set()
+        self.tables = statement_tables(statement)
+
+
+class QueryCapture(object):
+    """ Records the distinct SELECT statements run on a SQLAlchemy engine.
+    Statements are distinct by their text and the +label+ they were run under,
+    such as a geo level.
+
+    Usage::
+
+        capture = QueryCapture(engine)
+        with capture.capturing('ward'):
+            get_profile(geo, 'census', None)
+        capture.statements
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = OrderedDict()
+        self.label = None
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if executemany or not statement.lstrip().upper().startswith('SELECT'):
+            return
+
+        key = (self.label, statement)
+        captured = self.statements.get(key)
+        if captured is None:
+            captured = self.statements[key] = CapturedStatement(statement, parameters)
+
+        captured.count += 1
+        captured.geo_levels.add(self.label)
+        captured.sections.add(current_section() or 'other')
+
+    @contextmanager
+    def capturing(self, label):
+        """ Record the statements run in the enclosed block under +label+.
+        """
+        self.label = label
+        event.listen(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        try:
+            yield
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+            self.label = None
+
+
+def explain_analyze(engine, statement, parameters):
+    """ Run a statement with EXPLAIN (ANALYZE, BUFFERS) and return its JSON plan.
+    The statement's effects are rolled back.
+    """
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement, parameters)
+        plan = cursor.fetchone()[0]
+        cursor.close()
+        connection.rollback()
+    finally:
+        connection.close()
+
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+def plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        for n in plan_nodes(child):
+            yield n
+
+
+def estimate_error(node):
+    """ How many times the planner's estimate of a node's rows was out, per loop.
+    """
+    estimated = max(node.get('Plan Rows', 0), 1)
+    actual = max(node.get('Actual Rows', 0), 1)
+    return float(max(estimated, actual)) / min(estimated, actual)
+
+
+def summarise_plan(plan):
+    """ Summarise a JSON plan from `explain_analyze` as a dict of the execution
+    time in ms, the relations that were scanned sequentially, the node with the
+    worst row estimate and the number of shared buffers hit and read.
+    """
+    root = plan['Plan']
+    nodes = list(plan_nodes(root))
+    worst = max(nodes, key=estimate_error)
+
+    return {
+        'ms': plan.get('Execution Time', root.get('Actual Total Time', 0.0)),
+        'seq_scans': sorted(set(n.get('Relation Name', '?') for n in nodes if n['Node Type'] == 'Seq Scan')),
+        'estimate_error': estimate_error(worst),
+        'estimate_node': '%s%s' % (worst['Node Type'], ' on %s' % worst['Relation Name'] if 'Relation Name' in worst else ''),
+        'buffers_hit': root.get('Shared Hit Blocks', 0),
+        'buffers_read': root.get('Shared Read Blocks', 0),
+    }
@@ -12,6 +12,23 @@ DATABASES['default']['TEST'] = {
     'NAME': 'test_wazimap_za',
 }
 
+# Serve the geographies and data from a read-only SQLite file built
+# with `python manage.py buildsqlite`, rather than from postgres.
+SQLITE_DATA_PATH = os.environ.get('SQLITE_DATA_PATH')
+if SQLITE_DATA_PATH:
+    SQLITE_DATA_PATH = os.path.abspath(SQLITE_DATA_PATH)
+    DATABASE_URL = 'sqlite:///' + SQLITE_DATA_PATH
+    # keep the other settings, such as ATOMIC_REQUESTS, but not postgres' connection options
+    DATABASES['default'].update({
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': SQLITE_DATA_PATH,
+    })
+    DATABASES['default'].pop('OPTIONS', None)
+
+# Serve the data API's table listing from a manifest built
+# with `python manage.py buildmanifest`, rather than from the data tables.
+TABLE_MANIFEST_PATH = os.environ.get('TABLE_MANIFEST_PATH')
+
 # redirect www.wazimap.co.za to wazimap.co.za
 STRIP_WWW = True
 
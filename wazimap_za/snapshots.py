@@ -0,0 +1,453 @@
+import json
+import os
+import struct
+from decimal import Decimal
+
+import numpy as np
+from sqlalchemy import text
+
+from wazimap_za.loading import IndexDef, get_table_indexes
+
+"""
+Compact, columnar snapshots of data tables.
+
+Each table is written to its own directory, with a NumPy array per column
+and a meta.json file describing the table. Text columns, such as geo_level,
+geo_code and the field values, are dictionary-encoded: the array holds
+an index into a list of the distinct strings, stored in meta.json.
+Decimal columns are dictionary-encoded as strings too, so they keep their
+exact values. Integer and floating point columns are stored as they are,
+with a separate mask for NULLs.
+
+Snapshots are written a chunk of rows at a time, and the arrays are loaded
+with mmap, so neither writing nor reading a snapshot needs more memory than
+a chunk of rows and the dictionaries.
+
+Tables with only integer, floating point and text columns are loaded with
+postgres' binary COPY format, which is built from the arrays with NumPy
+rather than formatting each value in Python. Other tables, such as those
+with decimal columns, are loaded with the text COPY format.
+"""
+
+SNAPSHOT_FORMAT = 2
+# format 1 stored decimal columns as floats, and can still be read
+READABLE_FORMATS = (1, 2)
+
+INTEGER_TYPES = ('smallint', 'integer', 'bigint')
+FLOAT_TYPES = ('real', 'double precision')
+
+# The binary COPY representation of the number types
+BINARY_DTYPES = {
+    'smallint': np.dtype('>i2'),
+    'integer': np.dtype('>i4'),
+    'bigint': np.dtype('>i8'),
+    'real': np.dtype('>f4'),
+    'double precision': np.dtype('>f8'),
+}
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_BINARY_TRAILER = struct.pack('>h', -1)
+
+
+def get_table_columns(session, table_name):
+    """ Return a list of (name, type, not null) tuples for a database table,
+    where type is the postgres type, eg. "character varying(128)".
+    """
+    return list(session.execute(text(
+        "SELECT attname, format_type(atttypid, atttypmod), attnotnull FROM pg_attribute "
+        "WHERE attrelid = to_regclass(:table) AND attnum > 0 AND NOT attisdropped "
+        "ORDER BY attnum"), {'table': table_name}))
+
+
+def column_kind(pg_type):
+    if pg_type in INTEGER_TYPES:
+        return 'int'
+    elif pg_type in FLOAT_TYPES:
+        return 'float'
+    elif pg_type.startswith('numeric'):
+        return 'decimal'
+    return 'text'
+
+
+def code_dtype(size):
+    # the smallest unsigned type that can index a dictionary of +size+ entries
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if size <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def is_binary_text(pg_type):
+    # types whose binary COPY representation is the UTF-8 text
+    return pg_type == 'text' or pg_type.startswith('character varying')
+
+
+def binary_dictionary(dictionary):
+    """ Return (fields, mask) for the binary COPY fields of the strings in a
+    dictionary: each is its length followed by its UTF-8 bytes, or a length
+    of -1 for NULL. +fields+ has a row of bytes for each string, padded to the
+    longest, and +mask+ picks out the bytes that aren't padding (or is None if
+    there aren't any).
+    """
+    fields = []
+    for value in dictionary:
+        if value is None:
+            fields.append(struct.pack('>i', -1))
+        else:
+            if isinstance(value, unicode):
+                value = value.encode('utf8')
+            fields.append(struct.pack('>i', len(value)) + value)
+
+    lengths = np.array([len(f) for f in fields], dtype=np.int64)
+    width = lengths.max() if fields else 4
+    padded = np.zeros((len(fields), width), dtype=np.uint8)
+    for i, field in enumerate(fields):
+        padded[i, :len(field)] = np.frombuffer(field, dtype=np.uint8)
+
+    if (lengths == width).all():
+        return padded, None
+    return padded, np.arange(width) < lengths[:, np.newaxis]
+
+
+def binary_numbers(values, nulls, dtype):
+    """ Return (fields, mask) for the binary COPY fields of an array of
+    numbers, as for `binary_dictionary`. NULLs are just a length of -1.
+    """
+    fields = np.empty(len(values), dtype=[('length', '>i4'), ('value', dtype)])
+    fields['length'] = dtype.itemsize
+    fields['value'] = values
+    mask = None
+    if nulls is not None and nulls.any():
+        fields['length'][nulls] = -1
+        mask = np.ones((len(values), fields.itemsize), dtype=bool)
+        mask[nulls, 4:] = False
+
+    return fields.view(np.uint8).reshape(len(values), fields.itemsize), mask
+
+
+def binary_rows(columns, rows):
+    """ Join the fields of +rows+ rows into binary COPY tuples. +columns+ has
+    a (fields, mask) tuple for each column, from `binary_dictionary` or
+    `binary_numbers`.
+
+    The rows are laid out with each field padded to the widest in its column,
+    and then the padding is dropped, which is much quicker with numpy than
+    placing fields of different lengths one at a time.
+    """
+    width = 2 + sum(fields.shape[1] for fields, mask in columns)
+    padded = np.empty((rows, width), dtype=np.uint8)
+    padded[:, :2] = np.frombuffer(struct.pack('>h', len(columns)), dtype=np.uint8)
+    keep = None
+
+    offset = 2
+    for fields, mask in columns:
+        stop = offset + fields.shape[1]
+        padded[:, offset:stop] = fields
+        if mask is not None:
+            if keep is None:
+                keep = np.ones((rows, width), dtype=bool)
+            keep[:, offset:stop] = mask
+        offset = stop
+
+    if keep is None:
+        return padded.tostring()
+    return padded[keep].tostring()
+
+
+def copy_escape(value):
+    """ Format a value for postgres' text COPY format.
+    """
+    if value is None:
+        return '\\N'
+    if not isinstance(value, basestring):
+        return repr(value) if isinstance(value, float) else str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class TableSnapshot(object):
+    """ A snapshot of a data table in a directory.
+
+    Usage::
+
+        snapshot = TableSnapshot.write(session, 'gender', 'snapshot/gender')
+        ...
+        snapshot = TableSnapshot('snapshot/gender')
+        staging.copy_from(snapshot.copy_data(), snapshot.column_names)
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        if self.meta['format'] not in READABLE_FORMATS:
+            raise ValueError("Unsupported snapshot format %s in %s" % (self.meta['format'], path))
+
+        self.table = self.meta['table']
+        self.rows = self.meta['rows']
+        self.columns = self.meta['columns']
+        self.column_names = [c['name'] for c in self.columns]
+        self.indexes = [IndexDef(**i) for i in self.meta['indexes']]
+
+    @classmethod
+    def write(cls, session, table_name, path, chunk_size=10000):
+        """ Write a snapshot of +table_name+ into the directory +path+,
+        +chunk_size+ rows at a time.
+        """
+        columns = get_table_columns(session, table_name)
+        if not columns:
+            raise ValueError("Table %s doesn't exist" % table_name)
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        quote = session.get_bind().dialect.identifier_preparer.quote
+        result = session.execute(text("SELECT %s FROM %s" % (
+            ", ".join(quote(c[0]) for c in columns), quote(table_name))).execution_options(stream_results=True))
+
+        writers = [ColumnWriter(path, i, name, pg_type, not_null)
+                   for i, (name, pg_type, not_null) in enumerate(columns)]
+        count = 0
+        try:
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for writer, values in zip(writers, zip(*rows)):
+                    writer.append(values)
+                count += len(rows)
+
+            meta_columns = [writer.finish(chunk_size) for writer in writers]
+        finally:
+            for writer in writers:
+                writer.close()
+
+        meta = {
+            'format': SNAPSHOT_FORMAT,
+            'table': table_name,
+            'rows': count,
+            'columns': meta_columns,
+            'indexes': [vars(i) for i in get_table_indexes(session, table_name)],
+        }
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+        return cls(path)
+
+    def array(self, name):
+        """ The raw array for a column, memory-mapped. For text columns,
+        this is the dictionary codes.
+        """
+        column = self.columns[self.column_names.index(name)]
+        return np.load(os.path.join(self.path, column['file']), mmap_mode='r')
+
+    def values(self, name, start=0, stop=None):
+        """ The decoded values of a column, as a NumPy object array.
+        """
+        column = self.columns[self.column_names.index(name)]
+        array = self.array(name)[start:stop]
+
+        if column['kind'] == 'text':
+            return np.array(column['dictionary'], dtype=object)[array]
+        if column['kind'] == 'decimal':
+            dictionary = [None if v is None else Decimal(v) for v in column['dictionary']]
+            return np.array(dictionary, dtype=object)[array]
+
+        values = array.astype(object)
+        if 'nulls' in column:
+            nulls = np.load(os.path.join(self.path, column['nulls']), mmap_mode='r')[start:stop]
+            values[nulls] = None
+        return values
+
+    def create_sql(self):
+        """ A CREATE TABLE statement for this table, with a %s placeholder
+        for the table name.
+        """
+        columns = ', '.join('"%s" %s%s' % (c['name'], c['type'], ' NOT NULL' if c['not_null'] else '')
+                            for c in self.columns)
+        return "CREATE TABLE %%s (%s)" % columns.replace('%', '%%')
+
+    def copy_data(self, chunk_size=10000):
+        """ Return a file-like object with the rows in postgres' text COPY format.
+        """
+        return CopyReader(self.copy_chunks(chunk_size))
+
+    def copy_chunks(self, chunk_size):
+        for start in xrange(0, self.rows, chunk_size):
+            stop = min(start + chunk_size, self.rows)
+            columns = [self.values(name, start, stop) for name in self.column_names]
+            yield ''.join('\t'.join(copy_escape(v) for v in row) + '\n' for row in zip(*columns))
+
+    @property
+    def can_copy_binary(self):
+        """ Can this table be loaded with the binary COPY format?
+        """
+        return all(c['type'] in BINARY_DTYPES if c['kind'] in ('int', 'float')
+                   else c['kind'] == 'text' and is_binary_text(c['type'])
+                   for c in self.columns)
+
+    def copy_binary(self, chunk_size=100000):
+        """ Return a file-like object with the rows in postgres' binary COPY format.
+        Only for tables that `can_copy_binary`.
+        """
+        return CopyReader(self.binary_chunks(chunk_size))
+
+    def binary_chunks(self, chunk_size):
+        dictionaries = {c['name']: binary_dictionary(c['dictionary']) for c in self.columns if c['kind'] == 'text'}
+
+        yield COPY_BINARY_HEADER
+        for start in xrange(0, self.rows, chunk_size):
+            stop = min(start + chunk_size, self.rows)
+            columns = []
+            for column in self.columns:
+                array = self.array(column['name'])[start:stop]
+                if column['kind'] == 'text':
+                    fields, mask = dictionaries[column['name']]
+                    columns.append((fields[array], None if mask is None else mask[array]))
+                else:
+                    nulls = None
+                    if 'nulls' in column:
+                        nulls = np.load(os.path.join(self.path, column['nulls']), mmap_mode='r')[start:stop]
+                    columns.append(binary_numbers(array, nulls, BINARY_DTYPES[column['type']]))
+            yield binary_rows(columns, stop - start)
+        yield COPY_BINARY_TRAILER
+
+
+class ColumnWriter(object):
+    """ Writes column number +index+ of a snapshot into the directory +path+.
+
+    Chunks of values are appended to raw files, with text and decimal values
+    encoded as they're seen, and `finish` converts them into the column's
+    arrays, with the dictionary sorted and the smallest type of code.
+    """
+    def __init__(self, path, index, name, pg_type, not_null):
+        self.path = path
+        self.column = {
+            'name': name,
+            'type': pg_type,
+            'not_null': not_null,
+            'kind': column_kind(pg_type),
+            'file': '%d.npy' % index,
+        }
+        self.nulls_file = '%d.nulls.npy' % index
+        self.encoded = self.column['kind'] in ('text', 'decimal')
+        if self.encoded:
+            self.dtype = np.uint32
+        else:
+            self.dtype = np.int64 if self.column['kind'] == 'int' else np.float64
+
+        self.codes = {}
+        self.rows = 0
+        self.has_nulls = False
+        self.tmp_paths = [self.file_path(self.column['file']) + '.tmp']
+        self.raw = open(self.tmp_paths[0], 'wb')
+        if not self.encoded:
+            self.tmp_paths.append(self.file_path(self.nulls_file) + '.tmp')
+            self.raw_nulls = open(self.tmp_paths[1], 'wb')
+
+    def file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def code(self, value):
+        if isinstance(value, Decimal):
+            value = str(value)
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.codes)
+        return code
+
+    def append(self, values):
+        if self.encoded:
+            array = np.fromiter((self.code(v) for v in values), dtype=self.dtype, count=len(values))
+        else:
+            nulls = np.array([v is None for v in values], dtype=bool)
+            self.has_nulls = self.has_nulls or nulls.any()
+            nulls.tofile(self.raw_nulls)
+            array = np.array([0 if v is None else v for v in values], dtype=self.dtype)
+
+        array.tofile(self.raw)
+        self.rows += len(values)
+
+    def finish(self, chunk_size=10000):
+        """ Write the column's arrays, and return its description for meta.json.
+        """
+        self.raw.close()
+        if self.encoded:
+            # number the codes in dictionary order
+            dictionary = sorted(self.codes)
+            self.column['dictionary'] = dictionary
+            dtype = code_dtype(len(dictionary))
+            order = np.empty(len(dictionary), dtype=dtype)
+            for i, value in enumerate(dictionary):
+                order[self.codes[value]] = i
+            self.convert(self.tmp_paths[0], self.file_path(self.column['file']), self.dtype, dtype, chunk_size, order)
+        else:
+            self.raw_nulls.close()
+            self.convert(self.tmp_paths[0], self.file_path(self.column['file']), self.dtype, self.dtype, chunk_size)
+            if self.has_nulls:
+                self.column['nulls'] = self.nulls_file
+                self.convert(self.tmp_paths[1], self.file_path(self.nulls_file), bool, bool, chunk_size)
+
+        return self.column
+
+    def convert(self, raw_path, path, raw_dtype, dtype, chunk_size, mapping=None):
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(self.rows,))
+        if self.rows:
+            raw = np.memmap(raw_path, dtype=raw_dtype, mode='r', shape=(self.rows,))
+            for start in xrange(0, self.rows, chunk_size):
+                chunk = raw[start:start + chunk_size]
+                out[start:start + chunk_size] = chunk if mapping is None else mapping[chunk]
+            del raw
+        out.flush()
+        del out
+
+    def close(self):
+        """ Close and remove the raw files.
+        """
+        self.raw.close()
+        if not self.encoded:
+            self.raw_nulls.close()
+        for path in self.tmp_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class CopyReader(object):
+    """ A read-only file-like object over an iterator of strings.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        # reads move through the buffer rather than copying what's left of it each time
+        self.pos = 0
+
+    def fill(self):
+        """ Add the next chunk to the buffer, and return False if there are none left.
+        """
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.pos < size:
+            if not self.fill():
+                break
+
+        end = len(self.buffer) if size < 0 else min(self.pos + size, len(self.buffer))
+        data, self.pos = self.buffer[self.pos:end], end
+        return data
+
+    def readline(self, size=-1):
+        while self.buffer.find('\n', self.pos) < 0:
+            if not self.fill():
+                break
+
+        end = self.buffer.find('\n', self.pos) + 1 or len(self.buffer)
+        if 0 <= size < end - self.pos:
+            end = self.pos + size
+        data, self.pos = self.buffer[self.pos:end], end
+        return data
@@ -0,0 +1,142 @@
+import os
+import re
+import sqlite3
+from decimal import Decimal
+
+from sqlalchemy import text
+
+from wazimap_za.loading import KEY_CONSTRAINT_RE, get_table_indexes
+from wazimap_za.snapshots import column_kind, get_table_columns
+
+"""
+A read-only SQLite copy of the data tables and geographies, which can
+be served instead of postgres.
+
+`build_sqlite` copies tables from postgres into a new SQLite file, with
+the same primary keys and indexes. When the SQLITE_DATA_PATH setting is
+set, Django and the data tables are served from that file, and
+`use_readonly_sqlite` makes every connection read-only and memory-mapped.
+"""
+
+SQLITE_TYPES = {
+    'int': 'INTEGER',
+    'float': 'REAL',
+    'decimal': 'REAL',
+    'text': 'TEXT',
+}
+
+# How much of the file to memory-map for each connection
+MMAP_SIZE = 1024 * 1024 * 1024
+
+INDEX_COLUMNS_RE = re.compile(r'^USING \w+ (\(.*\))$', re.DOTALL)
+
+
+def sqlite_table_sql(table_name, columns, indexes):
+    """ Return the statements to create a SQLite table and its indexes, from
+    the postgres +columns+ (see `get_table_columns`) and IndexDefs.
+    """
+    definitions = ['"%s" %s%s' % (name, SQLITE_TYPES[column_kind(pg_type)], ' NOT NULL' if not_null else '')
+                   for name, pg_type, not_null in columns]
+    statements = []
+    primary_key = None
+
+    for index in indexes:
+        match = index.constraint and KEY_CONSTRAINT_RE.match(index.definition)
+        if match:
+            kind, index_columns = match.groups()
+            if kind == 'PRIMARY KEY':
+                primary_key = index_columns
+            else:
+                statements.append('CREATE UNIQUE INDEX "%s" ON "%s" %s' % (index.name, table_name, index_columns))
+            continue
+
+        # other constraints, such as foreign keys, don't matter for a read-only copy
+        match = not index.constraint and INDEX_COLUMNS_RE.match(index.definition)
+        if match:
+            statements.append('CREATE %sINDEX "%s" ON "%s" %s' % (
+                'UNIQUE ' if index.unique else '', index.name, table_name, match.group(1)))
+
+    if primary_key:
+        # store the rows in primary key order, so that lookups by geography are a single range scan
+        definitions.append('PRIMARY KEY %s' % primary_key)
+        create = 'CREATE TABLE "%s" (%s) WITHOUT ROWID' % (table_name, ', '.join(definitions))
+    else:
+        create = 'CREATE TABLE "%s" (%s)' % (table_name, ', '.join(definitions))
+
+    return [create] + statements
+
+
+def copy_table(session, db, table_name, chunk_size=10000):
+    """ Copy a table from postgres into the SQLite connection +db+, and return
+    the number of rows copied.
+    """
+    columns = get_table_columns(session, table_name)
+    if not columns:
+        raise ValueError("Table %s doesn't exist" % table_name)
+
+    for sql in sqlite_table_sql(table_name, columns, get_table_indexes(session, table_name)):
+        db.execute(sql)
+
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    result = session.execute(text("SELECT %s FROM %s" % (
+        ", ".join(quote(c[0]) for c in columns), quote(table_name))).execution_options(stream_results=True))
+    insert = 'INSERT INTO "%s" VALUES (%s)' % (table_name, ', '.join('?' for c in columns))
+
+    count = 0
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        # sqlite can't store Decimals
+        db.executemany(insert, [[float(v) if isinstance(v, Decimal) else v for v in row] for row in rows])
+        count += len(rows)
+
+    return count
+
+
+def build_sqlite(session, path, tables):
+    """ Build a SQLite file at +path+ with a copy of each of +tables+, and return
+    a list of (table, rows) tuples. The file is only replaced once it's complete.
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    db = sqlite3.connect(tmp_path)
+    try:
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        counts = [(table, copy_table(session, db, table)) for table in tables]
+        db.commit()
+        db.execute("ANALYZE")
+        db.execute("VACUUM")
+    finally:
+        db.close()
+
+    os.rename(tmp_path, path)
+    return counts
+
+
+def configure_connection(connection, mmap_size=MMAP_SIZE):
+    """ Make a SQLite DB-API connection read-only and memory-mapped.
+    """
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA query_only = ON")
+    cursor.execute("PRAGMA mmap_size = %d" % mmap_size)
+    cursor.close()
+
+
+def use_readonly_sqlite(mmap_size=MMAP_SIZE):
+    """ Configure every new Django and SQLAlchemy connection to the
+    SQLite data file to be read-only and memory-mapped.
+    """
+    from django.db.backends.signals import connection_created
+    from sqlalchemy import event
+    from wazimap.data.utils import _engine
+
+    def django_connection(sender, connection, **kwargs):
+        if connection.vendor == 'sqlite':
+            configure_connection(connection.connection, mmap_size)
+
+    connection_created.connect(django_connection, weak=False)
+    event.listen(_engine, 'connect', lambda connection, record: configure_connection(connection, mmap_size))
@@ -1,7 +1,8 @@
 from django.conf import settings
-from wazimap.data.tables import FieldTable, SimpleTable
+from wazimap_za.lazy_tables import LazyFieldTable as FieldTable, LazySimpleTable as SimpleTable
 
 # Define our tables for each profile so the data API can discover them.
+# Their models are only built when they're first used, see lazy_tables.py.
 
 # All profiles
 
@@ -0,0 +1,48 @@
+from django.test import TestCase
+
+from wazimap_za.aggregation import aggregate_to_parents, geo_ancestors
+
+
+GEOS = [
+    ('country', 'ZA', None, None),
+    ('province', 'WC', 'country', 'ZA'),
+    ('district', 'DC4', 'province', 'WC'),
+    ('municipality', 'WC044', 'district', 'DC4'),
+    ('municipality', 'CPT', 'province', 'WC'),
+    ('ward', '10404010', 'municipality', 'WC044'),
+    ('ward', '19100001', 'municipality', 'CPT'),
+]
+
+
+class AggregationTests(TestCase):
+    def test_geo_ancestors(self):
+        ancestors = geo_ancestors(GEOS)
+        self.assertEqual([('municipality', 'WC044'), ('district', 'DC4'), ('province', 'WC'), ('country', 'ZA')],
+                         ancestors[('ward', '10404010')])
+        # metros have no district
+        self.assertEqual([('municipality', 'CPT'), ('province', 'WC'), ('country', 'ZA')],
+                         ancestors[('ward', '19100001')])
+
+    def test_aggregate_to_parents(self):
+        rows = aggregate_to_parents([
+            {'geo_level': 'ward', 'geo_code': '10404010', 'year': '2016', 'crime': 'Contact crime', 'total': '3'},
+            {'geo_level': 'ward', 'geo_code': '19100001', 'year': '2016', 'crime': 'Contact crime', 'total': '5'},
+            {'geo_level': 'ward', 'geo_code': '19100001', 'year': '2015', 'crime': 'Contact crime', 'total': '2'},
+        ], GEOS, ['year', 'crime'])
+
+        totals = dict(((r['geo_level'], r['geo_code'], r['year']), r['total']) for r in rows)
+        self.assertEqual({
+            ('municipality', 'WC044', '2016'): 3.0,
+            ('district', 'DC4', '2016'): 3.0,
+            ('municipality', 'CPT', '2016'): 5.0,
+            ('province', 'WC', '2016'): 8.0,
+            ('country', 'ZA', '2016'): 8.0,
+            ('municipality', 'CPT', '2015'): 2.0,
+            ('province', 'WC', '2015'): 2.0,
+            ('country', 'ZA', '2015'): 2.0,
+        }, totals)
+        self.assertTrue(all(r['crime'] == 'Contact crime' for r in rows))
+
+    def test_unmapped_ward(self):
+        with self.assertRaises(ValueError):
+            aggregate_to_parents([{'geo_level': 'ward', 'geo_code': '99999999', 'total': '1'}], GEOS, [])
@@ -0,0 +1,51 @@
+from django.test import TestCase
+
+from wazimap_za.apportion import Apportionment
+
+
+class ApportionmentTests(TestCase):
+    def setUp(self):
+        self.apportionment = Apportionment.from_rows([
+            {'station': 'a', 'ward': '1', 'factor': '0.5'},
+            {'station': 'a', 'ward': '2', 'factor': '0.5'},
+            {'station': 'b', 'ward': '2', 'factor': '1'},
+        ], 'station', 'ward', 'factor')
+
+    def test_apply(self):
+        # station x year
+        result = self.apportionment.apply([[10, 2], [5, 0]])
+        self.assertEqual([[5, 1], [10, 1]], result.tolist())
+
+    def test_apply_rows(self):
+        rows = self.apportionment.apply_rows([
+            {'station': 'a', 'year': '2004', 'contact': '10'},
+            {'station': 'b', 'year': '2004', 'contact': '5'},
+            {'station': 'a', 'year': '2005', 'contact': '2'},
+        ], 'station', ['contact'], ['year'], target_key='ward')
+
+        self.assertEqual([
+            {'ward': '1', 'year': '2004', 'contact': 5.0},
+            {'ward': '2', 'year': '2004', 'contact': 10.0},
+            {'ward': '1', 'year': '2005', 'contact': 1.0},
+            {'ward': '2', 'year': '2005', 'contact': 1.0},
+        ], rows)
+
+    def test_apply_rows_keep_nulls(self):
+        rows = self.apportionment.apply_rows([
+            {'station': 'a', 'contact': None},
+            {'station': 'b', 'contact': '5'},
+        ], 'station', ['contact'], target_key='ward', keep_nulls=True)
+
+        self.assertEqual([
+            {'ward': '1', 'contact': None},
+            {'ward': '2', 'contact': None},
+        ], rows)
+
+        rows = self.apportionment.apply_rows([
+            {'station': 'b', 'contact': None},
+        ], 'station', ['contact'], target_key='ward')
+        self.assertEqual([{'ward': '2', 'contact': 0.0}], rows)
+
+    def test_unknown_source(self):
+        with self.assertRaises(ValueError):
+            self.apportionment.apply_rows([{'station': 'c', 'contact': '1'}], 'station', ['contact'])
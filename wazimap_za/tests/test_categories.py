@@ -0,0 +1,24 @@
+from django.test import TestCase
+
+from wazimap_za.categories import UNKNOWN_CODE, CategoryDictionary, CategoryType, check_constraint_name
+
+
+class CategoryTests(TestCase):
+    def setUp(self):
+        self.dictionary = CategoryDictionary('gender', ['Female', 'Male'])
+
+    def test_dictionary(self):
+        self.assertEqual(1, self.dictionary.encode('Male'))
+        self.assertEqual('Female', self.dictionary.decode(0))
+        self.assertEqual(UNKNOWN_CODE, self.dictionary.encode('Unspecified'))
+
+    def test_type(self):
+        category = CategoryType(self.dictionary)
+        self.assertEqual(0, category.process_bind_param('Female', None))
+        self.assertEqual('Male', category.process_result_value(1, None))
+        self.assertIsNone(category.process_bind_param(None, None))
+
+    def test_check_constraint_name(self):
+        name = check_constraint_name('gender_population_group', 'population group')
+        self.assertTrue(name.startswith('category_check_'))
+        self.assertNotEqual(name, check_constraint_name('gender_population_group', 'gender'))
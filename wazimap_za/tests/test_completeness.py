@@ -0,0 +1,17 @@
+from collections import namedtuple
+
+from django.test import TestCase
+
+from wazimap_za.completeness import is_additive
+from wazimap_za.management.commands.checkhierarchy import NON_ADDITIVE_TABLES
+
+
+Table = namedtuple('Table', ['id', 'stat_type'])
+
+
+class CompletenessTests(TestCase):
+    def test_is_additive(self):
+        self.assertTrue(is_additive(Table('GENDER', 'number')))
+        self.assertFalse(is_additive(Table('YOUTH_DELIVERY_RATE_YEAR', 'percentage')))
+        self.assertFalse(is_additive(Table('YOUTH_MPI_SCORE', 'number'), NON_ADDITIVE_TABLES))
+        self.assertTrue(is_additive(Table('YOUTH_MPI_SCORE', 'number')))
@@ -0,0 +1,48 @@
+from collections import namedtuple
+
+from django.test import TestCase
+
+from wazimap_za.geo import GeoResolver
+
+
+Geo = namedtuple('Geo', ['geo_level', 'geo_code', 'name', 'parent_level'])
+
+
+class GeoResolverTests(TestCase):
+    def setUp(self):
+        self.resolver = GeoResolver([
+            Geo('country', 'ZA', 'South Africa', None),
+            Geo('province', 'WC', 'Western Cape', 'country'),
+            Geo('district', 'DC1', 'West Coast', 'province'),
+            Geo('municipality', 'CPT', 'City of Cape Town', 'province'),
+            Geo('municipality', 'WC011', 'Matzikama', 'district'),
+            Geo('municipality', 'EC136', 'Emalahleni', 'district'),
+            Geo('municipality', 'MP312', 'Emalahleni', 'district'),
+            Geo('ward', '19100105', 'City of Cape Town Ward 105', 'municipality'),
+        ])
+
+    def test_resolve(self):
+        self.assertEqual(('country', 'ZA'), self.resolver.resolve(''))
+        self.assertEqual(('municipality', 'WC011'), self.resolver.resolve('WC011: Matzikama'))
+        self.assertEqual(('district', 'DC1'), self.resolver.resolve('DC1: West Coast'))
+        self.assertEqual(('ward', '19100105'), self.resolver.resolve('19100105: Ward 105'))
+        self.assertEqual(('province', 'WC'), self.resolver.resolve('Western  cape '))
+        self.assertEqual(('municipality', 'CPT'), self.resolver.resolve('City of Cape Town'))
+
+    def test_resolve_unknown(self):
+        with self.assertRaises(ValueError):
+            self.resolver.resolve('Atlantis')
+
+        # local municipalities are only recognised by their codes
+        with self.assertRaises(ValueError):
+            self.resolver.resolve('Matzikama')
+
+    def test_lookup(self):
+        self.assertEqual([('municipality', 'WC011')], self.resolver.lookup_code('wc011'))
+        self.assertEqual([], self.resolver.lookup_code('WC011', 'ward'))
+        self.assertEqual(2, len(self.resolver.lookup_name('Emalahleni')))
+        self.assertEqual([('district', 'DC1')], self.resolver.lookup_name('west coast', ['district']))
+
+    def test_describe(self):
+        self.assertEqual('municipality-WC011 (Matzikama)', self.resolver.describe(('municipality', 'WC011')))
+        self.assertEqual('ward-1', self.resolver.describe(('ward', '1')))
@@ -0,0 +1,27 @@
+from django.test import TestCase
+
+from wazimap_za.indexes import find_geo_index, geo_index_columns, geo_index_name
+
+
+class GeoIndexTests(TestCase):
+    def test_find_geo_index(self):
+        indexes = [
+            ('gender_geo_code', ['geo_code'], True),
+            ('gender_pkey', ['geo_level', 'geo_code', 'geo_version', 'gender'], True),
+        ]
+        self.assertEqual('gender_pkey', find_geo_index(indexes))
+        self.assertEqual('gender_pkey', find_geo_index(indexes, ['gender']))
+        self.assertIsNone(find_geo_index(indexes, ['gender', 'total']))
+        self.assertIsNone(find_geo_index(indexes[:1]))
+
+    def test_invalid_index(self):
+        indexes = [('gender_geo_lookup', ['geo_version', 'geo_level', 'geo_code'], False)]
+        self.assertIsNone(find_geo_index(indexes))
+
+    def test_geo_index_columns(self):
+        self.assertEqual(['geo_version', 'geo_level', 'geo_code'], geo_index_columns([]))
+        self.assertEqual(['geo_version', 'geo_level', 'geo_code', 'gender', 'total'], geo_index_columns(['gender']))
+
+    def test_geo_index_name(self):
+        self.assertEqual('gender_geo_lookup', geo_index_name('gender'))
+        self.assertEqual(63, len(geo_index_name('x' * 70)))
@@ -0,0 +1,42 @@
+from django.test import TestCase
+
+from wazimap.data.tables import DATA_TABLES, FIELD_TABLES, FieldTable, get_datatable
+
+from wazimap_za.lazy_tables import LazyFieldTable
+
+
+class LazyTableTests(TestCase):
+    def setUp(self):
+        self.table = LazyFieldTable(['lazy test field'], universe='Tests')
+
+    def tearDown(self):
+        DATA_TABLES.pop(self.table.id, None)
+        FIELD_TABLES.pop(self.table.id, None)
+
+    def test_declared_not_built(self):
+        self.assertIs(self.table, get_datatable('lazytestfield'))
+        self.assertIs(self.table, FieldTable.for_fields(['lazy test field']))
+        self.assertEqual('Tests by lazy test field', self.table.description)
+        self.assertFalse(self.table.built)
+
+    def test_built_on_first_use(self):
+        model = self.table.model
+        self.assertTrue(self.table.built)
+        self.assertEqual('lazytestfield', model.__table__.name)
+        self.assertEqual('total', self.table.total_column)
+
+    def test_shared_db_table_declaration_order(self):
+        first = LazyFieldTable(['lazy test field', 'lazy other field'], universe='Tests')
+        second = LazyFieldTable(['lazy other field', 'lazy test field'], id='lazy_test_second',
+                                universe='Tests', db_table=first.db_table)
+        third = LazyFieldTable(['lazy other field', 'lazy test field'], id='lazy_test_third',
+                               universe='Tests', db_table=first.db_table)
+        try:
+            # building the last table first still registers them in declaration order
+            self.assertEqual([first, second, third], third.model.data_tables)
+            self.assertIs(third.model, second.model)
+            self.assertEqual([first, second, third], second.model.data_tables)
+        finally:
+            for table in (first, second, third):
+                DATA_TABLES.pop(table.id, None)
+                FIELD_TABLES.pop(table.id, None)
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from wazimap_za.management.commands import loaddata_sql
+
+
+class FakeSubprocess(object):
+    def __init__(self, returncode):
+        self.returncode = returncode
+        self.calls = []
+
+    def call(self, args, **kwargs):
+        self.calls.append(args)
+        return self.returncode
+
+
+class RecordingCommand(loaddata_sql.Command):
+    def store_checksum(self, path):
+        self.stored.append(path)
+
+
+class LoadDataSqlTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, '00_test.sql')
+        with open(self.path, 'w') as f:
+            f.write("CREATE TABLE test_geography (\n    id integer NOT NULL\n);\n"
+                    "CREATE SEQUENCE test_geography_id_seq;\n")
+
+        self.subprocess = loaddata_sql.subprocess
+        self.command = RecordingCommand()
+        self.command.dryrun = False
+        self.command.stored = []
+        self.command.checksums = {self.path: 'da39a3ee5e6b4b0d3255bfef95601890afd80709'}
+
+    def tearDown(self):
+        loaddata_sql.subprocess = self.subprocess
+        shutil.rmtree(self.dir)
+
+    def test_failed_load_stores_no_checksum(self):
+        loaddata_sql.subprocess = FakeSubprocess(3)
+        with self.assertRaises(CommandError):
+            self.command.load(self.path)
+
+        self.assertEqual([], self.command.stored)
+        args = loaddata_sql.subprocess.calls[0]
+        self.assertIn('ON_ERROR_STOP=1', args)
+        self.assertIn('--single-transaction', args)
+
+    def test_load_stores_checksum(self):
+        loaddata_sql.subprocess = FakeSubprocess(0)
+        self.command.load(self.path)
+        self.assertEqual([self.path], self.command.stored)
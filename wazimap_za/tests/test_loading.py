@@ -0,0 +1,33 @@
+from django.test import TestCase
+
+from wazimap_za.loading import IndexDef, format_size, staging_name
+
+
+class IndexDefTests(TestCase):
+    def test_enforces_uniqueness(self):
+        self.assertTrue(IndexDef('gender_pkey', 'PRIMARY KEY (geo_level, geo_code)', constraint=True).enforces_uniqueness)
+        self.assertTrue(IndexDef('gender_uniq', 'USING btree (geo_code)', unique=True).enforces_uniqueness)
+        self.assertFalse(IndexDef('gender_geo_code', 'USING btree (geo_code)').enforces_uniqueness)
+        self.assertFalse(IndexDef('gender_check', 'CHECK (total >= 0)', constraint=True).enforces_uniqueness)
+
+    def test_build_sql(self):
+        index = IndexDef('gender_pkey', 'PRIMARY KEY (geo_level, geo_code)', constraint=True)
+        self.assertEqual([
+            'CREATE UNIQUE INDEX gender_pkey ON gender (geo_level, geo_code)',
+            'ALTER TABLE gender ADD CONSTRAINT gender_pkey PRIMARY KEY USING INDEX gender_pkey',
+        ], index.build_sql('gender'))
+
+    def test_from_index_sql(self):
+        index = IndexDef.from_index_sql('CREATE INDEX gender_geo_code ON gender USING btree (geo_code)')
+        self.assertEqual('gender_geo_code', index.name)
+        self.assertEqual('USING btree (geo_code)', index.definition)
+        self.assertFalse(index.unique)
+
+    def test_staging_name(self):
+        self.assertEqual('gender_staging', staging_name('gender'))
+        self.assertEqual(63, len(staging_name('x' * 70, '_retired')))
+
+    def test_format_size(self):
+        self.assertEqual('512 bytes', format_size(512))
+        self.assertEqual('2 MB', format_size(2 * 1024 * 1024))
+        self.assertEqual('1.5 GB', format_size(1.5 * 1024 ** 3))
@@ -0,0 +1,56 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from wazimap_za.manifest import MANIFEST_FORMAT, TableManifest
+
+
+def entry(id, fields, universe, categories):
+    return {
+        'id': id,
+        'fields': fields,
+        'universe': universe,
+        'description': universe + ' by ' + ', '.join(fields),
+        'denominator': None,
+        'dataset': 'Census 2011',
+        'year': '2011',
+        'db_table': id.lower(),
+        'categories': categories,
+        'api': {'table_id': id, 'universe': universe},
+    }
+
+
+class TableManifestTests(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        manifest_path = os.path.join(self.path, 'manifest.json')
+
+        with open(manifest_path, 'w') as f:
+            json.dump({
+                'format': MANIFEST_FORMAT,
+                'tables': [
+                    entry('GENDER', ['gender'], 'Population', {'gender': ['Female', 'Male']}),
+                    entry('TENURESTATUS', ['tenure status'], 'Households',
+                          {'tenure status': ['Owned and fully paid off', 'Rented']}),
+                ],
+            }, f)
+
+        self.manifest = TableManifest(manifest_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get(self):
+        self.assertEqual(['tenure status'], self.manifest.get('tenurestatus')['fields'])
+
+    def test_search(self):
+        self.assertEqual(['GENDER'], [t['id'] for t in self.manifest.search('female')])
+        self.assertEqual(['TENURESTATUS'], [t['id'] for t in self.manifest.search('households rented')])
+        self.assertEqual([], self.manifest.search('households female'))
+
+    def test_api_tables(self):
+        self.assertEqual(['GENDER', 'TENURESTATUS'], [t['table_id'] for t in self.manifest.api_tables()])
+        self.assertEqual([{'table_id': 'GENDER', 'universe': 'Population'}], self.manifest.api_tables('gender'))
@@ -0,0 +1,57 @@
+from StringIO import StringIO
+
+from django.test import TestCase
+
+from wazimap_za.progress import CountingFile, ProgressReporter
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Lines(list):
+    # like a management command's stdout, one line per write
+    def write(self, msg):
+        self.append(msg)
+
+
+class ProgressReporterTests(TestCase):
+    def test_bounded_status_lines(self):
+        clock = FakeClock()
+        stream = Lines()
+        progress = ProgressReporter(stream, total_bytes=1000, interval=2.0, clock=clock)
+
+        for i in xrange(10):
+            clock.now += 0.5
+            progress.update(bytes_read=(i + 1) * 50)
+
+        # 5 seconds at a 2 second interval
+        self.assertEqual(2, len(stream))
+        self.assertIn('50%', progress.status())
+
+    def test_summary(self):
+        clock = FakeClock()
+        progress = ProgressReporter(None, clock=clock)
+
+        with progress.phase('parse'):
+            clock.now += 1.0
+        for item in progress.timed(iter([1, 2]), 'write'):
+            clock.now += 0.5
+        progress.update(rows=100, bytes_read=2000)
+        clock.now += 1.0
+
+        summary = progress.finish()
+        self.assertEqual(100, summary['rows'])
+        self.assertEqual(3.0, summary['seconds'])
+        self.assertEqual(1.0, summary['phases']['parse'])
+        # only time spent fetching items counts towards the phase
+        self.assertEqual(0.0, summary['phases']['write'])
+
+    def test_counting_file(self):
+        f = CountingFile(StringIO("a,b\n1,2\n"))
+        self.assertEqual(['a,b\n', '1,2\n'], list(f))
+        self.assertEqual(8, f.tell())
@@ -0,0 +1,42 @@
+from django.test import TestCase
+
+from wazimap_za.query_audit import current_section, statement_tables, summarise_plan
+
+
+PLAN = {
+    'Plan': {
+        'Node Type': 'Aggregate',
+        'Plan Rows': 1,
+        'Actual Rows': 1,
+        'Shared Hit Blocks': 12,
+        'Shared Read Blocks': 3,
+        'Plans': [{
+            'Node Type': 'Seq Scan',
+            'Relation Name': 'gender',
+            'Plan Rows': 2,
+            'Actual Rows': 200,
+        }],
+    },
+    'Execution Time': 1.5,
+}
+
+
+class QueryAuditTests(TestCase):
+    def test_current_section(self):
+        def get_demographics_profile():
+            return current_section()
+
+        self.assertEqual('demographics', get_demographics_profile())
+        self.assertIsNone(current_section())
+
+    def test_statement_tables(self):
+        self.assertEqual(['gender', 'wazimap_geography'], statement_tables(
+            'SELECT sum(gender.total) AS total FROM gender JOIN "wazimap_geography" ON 1 = 1'))
+
+    def test_summarise_plan(self):
+        summary = summarise_plan(PLAN)
+        self.assertEqual(1.5, summary['ms'])
+        self.assertEqual(['gender'], summary['seq_scans'])
+        self.assertEqual(100.0, summary['estimate_error'])
+        self.assertEqual('Seq Scan on gender', summary['estimate_node'])
+        self.assertEqual(12, summary['buffers_hit'])
@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import struct
+import tempfile
+from decimal import Decimal
+
+import numpy as np
+from django.test import TestCase
+
+from wazimap_za.snapshots import SNAPSHOT_FORMAT, ColumnWriter, TableSnapshot, copy_escape
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_write_text_column(self):
+        writer = ColumnWriter(self.path, 0, 'geo_level', 'character varying(15)', True)
+        writer.append(['ward', 'province'])
+        writer.append(['ward', None])
+        column = writer.finish(chunk_size=3)
+        writer.close()
+
+        self.assertEqual([None, 'province', 'ward'], column['dictionary'])
+        codes = np.load(os.path.join(self.path, '0.npy'))
+        self.assertEqual([2, 1, 2, 0], list(codes))
+        self.assertEqual(np.uint8, codes.dtype)
+        self.assertEqual(['0.npy'], os.listdir(self.path))
+
+    def test_write_number_columns(self):
+        writer = ColumnWriter(self.path, 0, 'total', 'integer', False)
+        writer.append([10, None])
+        writer.append([12])
+        column = writer.finish()
+        writer.close()
+
+        self.assertEqual('0.nulls.npy', column['nulls'])
+        self.assertEqual([10, 0, 12], list(np.load(os.path.join(self.path, '0.npy'))))
+        self.assertEqual([False, True, False], list(np.load(os.path.join(self.path, '0.nulls.npy'))))
+
+        writer = ColumnWriter(self.path, 1, 'score', 'numeric(5,2)', True)
+        writer.append([Decimal('0.10'), Decimal('2.35')])
+        column = writer.finish()
+        writer.close()
+
+        self.assertEqual('decimal', column['kind'])
+        self.assertEqual(['0.10', '2.35'], column['dictionary'])
+
+    def test_copy_escape(self):
+        self.assertEqual('\\N', copy_escape(None))
+        self.assertEqual('12', copy_escape(12))
+        self.assertEqual('a\\tb\\\\c', copy_escape(u'a\tb\\c'))
+
+    def test_copy_data(self):
+        dictionary = ['WC', 'ZA']
+        np.save(os.path.join(self.path, '0.npy'), np.array([0, 1, 0], dtype=np.uint8))
+        np.save(os.path.join(self.path, '1.npy'), np.array([10, 0, 12], dtype=np.int64))
+        np.save(os.path.join(self.path, '1.nulls.npy'), np.array([False, True, False]))
+
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({
+                'format': SNAPSHOT_FORMAT,
+                'table': 'population',
+                'rows': 3,
+                'columns': [
+                    {'name': 'geo_code', 'type': 'character varying(8)', 'not_null': True,
+                     'kind': 'text', 'file': '0.npy', 'dictionary': dictionary},
+                    {'name': 'population', 'type': 'integer', 'not_null': False,
+                     'kind': 'int', 'file': '1.npy', 'nulls': '1.nulls.npy'},
+                ],
+                'indexes': [],
+            }, f)
+
+        snapshot = TableSnapshot(self.path)
+        self.assertEqual(['WC', 'ZA', 'WC'], list(snapshot.values('geo_code')))
+        self.assertEqual([10, None, 12], list(snapshot.values('population')))
+
+        data = snapshot.copy_data(chunk_size=2)
+        self.assertEqual('WC\t10\n', data.readline())
+        self.assertEqual('ZA\t\\N\nWC\t12\n', data.read())
+        self.assertEqual('', data.read(10))
+
+    def test_copy_binary(self):
+        np.save(os.path.join(self.path, '0.npy'), np.array([0, 1, 0], dtype=np.uint8))
+        np.save(os.path.join(self.path, '1.npy'), np.array([10, 0, 12], dtype=np.int64))
+        np.save(os.path.join(self.path, '1.nulls.npy'), np.array([False, True, False]))
+
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({
+                'format': SNAPSHOT_FORMAT,
+                'table': 'population',
+                'rows': 3,
+                'columns': [
+                    {'name': 'geo_code', 'type': 'character varying(8)', 'not_null': True,
+                     'kind': 'text', 'file': '0.npy', 'dictionary': ['WC', None]},
+                    {'name': 'population', 'type': 'integer', 'not_null': False,
+                     'kind': 'int', 'file': '1.npy', 'nulls': '1.nulls.npy'},
+                ],
+                'indexes': [],
+            }, f)
+
+        snapshot = TableSnapshot(self.path)
+        self.assertTrue(snapshot.can_copy_binary)
+
+        expected = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+        expected += struct.pack('>hi2sii', 2, 2, 'WC', 4, 10)
+        expected += struct.pack('>hii', 2, -1, -1)
+        expected += struct.pack('>hi2sii', 2, 2, 'WC', 4, 12)
+        expected += struct.pack('>h', -1)
+        self.assertEqual(expected, snapshot.copy_binary(chunk_size=2).read())
+
+        snapshot.columns[1]['type'] = 'numeric(10,2)'
+        snapshot.columns[1]['kind'] = 'decimal'
+        self.assertFalse(snapshot.can_copy_binary)